@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bitrix_app_5.settings')
+# urls.py подключает асинхронные view экспорта и импорта только под asgi
+os.environ['CONTACT_EXPORT_ASGI'] = '1'
 
 application = get_asgi_application()
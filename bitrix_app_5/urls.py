@@ -14,14 +14,32 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from contact_export import views as contact_views
 
+# под asgi экспорт и импорт идут через асинхронные view, под wsgi - через синхронные
+if getattr(settings, 'CONTACT_EXPORT_ASGI', False):
+    export_contacts = contact_views.export_contacts_async
+    export_contacts_download = contact_views.export_contacts_download_async
+    import_contacts = contact_views.import_contacts_async
+else:
+    export_contacts = contact_views.export_contacts
+    export_contacts_download = contact_views.export_contacts_download
+    import_contacts = contact_views.import_contacts
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', contact_views.start_index, name='start_index'),
     path('index/', contact_views.index_after, name='index_after'),
-    path('export_contacts/', contact_views.export_contacts, name='export_contacts'),
-    path('import_contacts/', contact_views.import_contacts, name='import_contacts'),
+    path('export_contacts/', export_contacts, name='export_contacts'),
+    path('export_contacts/download/', export_contacts_download, name='export_contacts_download'),
+    path('export_jobs/<int:job_id>/', contact_views.export_job_status, name='export_job_status'),
+    path('export_jobs/<int:job_id>/download/', contact_views.export_job_download, name='export_job_download'),
+    path('import_contacts/', import_contacts, name='import_contacts'),
+    path('import_jobs/<int:job_id>/', contact_views.import_job_status, name='import_job_status'),
+    path('import_jobs/<int:job_id>/errors/', contact_views.import_job_errors, name='import_job_errors'),
+    path('import_jobs/<int:job_id>/resume/', contact_views.import_job_resume, name='import_job_resume'),
+    path('metrics/', contact_views.contact_metrics, name='contact_metrics'),
 ]
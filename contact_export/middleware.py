@@ -0,0 +1,33 @@
+from typing import AsyncIterator, Iterable
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.utils.decorators import sync_and_async_middleware
+
+
+async def aiter_in_thread(chunks: Iterable[bytes]) -> AsyncIterator[bytes]:
+    """синхронные куски ответа для asgi: каждый читается в потоке, в памяти только текущий кусок"""
+    iterator = iter(chunks)
+    while True:
+        chunk = await sync_to_async(next)(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+@sync_and_async_middleware
+def async_streaming_middleware(get_response):
+    """под asgi отдаёт синхронные потоковые ответы (FileResponse, xlsx, файл из кэша экспорта) по кускам
+
+    django 4.2 читает синхронный потоковый ответ под asgi целиком через sync_to_async(list),
+    то есть собирает весь файл в памяти. под wsgi ответ и так читается по кускам, там middleware ничего не делает
+    """
+    if not iscoroutinefunction(get_response):
+        return get_response
+
+    async def middleware(request):
+        response = await get_response(request)
+        if getattr(response, 'streaming', False) and not response.is_async:
+            # закрытие файла и генераторов остаётся в response.close: они уже в _resource_closers
+            response.streaming_content = aiter_in_thread(response.streaming_content)
+        return response
+    return middleware
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.24 on 2026-10-18 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactMirrorState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bitrix_portal_id', models.IntegerField(unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MirroredContact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bitrix_portal_id', models.IntegerField()),
+                ('bitrix_id', models.BigIntegerField()),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('last_name', models.CharField(blank=True, max_length=255)),
+                ('phones', models.JSONField(blank=True, default=list)),
+                ('emails', models.JSONField(blank=True, default=list)),
+                ('company_id', models.CharField(blank=True, max_length=32)),
+                ('date_create', models.DateTimeField(blank=True, null=True)),
+                ('date_modify', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='mirroredcontact',
+            constraint=models.UniqueConstraint(fields=('bitrix_portal_id', 'bitrix_id'), name='unique_mirrored_contact'),
+        ),
+    ]
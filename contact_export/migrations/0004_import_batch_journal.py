@@ -0,0 +1,33 @@
+# Generated by Django 4.2.24 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0003_import_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportBatchJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bitrix_portal_id', models.IntegerField()),
+                ('file_hash', models.CharField(max_length=64)),
+                ('chunk_index', models.PositiveIntegerField()),
+                ('contact_ids', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='resumed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='importbatchjournal',
+            constraint=models.UniqueConstraint(fields=('bitrix_portal_id', 'file_hash', 'chunk_index'), name='unique_import_batch_journal_chunk'),
+        ),
+    ]
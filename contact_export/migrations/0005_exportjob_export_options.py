@@ -0,0 +1,18 @@
+# Generated by Django 4.2.24 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0004_import_batch_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='export_options',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.24 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0005_exportjob_export_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='import_mode',
+            field=models.CharField(default='create', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='updated_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='unchanged_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
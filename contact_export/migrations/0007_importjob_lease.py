@@ -0,0 +1,23 @@
+# Generated by Django 4.2.24 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0006_importjob_import_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='lease_owner',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.24 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contact_export', '0007_importjob_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importbatchjournal',
+            name='failed_rows',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -1,3 +1,129 @@
 from django.db import models
 
-# Create your models here.
+
+class BackgroundJob(models.Model):
+    """общие поля фоновых задач импорта и экспорта"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'в очереди'),
+        (STATUS_RUNNING, 'выполняется'),
+        (STATUS_DONE, 'готово'),
+        (STATUS_FAILED, 'ошибка'),
+    ]
+
+    bitrix_portal_id = models.IntegerField(db_index=True)
+    bitrix_user_id = models.IntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+        ordering = ['-created_at']
+
+
+class ExportJob(BackgroundJob):
+    """фоновая задача экспорта контактов"""
+    exporter_format = models.CharField(max_length=16)
+    # фильтр, поля и число значений мультиполей (ExportOptions.to_dict)
+    export_options = models.JSONField(default=dict, blank=True)
+    pages_fetched = models.PositiveIntegerField(default=0)
+    rows_written = models.PositiveIntegerField(default=0)
+    result_file = models.FileField(upload_to='contact_export/exports/', blank=True)
+
+    class Meta(BackgroundJob.Meta):
+        pass
+
+    def __str__(self):
+        return f'экспорт #{self.id} ({self.exporter_format}, {self.status})'
+
+
+class ImportJob(BackgroundJob):
+    """фоновая задача импорта контактов из загруженного файла"""
+    source_file = models.FileField(upload_to='contact_export/imports/')
+    original_name = models.CharField(max_length=255)
+    # create - только новые контакты, upsert - новые и изменившиеся (import_pipeline.IMPORT_MODES)
+    import_mode = models.CharField(max_length=16, default='create')
+    rows_processed = models.PositiveIntegerField(default=0)
+    success_count = models.PositiveIntegerField(default=0)
+    # upsert: обновлённые контакты (входят в success_count) и строки, совпавшие с контактом полностью
+    updated_count = models.PositiveIntegerField(default=0)
+    unchanged_count = models.PositiveIntegerField(default=0)
+    duplicate_count = models.PositiveIntegerField(default=0)
+    # строки, отправленные ещё предыдущим запуском задачи (пропущены по журналу)
+    resumed_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    # csv со строками, которые bitrix не принял, и текстом ошибки
+    error_report = models.FileField(upload_to='contact_export/import_errors/', blank=True)
+    # аренда задачи: кто её сейчас выполняет (id запуска) и до какого момента; выполняющий запуск
+    # продлевает аренду с каждым сохранением прогресса, истёкшая аренда значит, что процесс потерян
+    lease_owner = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta(BackgroundJob.Meta):
+        pass
+
+    def __str__(self):
+        return f'импорт #{self.id} ({self.original_name}, {self.status})'
+
+
+class MirroredContact(models.Model):
+    """локальная копия контакта bitrix, из которой читает экспорт"""
+    bitrix_portal_id = models.IntegerField()
+    bitrix_id = models.BigIntegerField()
+    name = models.CharField(max_length=255, blank=True)
+    last_name = models.CharField(max_length=255, blank=True)
+    phones = models.JSONField(default=list, blank=True)
+    emails = models.JSONField(default=list, blank=True)
+    company_id = models.CharField(max_length=32, blank=True)
+    date_create = models.DateTimeField(null=True, blank=True)
+    date_modify = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bitrix_portal_id', 'bitrix_id'], name='unique_mirrored_contact'),
+        ]
+
+    def __str__(self):
+        return f'контакт {self.bitrix_id} портала {self.bitrix_portal_id}'
+
+
+class ContactMirrorState(models.Model):
+    """состояние синхронизации зеркала контактов портала"""
+    bitrix_portal_id = models.IntegerField(unique=True)
+    # максимальный DATE_MODIFY среди уже загруженных контактов
+    watermark = models.DateTimeField(null=True, blank=True)
+    synced_at = models.DateTimeField(null=True, blank=True)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'зеркало контактов портала {self.bitrix_portal_id}'
+
+
+class ImportBatchJournal(models.Model):
+    """журнал отправленных chunk-ов импорта: повторный импорт того же файла отправляет из записанных chunk-ов
+    только строки, которые bitrix не принял"""
+    bitrix_portal_id = models.IntegerField()
+    # sha256 содержимого импортируемого файла
+    file_hash = models.CharField(max_length=64)
+    chunk_index = models.PositiveIntegerField()
+    # id контактов, созданных этим chunk-ом
+    contact_ids = models.JSONField(default=list, blank=True)
+    # номера строк chunk-а (с 0, по позиции в файле), которые bitrix не принял
+    failed_rows = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['bitrix_portal_id', 'file_hash', 'chunk_index'],
+                name='unique_import_batch_journal_chunk',
+            ),
+        ]
+
+    def __str__(self):
+        return f'chunk {self.chunk_index} файла {self.file_hash[:12]} портала {self.bitrix_portal_id}'
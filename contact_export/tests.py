@@ -1,3 +1,1526 @@
-from django.test import TestCase
+"""
+бенчмарки экспорта и импорта контактов на локальной заглушке bitrix rest api
 
-# Create your tests here.
+заглушка живёт в памяти процесса: синтетический портал на N контактов,
+задержка на каждый rest-запрос и "дырявое ведро" лимита запросов, как у bitrix.
+для каждого размера портала и формата файла export_contacts и import_contacts
+прогоняются целиком, а время, число rest-запросов и пик памяти сверяются
+с сохранёнными в benchmark_baseline.json значениями.
+
+переменные окружения:
+    CONTACT_EXPORT_BENCH_SIZES      размеры порталов через запятую (по умолчанию 1000,10000; 100000 - вручную)
+    CONTACT_EXPORT_BENCH_TOLERANCE  допустимое ухудшение времени и памяти относительно базы (по умолчанию 0.5 = 50%)
+    CONTACT_EXPORT_BENCH_UPDATE     1 - перезаписать базовые значения результатами прогона
+"""
+import asyncio
+import bisect
+import codecs
+import csv
+import datetime
+import gzip
+import importlib.util
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+import weakref
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock, skipUnless
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+import openpyxl
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import QueryDict
+from django.utils import timezone
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from openpyxl.utils import get_column_letter
+
+from contact_export.middleware import async_streaming_middleware
+from contact_export.models import ContactMirrorState, ImportBatchJournal, ImportJob, MirroredContact
+from contact_export.utils import (
+    async_bitrix, auth_cache, batch_scheduler, company_directory, contact_mirror, contact_source, export_cache,
+    exorter_module, import_jobs, import_journal, metrics)
+from contact_export.utils.company_resolver import CompanyResolver, normalize_company_name
+from contact_export.utils.contact_normalizer import ERROR_COLUMN, iter_normalized_contacts, normalize_phone
+from contact_export.utils.duplicate_index import ContactDuplicateIndex, ContactUpsertIndex
+from contact_export.utils.contact_source import prepare_export_row
+from contact_export.utils.exorter_module import EXPORT_HEADERS, ExporterFactory
+from contact_export.utils.export_options import ExportFilter, ExportOptions
+from contact_export.utils.import_pipeline import IMPORT_MODE_UPSERT, ImportPipeline
+from contact_export.utils.importer_module import detect_delimiter, detect_encoding, iter_imported_file
+
+BENCHMARK_SIZES = [int(size) for size in os.environ.get('CONTACT_EXPORT_BENCH_SIZES', '1000,10000').split(',')]
+BENCHMARK_FORMATS = ['csv', 'xlsx']
+BENCHMARK_TOLERANCE = float(os.environ.get('CONTACT_EXPORT_BENCH_TOLERANCE', '0.5'))
+BENCHMARK_UPDATE_BASELINE = os.environ.get('CONTACT_EXPORT_BENCH_UPDATE') == '1'
+BENCHMARK_BASELINE_PATH = Path(__file__).with_name('benchmark_baseline.json')
+# размер портала для проверки памяти потоковой отдачи: файл должен быть заметно больше
+# памяти, которую занимают страницы bitrix в обработке
+STREAMING_MEMORY_CONTACTS = 10000
+
+# параметры заглушки: задержка ответа и лимит запросов портала
+FAKE_BITRIX_LATENCY = 0.002
+FAKE_BITRIX_RATE_LIMIT = 50.0
+FAKE_BITRIX_RATE_BURST = 50
+FAKE_BITRIX_PAGE_SIZE = 50
+
+FAKE_PORTAL_ID = 1
+FAKE_PORTAL_DOMAIN = 'fake.bitrix24.ru'
+FAKE_USER_ID = 1
+
+
+class FakeBitrixApiError(Exception):
+    """ошибка заглушки в том же виде, что и ошибка rest api bitrix"""
+
+    def __init__(self, error: str, error_description: str = '', status_code: int = 400):
+        super().__init__(f'{error}: {error_description}')
+        self.error = error
+        self.error_description = error_description
+        self.status_code = status_code
+
+
+def _date(index: int) -> str:
+    return f'2024-01-{index % 28 + 1:02d}T{index % 24:02d}:00:00+03:00'
+
+
+class FakeBitrixPortal:
+    """синтетический портал bitrix в памяти процесса"""
+
+    def __init__(
+            self,
+            contacts_count: int = 0,
+            companies_count: int = 10,
+            latency: float = FAKE_BITRIX_LATENCY,
+            rate_limit: float = FAKE_BITRIX_RATE_LIMIT,
+            rate_burst: int = FAKE_BITRIX_RATE_BURST,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.rest_calls = 0
+        self.limit_errors = 0
+        self.updated_contacts = set()
+        # user.admin: администратор видит все контакты и читает экспорт из зеркала
+        self.is_admin = True
+        self._bucket = 0.0
+        self._bucket_updated = time.monotonic()
+        # RLock: команды batch-а исполняются изнутри самого batch-а
+        self._lock = threading.RLock()
+
+        self.companies: Dict[int, Dict[str, Any]] = {}
+        for index in range(1, companies_count + 1):
+            self.companies[index] = {'ID': str(index), 'TITLE': f'ООО "Компания {index}"', 'DATE_MODIFY': _date(index)}
+        self.contacts: Dict[int, Dict[str, Any]] = {}
+        for index in range(1, contacts_count + 1):
+            self.contacts[index] = {
+                'ID': str(index),
+                'NAME': f'Имя{index}',
+                'LAST_NAME': f'Фамилия{index}',
+                'PHONE': [{'ID': str(index), 'VALUE': f'+7900{index:07d}', 'VALUE_TYPE': 'WORK'}],
+                'EMAIL': [{'ID': str(index), 'VALUE': f'contact{index}@example.com', 'VALUE_TYPE': 'WORK'}],
+                'COMPANY_ID': str(index % companies_count + 1) if companies_count and index % 3 else None,
+                'DATE_CREATE': _date(index),
+                'DATE_MODIFY': _date(index),
+            }
+
+    # --- транспорт
+
+    def request(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """один rest-запрос: учитывается в счётчике, в лимите и в задержке"""
+        self._admit()
+        if self.latency:
+            time.sleep(self.latency)
+        return self.execute(method, params)
+
+    async def arequest(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """тот же rest-запрос для асинхронного клиента: задержка не занимает поток"""
+        self._admit()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.execute(method, params)
+
+    def _admit(self) -> None:
+        with self._lock:
+            self.rest_calls += 1
+            now = time.monotonic()
+            self._bucket = max(0.0, self._bucket - (now - self._bucket_updated) * self.rate_limit)
+            self._bucket_updated = now
+            if self._bucket + 1 > self.rate_burst:
+                self.limit_errors += 1
+                raise FakeBitrixApiError('QUERY_LIMIT_EXCEEDED', 'Too many requests', status_code=503)
+            self._bucket += 1
+
+    def execute(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """исполнение метода без учёта в лимите (так исполняются и команды batch-а)"""
+        handler = getattr(self, '_' + method.replace('.', '_'), None)
+        if handler is None:
+            raise FakeBitrixApiError('ERROR_METHOD_NOT_FOUND', f'Method not found: {method}', status_code=404)
+        with self._lock:
+            return handler(params)
+
+    # --- методы api
+
+    def _user_admin(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'result': self.is_admin}
+
+    def _crm_contact_list(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self._list(self.contacts, params)
+
+    def _crm_company_list(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self._list(self.companies, params)
+
+    def _crm_contact_get(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        contact = self.contacts.get(int(params.get('ID') or params.get('id') or 0))
+        if contact is None:
+            raise FakeBitrixApiError('NOT_FOUND', 'Not found')
+        return {'result': dict(contact)}
+
+    def _crm_contact_add(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        contact_id = max(self.contacts, default=0) + 1
+        fields = params.get('fields') or {}
+        self.contacts[contact_id] = dict(
+            {key: value for key, value in fields.items() if value is not None},
+            ID=str(contact_id),
+            DATE_CREATE=_date(contact_id),
+            DATE_MODIFY=_date(contact_id),
+        )
+        return {'result': contact_id}
+
+    def _crm_contact_update(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        contact = self.contacts.get(int(params.get('id') or params.get('ID') or 0))
+        if contact is None:
+            raise FakeBitrixApiError('NOT_FOUND', 'Not found')
+        for key, value in (params.get('fields') or {}).items():
+            if key in ('PHONE', 'EMAIL'):
+                # как в bitrix: значение с ID заменяет существующее, без ID - добавляется
+                items = {item.get('ID'): item for item in contact.get(key) or []}
+                for item in value:
+                    if item.get('ID') in items:
+                        items[item['ID']] = dict(items[item['ID']], **item)
+                    else:
+                        items[f'new{len(items)}'] = item
+                contact[key] = list(items.values())
+            else:
+                contact[key] = value
+        contact['DATE_MODIFY'] = '2030-01-01T00:00:00+03:00'
+        self.updated_contacts.add(contact['ID'])
+        return {'result': True}
+
+    def _crm_company_add(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        company_id = max(self.companies, default=0) + 1
+        self.companies[company_id] = {
+            'ID': str(company_id),
+            'TITLE': (params.get('fields') or {}).get('TITLE', ''),
+            'DATE_MODIFY': _date(company_id),
+        }
+        return {'result': company_id}
+
+    def _batch(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # команды batch-а через http приходят строками запроса, как их собирает http_build_query;
+        # синхронный FakeBitrixUserToken.batch_api_call исполняет их сам и передаёт пустой cmd
+        results, errors = {}, {}
+        for name, command in (params.get('cmd') or {}).items():
+            method, _, query = command.partition('?')
+            try:
+                results[name] = self.execute(method, _parse_query(query)).get('result')
+            except FakeBitrixApiError as e:
+                errors[name] = {'error': e.error, 'error_description': e.error_description}
+                if params.get('halt'):
+                    break
+        return {'result': {'result': results, 'result_error': errors}}
+
+    def _list(self, records: Dict[int, Dict[str, Any]], params: Dict[str, Any]) -> Dict[str, Any]:
+        list_filter = params.get('filter') or {}
+        select = params.get('select') or ['*']
+        # записи добавляются с растущими ID, так что словарь уже упорядочен по ID
+        ids = list(records)
+        position = bisect.bisect_right(ids, int(list_filter['>ID'])) if '>ID' in list_filter else 0
+        matched = (records[record_id] for record_id in ids[position:] if _matches(records[record_id], list_filter))
+
+        start = int(params.get('start') or 0)
+        if start == -1:
+            return {'result': [_select(record, select) for record in itertools.islice(matched, FAKE_BITRIX_PAGE_SIZE)]}
+        matched = list(matched)
+        # сортировка по ключам order от последнего к первому, как order by в sql
+        for field, direction in reversed(list((params.get('order') or {}).items())):
+            matched.sort(key=lambda record: record.get(field) or '', reverse=direction.upper() == 'DESC')
+        page = matched[start:start + FAKE_BITRIX_PAGE_SIZE]
+        response = {'result': [_select(record, select) for record in page], 'total': len(matched)}
+        if start + FAKE_BITRIX_PAGE_SIZE < len(matched):
+            response['next'] = start + FAKE_BITRIX_PAGE_SIZE
+        return response
+
+
+def _parse_query(query: str) -> Dict[str, Any]:
+    """строка запроса php (fields[PHONE][0][VALUE]=...) обратно во вложенные словари и списки"""
+    params: Dict[str, Any] = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        name, _, rest = key.partition('[')
+        path = [name] + (rest[:-1].split('][') if rest else [])
+        node = params
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+    return _lists_from_indexes(params)
+
+
+def _lists_from_indexes(value: Any) -> Any:
+    if not isinstance(value, dict):
+        return value
+    value = {key: _lists_from_indexes(item) for key, item in value.items()}
+    if value and all(key.isdigit() for key in value):
+        return [value[key] for key in sorted(value, key=int)]
+    return value
+
+
+async def _handle_fake_http_request(request: httpx.Request) -> httpx.Response:
+    """транспорт httpx для async_bitrix: https://<домен>/rest/<метод>.json?auth=<токен> -> FakeBitrixPortal"""
+    token = _fake_tokens.get(request.url.params.get('auth'))
+    if token is None:
+        return httpx.Response(401, json={'error': 'invalid_token', 'error_description': 'Unknown token'})
+    method = urlsplit(str(request.url)).path.removeprefix('/rest/').removesuffix('.json')
+    try:
+        return httpx.Response(200, json=await token.portal.arequest(method, json.loads(request.content or b'{}')))
+    except FakeBitrixApiError as e:
+        return httpx.Response(e.status_code, json={'error': e.error, 'error_description': e.error_description})
+
+
+_FILTER_OPERATORS = ['>=', '<=', '!=', '>', '<', '=', '!']
+# часовой пояс пользователя синтетического портала: в нём bitrix понимает даты без времени
+FAKE_BITRIX_USER_TIMEZONE = datetime.timezone(datetime.timedelta(hours=3))
+
+
+def _bitrix_datetime(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=FAKE_BITRIX_USER_TIMEZONE)
+
+
+def _matches(record: Dict[str, Any], record_filter: Dict[str, Any]) -> bool:
+    for key, expected in record_filter.items():
+        operator = next((candidate for candidate in _FILTER_OPERATORS if key.startswith(candidate)), '=')
+        field = key[len(operator):] if key.startswith(operator) else key
+        if field in ('HAS_PHONE', 'HAS_EMAIL'):
+            if bool(record.get(field[len('HAS_'):])) != (expected == 'Y'):
+                return False
+            continue
+        actual = record.get(field)
+        if field in ('PHONE', 'EMAIL'):
+            actual = [value['VALUE'] for value in actual or []]
+            if operator in ('!', '!=') and expected in ('', None):
+                if not actual:
+                    return False
+                continue
+            if operator == '=' and expected in ('', None):
+                if actual:
+                    return False
+                continue
+        if field in ('ID', 'COMPANY_ID'):
+            actual = int(actual) if actual else 0
+            expected = [int(value) for value in expected] if isinstance(expected, list) else int(expected or 0)
+        if isinstance(expected, list):
+            if (actual in expected) == (operator in ('!', '!=')):
+                return False
+            continue
+        if operator in ('>', '>=', '<', '<=') and actual in (None, ''):
+            return False
+        if field in ('DATE_CREATE', 'DATE_MODIFY') and actual:
+            actual, expected = _bitrix_datetime(actual), _bitrix_datetime(expected)
+        checks = {
+            '>': lambda: actual > expected,
+            '>=': lambda: actual >= expected,
+            '<': lambda: actual < expected,
+            '<=': lambda: actual <= expected,
+            '=': lambda: actual == expected,
+            '!': lambda: actual != expected,
+            '!=': lambda: actual != expected,
+        }
+        if not checks[operator]():
+            return False
+    return True
+
+
+def _select(record: Dict[str, Any], select: List[str]) -> Dict[str, Any]:
+    if '*' in select:
+        # как и bitrix, мультиполя по "*" не отдаются
+        selected = {key: value for key, value in record.items() if key not in ('PHONE', 'EMAIL')}
+        selected.update({key: record.get(key) for key in select if key != '*'})
+        return selected
+    return dict({key: record.get(key) for key in select}, ID=record['ID'])
+
+
+_fake_tokens: 'weakref.WeakValueDictionary[str, FakeBitrixUserToken]' = weakref.WeakValueDictionary()
+
+
+class FakeBitrixUserToken:
+    """заменитель BitrixUserToken, который ходит в FakeBitrixPortal вместо портала"""
+
+    def __init__(self, portal: FakeBitrixPortal):
+        self.portal = portal
+        self.user = SimpleNamespace(portal_id=FAKE_PORTAL_ID, portal=SimpleNamespace(domain=FAKE_PORTAL_DOMAIN))
+        self.user_id = FAKE_USER_ID
+        # по токену из строки запроса асинхронный транспорт находит портал
+        self.auth_token = f'fake-token-{id(self)}'
+        _fake_tokens[self.auth_token] = self
+
+    def refresh(self) -> bool:
+        return True
+
+    def call_api_method(self, api_method: str, params: Optional[Dict[str, Any]] = None, timeout: int = 60):
+        return self.portal.request(api_method, params or {})
+
+    def call_list_method(self, method: str, fields: Optional[Dict[str, Any]] = None, timeout: int = 60):
+        records = []
+        start = 0
+        while True:
+            response = self.portal.request(method, dict(fields or {}, start=start))
+            records.extend(response['result'])
+            if 'next' not in response:
+                return records
+            start = response['next']
+
+    def batch_api_call(self, methods, halt: int = 0, chunk_size: int = 50, timeout: int = 60):
+        results = {}
+        for chunk_start in range(0, len(methods), chunk_size):
+            chunk = methods[chunk_start:chunk_start + chunk_size]
+            # весь batch - один rest-запрос с общей задержкой и местом в лимите
+            self.portal.request('batch', {})
+            for index, command in enumerate(chunk, chunk_start):
+                name, method, params = command if len(command) == 3 else (str(index),) + tuple(command)
+                try:
+                    results[name] = {'result': self.portal.execute(method, params).get('result'), 'error': None}
+                except FakeBitrixApiError as e:
+                    results[name] = {'result': None, 'error': e.error, 'error_description': e.error_description}
+                    if halt:
+                        return results
+        return results
+
+
+def _load_views_without_auth():
+    """отдельная копия модуля views, в которой main_auth ничего не проверяет
+
+    токен кладётся в request.bitrix_user_token самим бенчмарком
+    """
+    def passthrough(*args, **kwargs):
+        return lambda view: view
+
+    with mock.patch('integration_utils.bitrix24.bitrix_user_auth.main_auth.main_auth', passthrough):
+        spec = importlib.util.find_spec('contact_export.views')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+def _build_import_file(rows_count: int, file_format: str) -> SimpleUploadedFile:
+    """файл импорта в том же виде, в каком его отдаёт экспорт"""
+    companies = ['ООО Компания 1', 'ИП Новый', 'ЗАО "Третья"', '']
+    contacts = [
+        {
+            'NAME': f'Новый{index}',
+            'LAST_NAME': f'Контакт{index}',
+            'PHONE': f'+7911{index:07d}',
+            'EMAIL': f'new{index}@example.com',
+            'COMPANY': companies[index % len(companies)],
+        }
+        for index in range(rows_count)
+    ]
+    exporter = ExporterFactory.get_exporter(file_format)
+    buffer = io.BytesIO()
+    exporter.write(contacts, buffer)
+    return SimpleUploadedFile(f'contacts.{file_format}', buffer.getvalue())
+
+
+def _build_upsert_file(portal: FakeBitrixPortal, file_format: str, changed_every: int) -> SimpleUploadedFile:
+    """выгрузка портала, в которой у каждого changed_every-го контакта изменена фамилия"""
+    contacts = []
+    for contact in portal.contacts.values():
+        index = int(contact['ID'])
+        company = portal.companies.get(int(contact['COMPANY_ID'])) if contact['COMPANY_ID'] else None
+        contacts.append({
+            'NAME': contact['NAME'],
+            'LAST_NAME': f'Изменённая{index}' if index % changed_every == 0 else contact['LAST_NAME'],
+            'PHONE': contact['PHONE'][0]['VALUE'],
+            # почта в другом регистре - то же значение, обновления не требует
+            'EMAIL': contact['EMAIL'][0]['VALUE'].upper(),
+            'COMPANY': company['TITLE'] if company else '',
+        })
+    exporter = ExporterFactory.get_exporter(file_format)
+    buffer = io.BytesIO()
+    exporter.write(contacts, buffer)
+    return SimpleUploadedFile(f'contacts.{file_format}', buffer.getvalue())
+
+
+def _consume_with_peak_memory(consume) -> Tuple[int, int]:
+    tracemalloc.start()
+    try:
+        size = consume()
+        return size, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def _aconsume_with_peak_memory(response) -> Tuple[int, int]:
+    tracemalloc.start()
+    try:
+        size = 0
+        async for chunk in response:
+            size += len(chunk)
+        return size, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class ContactExportImportBenchmark(TransactionTestCase):
+    """сквозные бенчмарки export_contacts и import_contacts на заглушке bitrix"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.views = _load_views_without_auth()
+        # планировщик рассчитан на лимиты настоящего портала, под заглушку их поднимаем
+        cls._patchers = [
+            mock.patch.object(batch_scheduler, 'BITRIX_RATE_LIMIT_MIN', FAKE_BITRIX_RATE_LIMIT / 10),
+            mock.patch.object(export_cache, 'EXPORT_CACHE_DIR', tempfile.mkdtemp(prefix='contact_export_bench_')),
+            # асинхронный клиент ходит в заглушку через тот же пул соединений, но без сети
+            mock.patch.object(async_bitrix, '_create_client', lambda: httpx.AsyncClient(
+                transport=httpx.MockTransport(_handle_fake_http_request))),
+        ]
+        for patcher in cls._patchers:
+            patcher.start()
+        cls.factory = RequestFactory()
+        cls.baseline = json.loads(BENCHMARK_BASELINE_PATH.read_text()) if BENCHMARK_BASELINE_PATH.exists() else {}
+        cls.measured: Dict[str, Dict[str, float]] = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        for case, metrics in sorted(cls.measured.items()):
+            print(f'>> {case}: {metrics}')
+        if BENCHMARK_UPDATE_BASELINE and cls.measured:
+            BENCHMARK_BASELINE_PATH.write_text(
+                json.dumps(dict(cls.baseline, **cls.measured), indent=2, sort_keys=True) + '\n')
+        shutil.rmtree(export_cache.EXPORT_CACHE_DIR, ignore_errors=True)
+        for patcher in cls._patchers:
+            patcher.stop()
+        super().tearDownClass()
+
+    def _reset_state(self) -> None:
+        """каждый прогон начинается с пустого зеркала и свежих кэшей процесса"""
+        MirroredContact.objects.all().delete()
+        ContactMirrorState.objects.all().delete()
+        ImportBatchJournal.objects.all().delete()
+        company_directory._directories.clear()
+        contact_mirror._admin_users.clear()
+        contact_mirror._counted_at.clear()
+        async_bitrix._portal_domains.clear()
+        shutil.rmtree(export_cache.EXPORT_CACHE_DIR, ignore_errors=True)
+        batch_scheduler._limiters[FAKE_PORTAL_ID] = batch_scheduler.PortalRateLimiter(
+            rate=FAKE_BITRIX_RATE_LIMIT, burst=FAKE_BITRIX_RATE_BURST)
+
+    def _measure(self, case: str, portal: FakeBitrixPortal, action) -> Any:
+        portal.rest_calls = 0
+        portal.limit_errors = 0
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            result = action()
+            wall_time = time.perf_counter() - started
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        metrics = {
+            'wall_time': round(wall_time, 3),
+            'rest_calls': portal.rest_calls,
+            'peak_memory_kb': peak_memory // 1024,
+        }
+        self.measured[case] = metrics
+        self._check_against_baseline(case, metrics, portal.limit_errors)
+        return result
+
+    def _check_against_baseline(self, case: str, metrics: Dict[str, float], limit_errors: int) -> None:
+        baseline = self.baseline.get(case)
+        if baseline is None or BENCHMARK_UPDATE_BASELINE:
+            return
+        message = f'{case}: регрессия относительно {BENCHMARK_BASELINE_PATH.name} ({baseline}), сейчас {metrics}'
+        # каждый отвергнутый порталом запрос тоже попадает в rest_calls, они не считаются регрессией
+        self.assertLessEqual(metrics['rest_calls'] - limit_errors, baseline['rest_calls'], message)
+        self.assertLessEqual(metrics['wall_time'], baseline['wall_time'] * (1 + BENCHMARK_TOLERANCE) + 0.5, message)
+        self.assertLessEqual(
+            metrics['peak_memory_kb'], baseline['peak_memory_kb'] * (1 + BENCHMARK_TOLERANCE) + 1024, message)
+
+    def _post(self, path: str, data: Dict[str, Any], token: FakeBitrixUserToken):
+        request = self.factory.post(path, data)
+        request.bitrix_user_token = token
+        request.bitrix_user = token.user
+        return request
+
+    def _get(self, path: str, token: FakeBitrixUserToken):
+        request = self.factory.get(path)
+        request.bitrix_user_token = token
+        request.bitrix_user = token.user
+        return request
+
+    def test_export_benchmark(self):
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=size)
+                    token = FakeBitrixUserToken(portal)
+                    request = self._post('/export_contacts/', {'exporter_format': file_format}, token)
+
+                    def export():
+                        response = self.views.export_contacts(request)
+                        self.assertEqual(response.status_code, 200, getattr(response, 'content', b'')[:500])
+                        return b''.join(response.streaming_content)
+
+                    content = self._measure(f'export_{file_format}_{size}', portal, export)
+                    if file_format == 'csv':
+                        self.assertEqual(len(content.decode('utf-16').splitlines()), size + 1)
+
+    def test_async_export_benchmark(self):
+        """export_contacts_async под asgi: страницы bitrix приходят через httpx, файл отдаётся асинхронно"""
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=size)
+                    token = FakeBitrixUserToken(portal)
+                    request = self._post('/export_contacts/', {'exporter_format': file_format}, token)
+
+                    @async_to_sync
+                    async def export():
+                        response = await self.views.export_contacts_async(request)
+                        self.assertEqual(response.status_code, 200, getattr(response, 'content', b'')[:500])
+                        if response.is_async:
+                            return b''.join([chunk async for chunk in response.streaming_content])
+                        return b''.join(response.streaming_content)
+
+                    content = self._measure(f'export_async_{file_format}_{size}', portal, export)
+                    if file_format == 'csv':
+                        self.assertEqual(len(content.decode('utf-16').splitlines()), size + 1)
+
+    def test_repeated_export_benchmark(self):
+        """повторный экспорт неизменившегося портала отдаётся из кэша, а GET с ETag - ответом 304"""
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=size)
+                    token = FakeBitrixUserToken(portal)
+                    first = self.views.export_contacts(
+                        self._post('/export_contacts/', {'exporter_format': file_format}, token))
+                    first_content = b''.join(first.streaming_content)
+
+                    def export():
+                        response = self.views.export_contacts(
+                            self._post('/export_contacts/', {'exporter_format': file_format}, token))
+                        self.assertEqual(response.status_code, 200)
+                        self.assertEqual(response['ETag'], first['ETag'])
+                        return b''.join(response.streaming_content)
+
+                    content = self._measure(f'export_cached_{file_format}_{size}', portal, export)
+                    self.assertEqual(content, first_content)
+
+                    # 304 бывает только у GET-адреса, на который ссылается ответ на POST
+                    self.assertTrue(first['Content-Location'].startswith('/export_contacts/download/?'))
+                    request = self._get(first['Content-Location'], token)
+                    request.META['HTTP_IF_NONE_MATCH'] = first['ETag']
+                    self.assertEqual(self.views.export_contacts_download(request).status_code, 304)
+                    request = self._post('/export_contacts/', {'exporter_format': file_format}, token)
+                    request.META['HTTP_IF_NONE_MATCH'] = first['ETag']
+                    cached = self.views.export_contacts(request)
+                    self.assertEqual(cached.status_code, 200)
+                    cached.close()
+
+                    # изменение контакта меняет отметку зеркала, а с ней ключ кэша
+                    portal.contacts[1].update(NAME='Изменённый', DATE_MODIFY='2030-01-01T00:00:00+03:00')
+                    changed = self.views.export_contacts(request)
+                    self.assertEqual(changed.status_code, 200)
+                    self.assertNotEqual(changed['ETag'], first['ETag'])
+                    b''.join(changed.streaming_content)
+
+    def test_streaming_memory_under_wsgi_and_asgi(self):
+        """ответ экспорта отдаётся по кускам под обоими обработчиками: wsgi читает его синхронно,
+        asgi - через async for, как ASGIHandler.send_response; в памяти не должно оказаться всего файла"""
+        for file_format in BENCHMARK_FORMATS:
+            with self.subTest(file_format=file_format):
+                self._reset_state()
+                portal = FakeBitrixPortal(contacts_count=STREAMING_MEMORY_CONTACTS)
+                # без зеркала: строки идут страницами crm.contact.list, а не кусками из базы
+                portal.is_admin = False
+                token = FakeBitrixUserToken(portal)
+                request = self._post('/export_contacts/', {'exporter_format': file_format}, token)
+                with warnings.catch_warnings():
+                    # django предупреждает, когда собирает потоковый ответ в памяти целиком
+                    warnings.filterwarnings('error', message='StreamingHttpResponse must consume')
+                    response = self.views.export_contacts(request)
+                    wsgi_size, wsgi_peak = _consume_with_peak_memory(lambda: sum(len(chunk) for chunk in response))
+                    response.close()
+
+                    # под asgi файл собирается заново: xlsx приходит из потока, csv - страницами httpx
+                    shutil.rmtree(export_cache.EXPORT_CACHE_DIR, ignore_errors=True)
+                    handler = async_streaming_middleware(self.views.export_contacts_async)
+
+                    @async_to_sync
+                    async def serve_asgi():
+                        asgi_response = await handler(request)
+                        try:
+                            return await _aconsume_with_peak_memory(asgi_response)
+                        finally:
+                            await sync_to_async(asgi_response.close)()
+
+                    asgi_size, asgi_peak = serve_asgi()
+                # собранный в памяти ответ занял бы не меньше самого файла
+                self.assertLess(wsgi_peak, wsgi_size)
+                self.assertLess(asgi_peak, asgi_size)
+
+    def test_import_benchmark(self):
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=0)
+                    token = FakeBitrixUserToken(portal)
+                    request = self._post(
+                        '/import_contacts/', {'contacts_file': _build_import_file(size, file_format)}, token)
+
+                    def import_file():
+                        response = self.views.import_contacts(request)
+                        self.assertEqual(response.status_code, 302, getattr(response, 'content', b'')[:500])
+                        return response
+
+                    self._measure(f'import_{file_format}_{size}', portal, import_file)
+                    self.assertEqual(len(portal.contacts), size)
+
+    def test_async_import_benchmark(self):
+        """import_contacts_async под asgi: индекс дубликатов и chunk-и уходят в bitrix через httpx"""
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=0)
+                    token = FakeBitrixUserToken(portal)
+                    request = self._post(
+                        '/import_contacts/', {'contacts_file': _build_import_file(size, file_format)}, token)
+
+                    @async_to_sync
+                    async def import_file():
+                        response = await self.views.import_contacts_async(request)
+                        self.assertEqual(response.status_code, 302, getattr(response, 'content', b'')[:500])
+                        return response
+
+                    self._measure(f'import_async_{file_format}_{size}', portal, import_file)
+                    self.assertEqual(len(portal.contacts), size)
+                    # телефоны и почты прошли через строку запроса batch-а без потерь
+                    self.assertEqual(portal.contacts[1]['PHONE'][0]['VALUE'], '+79110000000')
+
+    def test_upsert_import_benchmark(self):
+        """повторная загрузка выгрузки портала с 1% изменений: обновляются только изменившиеся контакты"""
+        changed_every = 100
+        for size in BENCHMARK_SIZES:
+            for file_format in BENCHMARK_FORMATS:
+                with self.subTest(size=size, file_format=file_format):
+                    self._reset_state()
+                    portal = FakeBitrixPortal(contacts_count=size)
+                    token = FakeBitrixUserToken(portal)
+                    request = self._post('/import_contacts/', {
+                        'contacts_file': _build_upsert_file(portal, file_format, changed_every),
+                        'import_mode': 'upsert',
+                    }, token)
+
+                    def import_file():
+                        response = self.views.import_contacts(request)
+                        self.assertEqual(response.status_code, 302, getattr(response, 'content', b'')[:500])
+                        return response
+
+                    self._measure(f'import_upsert_{file_format}_{size}', portal, import_file)
+                    changed = {str(index) for index in range(changed_every, size + 1, changed_every)}
+                    self.assertEqual(len(portal.contacts), size)
+                    self.assertEqual(portal.updated_contacts, changed)
+                    contact = portal.contacts[changed_every]
+                    self.assertEqual(contact['LAST_NAME'], f'Изменённая{changed_every}')
+                    self.assertEqual(len(contact['PHONE']), 1)
+
+
+class FakePortalTestCase(SimpleTestCase):
+    """юнит-тесты на заглушке портала: без задержки ответа и без лимита запросов"""
+
+    def setUp(self):
+        super().setUp()
+        batch_scheduler._limiters[FAKE_PORTAL_ID] = batch_scheduler.PortalRateLimiter(rate=1000.0, burst=1000)
+        self.addCleanup(batch_scheduler._limiters.pop, FAKE_PORTAL_ID, None)
+        company_directory._directories.clear()
+        self.addCleanup(company_directory._directories.clear)
+        for cache in (contact_mirror._admin_users, contact_mirror._counted_at):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def make_token(self, contacts_count: int = 0, companies_count: int = 10) -> FakeBitrixUserToken:
+        portal = FakeBitrixPortal(
+            contacts_count=contacts_count, companies_count=companies_count, latency=0, rate_limit=1000.0, rate_burst=1000)
+        return FakeBitrixUserToken(portal)
+
+
+class CompanyDirectoryTests(FakePortalTestCase):
+
+    def test_empty_portal_is_cached(self):
+        token = self.make_token(companies_count=0)
+        directory = company_directory.CompanyDirectory()
+        directory.refresh(token, now=1000.0)
+        directory.refresh(token, now=1001.0)
+        self.assertEqual(token.portal.rest_calls, 1)
+        # после интервала синхронизации пустой портал перечитывается одним запросом
+        directory.refresh(token, now=1000.0 + company_directory.COMPANY_DIRECTORY_REFRESH_INTERVAL)
+        self.assertEqual(token.portal.rest_calls, 2)
+
+    def test_delta_refresh_picks_up_new_company(self):
+        token = self.make_token(companies_count=3)
+        directory = company_directory.CompanyDirectory()
+        directory.refresh(token, now=1000.0)
+        token.portal.companies[4] = {'ID': '4', 'TITLE': 'ООО "Новая"', 'DATE_MODIFY': '2030-01-01T00:00:00+03:00'}
+        directory.refresh(token, now=1000.0 + company_directory.COMPANY_DIRECTORY_REFRESH_INTERVAL)
+        self.assertEqual(directory.title_by_id('4'), 'ООО "Новая"')
+        self.assertEqual(directory.last_modified, '2030-01-01T00:00:00+03:00')
+
+
+class ContactMirrorTests(FakePortalTestCase, TestCase):
+
+    def test_restricted_user_does_not_use_mirror(self):
+        token = self.make_token(contacts_count=5)
+        self.assertTrue(contact_mirror.export_uses_mirror(token, ExportOptions()))
+        contact_mirror.sync_contact_mirror(token)
+        token.portal.is_admin = False
+        restricted = FakeBitrixUserToken(token.portal)
+        restricted.user_id = FAKE_USER_ID + 1
+        # зеркало администратора есть, но пользователю с ограниченными правами оно не отдаётся
+        self.assertFalse(contact_mirror.export_uses_mirror(restricted, ExportOptions()))
+
+    def test_deleted_contact_leaves_mirror_after_count_check(self):
+        token = self.make_token(contacts_count=5)
+        contact_mirror.sync_contact_mirror(token)
+        del token.portal.contacts[3]
+        contact_mirror.sync_contact_mirror(token)
+        # проверка числа контактов идёт не чаще раза в интервал, сразу после полной загрузки - нет
+        self.assertEqual(MirroredContact.objects.filter(bitrix_portal_id=FAKE_PORTAL_ID).count(), 5)
+
+        contact_mirror._counted_at.clear()
+        contact_mirror.sync_contact_mirror(token)
+        self.assertFalse(MirroredContact.objects.filter(bitrix_portal_id=FAKE_PORTAL_ID, bitrix_id=3).exists())
+        self.assertEqual(MirroredContact.objects.filter(bitrix_portal_id=FAKE_PORTAL_ID).count(), 4)
+
+    def test_mirror_and_rest_filter_dates_by_same_day_bounds(self):
+        # контакты созданы около полуночи по москве: 2024-01-02 01:00+03:00 - это ещё 1 января по UTC
+        token = self.make_token(contacts_count=30)
+        contact_mirror.sync_contact_mirror(token)
+        options = ExportOptions(ExportFilter(
+            date_create_from=datetime.date(2024, 1, 2), date_create_to=datetime.date(2024, 1, 5)))
+        rest_ids = {row['ID'] for row in contact_source.iter_export_contacts(token, {}, options=options)}
+        mirror_ids = {row['ID'] for row in contact_mirror.iter_mirror_export_contacts(FAKE_PORTAL_ID, {}, options=options)}
+        self.assertTrue(rest_ids)
+        self.assertEqual(rest_ids, mirror_ids)
+
+
+class ExportCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.mkdtemp(prefix='contact_export_cache_')
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        patcher = mock.patch.object(export_cache, 'EXPORT_CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_key_depends_on_user(self):
+        # bitrix отбирает контакты по правам пользователя, файлы разных пользователей не смешиваются
+        options = ExportOptions()
+        self.assertNotEqual(
+            export_cache.export_cache_key(FAKE_PORTAL_ID, 1, 'csv', options, 'w'),
+            export_cache.export_cache_key(FAKE_PORTAL_ID, 2, 'csv', options, 'w'))
+
+    def test_etag_matches(self):
+        self.assertTrue(export_cache.etag_matches('"a", W/"b"', '"b"'))
+        self.assertFalse(export_cache.etag_matches('"a"', '"b"'))
+        self.assertFalse(export_cache.etag_matches('*', '"b"'))
+        self.assertFalse(export_cache.etag_matches(None, '"b"'))
+
+    def test_interrupted_export_is_not_cached(self):
+        chunks = export_cache.cache_streaming_export('key', iter([b'a', b'b']))
+        self.assertEqual(next(chunks), b'a')
+        chunks.close()
+        self.assertIsNone(export_cache.open_cached_export('key'))
+        self.assertEqual(os.listdir(export_cache.EXPORT_CACHE_DIR), [])
+
+        self.assertEqual(b''.join(export_cache.cache_streaming_export('key', iter([b'a', b'b']))), b'ab')
+        with export_cache.open_cached_export('key') as cached_file:
+            self.assertEqual(cached_file.read(), b'ab')
+
+    def test_eviction_removes_least_recently_served(self):
+        for index, key in enumerate(['old', 'served', 'new']):
+            b''.join(export_cache.cache_streaming_export(key, iter([b'x' * 10])))
+            os.utime(os.path.join(export_cache.EXPORT_CACHE_DIR, key), (1000 + index, 1000 + index))
+        # отдача файла делает его самым свежим
+        export_cache.open_cached_export('served').close()
+        self.assertEqual(export_cache.evict_export_cache(max_bytes=20), 1)
+        self.assertEqual(sorted(os.listdir(export_cache.EXPORT_CACHE_DIR)), ['new', 'served'])
+
+
+class _StoredAuthToken:
+    """экземпляр токена, загруженный из "базы" row: как у BitrixUserToken, экземпляров одной строки может быть много"""
+
+    def __init__(self, row: Dict[str, Any], refresh=None):
+        self.row = row
+        self.pk = self.user_id = row['user_id']
+        self.refresh_from_db()
+        self._refresh = refresh
+
+    def refresh_from_db(self):
+        self.auth_token_date = self.row['auth_token_date']
+        self.auth_token = f'token-{self.row["refresh_calls"]}'
+
+    def refresh(self):
+        self.row['refresh_calls'] += 1
+        if self._refresh is not None:
+            self._refresh()
+        self.row['auth_token_date'] = timezone.now()
+        self.refresh_from_db()
+        return True
+
+
+class AuthCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        auth_cache.auth_cache.clear()
+        self.addCleanup(auth_cache.auth_cache.clear)
+
+    def _expired_row(self) -> Dict[str, Any]:
+        return {
+            'user_id': FAKE_USER_ID,
+            'auth_token_date': timezone.now() - datetime.timedelta(seconds=auth_cache.BITRIX_TOKEN_LIFETIME + 1),
+            'refresh_calls': 0,
+        }
+
+    def test_entry_expires_after_ttl(self):
+        cache = auth_cache.AuthCache(ttl=60)
+        cache.put('key', {'bitrix_user_token': 'token'}, now=1000.0)
+        self.assertEqual(cache.get('key', now=1059.0), {'bitrix_user_token': 'token'})
+        self.assertIsNone(cache.get('key', now=1060.0))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = auth_cache.AuthCache(max_entries=2)
+        cache.put('first', {}, now=1000.0)
+        cache.put('second', {}, now=1000.0)
+        cache.get('first', now=1001.0)
+        cache.put('third', {}, now=1002.0)
+        self.assertIsNone(cache.get('second', now=1003.0))
+        self.assertIsNotNone(cache.get('first', now=1003.0))
+
+    def test_copies_of_one_user_token_refresh_once(self):
+        row = self._expired_row()
+        release = threading.Event()
+        refreshing = _StoredAuthToken(row, refresh=lambda: release.wait(5))
+        # тот же пользователь под другими cookie: отдельный экземпляр токена в отдельной записи кэша
+        other = _StoredAuthToken(row)
+        auth_cache.auth_cache.put('first cookie', {'bitrix_user_token': refreshing})
+        auth_cache.auth_cache.put('other cookie', {'bitrix_user_token': other})
+
+        refresher = auth_cache._TokenRefresher()
+        thread = threading.Thread(target=refresher.ensure_fresh, args=[refreshing])
+        thread.start()
+        while not refresher._in_flight:
+            time.sleep(0.001)
+        waiter = threading.Thread(target=refresher.ensure_fresh, args=[other])
+        waiter.start()
+        release.set()
+        thread.join()
+        waiter.join()
+
+        self.assertEqual(row['refresh_calls'], 1)
+        # дождавшийся запрос получил новый токен, а запись со старым экземпляром вытеснена
+        self.assertEqual(other.auth_token_date, row['auth_token_date'])
+        self.assertIsNone(auth_cache.auth_cache.get('other cookie'))
+        self.assertIsNotNone(auth_cache.auth_cache.get('first cookie'))
+
+    def test_hung_refresh_does_not_block_waiters(self):
+        row = self._expired_row()
+        release = threading.Event()
+        refresher = auth_cache._TokenRefresher()
+        thread = threading.Thread(
+            target=refresher.ensure_fresh, args=[_StoredAuthToken(row, refresh=lambda: release.wait(5))])
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        while not refresher._in_flight:
+            time.sleep(0.001)
+        with mock.patch.object(auth_cache, 'BITRIX_TOKEN_REFRESH_WAIT', 0.01), \
+                self.assertLogs(auth_cache.logger, 'WARNING'):
+            refresher.ensure_fresh(_StoredAuthToken(row))
+        self.assertEqual(row['refresh_calls'], 1)
+
+
+class AsyncBitrixTests(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        async_bitrix._portal_domains.clear()
+        self.addCleanup(async_bitrix._portal_domains.clear)
+
+    def test_client_is_closed_with_its_loop(self):
+        async def get_client():
+            return async_bitrix.get_async_client()
+
+        # async_to_sync без цикла событий создаёт цикл на один вызов, клиент не должен его пережить
+        client = async_to_sync(get_client)()
+        self.assertTrue(client.is_closed)
+
+    def test_portal_domains_are_capped(self):
+        with mock.patch.object(async_bitrix, 'ASYNC_PORTAL_DOMAINS_MAX', 2), \
+                mock.patch.object(async_bitrix, 'get_portal_id', lambda portal_id: portal_id), \
+                mock.patch.object(async_bitrix, 'get_portal_domain', lambda portal_id: f'{portal_id}.bitrix24.ru'):
+            for portal_id in [1, 2, 1, 3]:
+                async_to_sync(async_bitrix._get_domain)(portal_id)
+        self.assertEqual(list(async_bitrix._portal_domains), [1, 3])
+
+    def test_expired_token_is_refreshed_once_per_user(self):
+        # по времени токен действует, но bitrix уже ответил expired_token всем трём запросам пользователя
+        row = {'user_id': FAKE_USER_ID, 'auth_token_date': timezone.now(), 'refresh_calls': 0}
+        tokens = [_StoredAuthToken(row) for _ in range(3)]
+
+        def handle(request):
+            if request.url.params['auth'] == 'token-0':
+                return httpx.Response(401, json={'error': 'expired_token', 'error_description': 'expired'})
+            return httpx.Response(200, json={'result': True})
+
+        async def post_all():
+            return await asyncio.gather(*(async_bitrix._post(token, 'profile', {}) for token in tokens))
+
+        with mock.patch.object(async_bitrix, '_create_client', lambda: httpx.AsyncClient(
+                transport=httpx.MockTransport(handle))), \
+                mock.patch.object(async_bitrix, '_get_domain', mock.AsyncMock(return_value=FAKE_PORTAL_DOMAIN)):
+            responses = async_to_sync(post_all)()
+        self.assertEqual(responses, [{'result': True}] * 3)
+        self.assertEqual(row['refresh_calls'], 1)
+
+    def test_query_encodes_flags_as_y_n(self):
+        self.assertEqual(
+            async_bitrix.http_build_query({'fields': {'OPENED': True, 'EXPORT': False, 'NAME': None}}),
+            ['fields[OPENED]=Y', 'fields[EXPORT]=N'])
+
+
+class ExporterTests(FakePortalTestCase):
+    """файлы экспортеров разбираются обратно и сверяются со строками синтетического портала"""
+
+    def export_rows(self, contacts_count: int = 120) -> List[Dict[str, Any]]:
+        # больше rows_per_chunk: файл собирается из нескольких кусков
+        portal = self.make_token(contacts_count).portal
+        company_dict = {company['ID']: company['TITLE'] for company in portal.companies.values()}
+        return [prepare_export_row(contact, company_dict) for contact in portal.contacts.values()]
+
+    def export_content(self, exporter, rows: List[Dict[str, Any]]) -> bytes:
+        response = exporter.export(rows)
+        try:
+            return b''.join(response.streaming_content)
+        finally:
+            response.close()
+
+    @staticmethod
+    def expected_records(rows: List[Dict[str, Any]]) -> List[List[str]]:
+        return [EXPORT_HEADERS] + [[row[key] for key in ('NAME', 'LAST_NAME', 'PHONE', 'EMAIL', 'COMPANY')] for row in rows]
+
+    def test_csv_has_one_bom_and_every_row(self):
+        rows = self.export_rows()
+        exporter = ExporterFactory.get_exporter('csv')
+        content = self.export_content(exporter, rows)
+        self.assertTrue(content.startswith(codecs.BOM_UTF16))
+        text = content.decode('utf-16')
+        # первый BOM decode снимает, любой следующий остался бы в тексте
+        self.assertNotIn('\ufeff', text)
+        self.assertEqual(list(csv.reader(io.StringIO(text, newline=''))), self.expected_records(rows))
+
+        async def aexport():
+            async def pages():
+                for start in range(0, len(rows), FAKE_BITRIX_PAGE_SIZE):
+                    yield rows[start:start + FAKE_BITRIX_PAGE_SIZE]
+            return b''.join([chunk async for chunk in exporter.aexport(pages()).streaming_content])
+
+        # асинхронная отдача собирает тот же файл
+        self.assertEqual(async_to_sync(aexport)(), content)
+
+    def test_xlsx_is_written_once_with_column_widths(self):
+        rows = self.export_rows()
+        # длиннее предельной ширины колонки
+        rows[0]['COMPANY'] = 'Компания' * 10
+        exporter = ExporterFactory.get_exporter('xlsx')
+        with mock.patch.object(exorter_module.openpyxl, 'Workbook', wraps=openpyxl.Workbook) as workbook_class:
+            content = self.export_content(exporter, rows)
+        workbook_class.assert_called_once_with(write_only=True)
+
+        sheet = openpyxl.load_workbook(io.BytesIO(content))['Контакты']
+        records = [[value or '' for value in row] for row in sheet.iter_rows(values_only=True)]
+        expected = self.expected_records(rows)
+        self.assertEqual(records, expected)
+        for index, column in enumerate(zip(*expected), 1):
+            width = min(max(len(value) for value in column) + 2, exporter.max_column_width)
+            self.assertEqual(sheet.column_dimensions[get_column_letter(index)].width, width)
+        self.assertEqual(sheet.column_dimensions['E'].width, exporter.max_column_width)
+
+    def test_gzip_csv_decompresses_to_every_row(self):
+        rows = self.export_rows()
+        content = gzip.decompress(self.export_content(ExporterFactory.get_exporter('csv.gz'), rows))
+        self.assertTrue(content.startswith(codecs.BOM_UTF8))
+        text = content.decode('utf-8-sig')
+        self.assertNotIn('\ufeff', text)
+        self.assertEqual(list(csv.reader(io.StringIO(text, newline=''))), self.expected_records(rows))
+
+    def test_ndjson_has_one_record_per_contact(self):
+        rows = self.export_rows()
+        lines = self.export_content(ExporterFactory.get_exporter('ndjson'), rows).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), len(rows))
+        self.assertEqual(json.loads(lines[0]), {
+            'id': 1, 'name': 'Имя1', 'last_name': 'Фамилия1', 'phone': '+79000000001',
+            'email': 'contact1@example.com', 'company': 'ООО "Компания 2"',
+        })
+        # контакт без компании - null, а не пустая строка
+        self.assertIsNone(json.loads(lines[2])['company'])
+
+    # pyarrow - необязательная зависимость, нужная только parquet
+    @skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow не установлен')
+    def test_parquet_schema_and_row_groups(self):
+        pyarrow = importlib.import_module('pyarrow')
+        parquet = importlib.import_module('pyarrow.parquet')
+        rows = self.export_rows()
+        exporter = ExporterFactory.get_exporter('parquet')
+        exporter.row_group_size = 50
+        parquet_file = parquet.ParquetFile(io.BytesIO(self.export_content(exporter, rows)))
+        self.assertEqual(parquet_file.schema_arrow, pyarrow.schema(
+            [('id', pyarrow.int64())] + [(key, pyarrow.string()) for key in exporter.record_keys[1:]]))
+        self.assertEqual(
+            [parquet_file.metadata.row_group(index).num_rows for index in range(parquet_file.num_row_groups)],
+            [50, 50, 20])
+        records = parquet_file.read().to_pylist()
+        self.assertEqual([record['id'] for record in records], list(range(1, len(rows) + 1)))
+        self.assertEqual(records[0]['company'], 'ООО "Компания 2"')
+
+    def test_file_exporter_names_file_by_format(self):
+        response = ExporterFactory.get_exporter('xlsx').export([{'ID': '1', 'NAME': 'Иван'}])
+        self.assertIn('contact_export.xlsx', response['Content-Disposition'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+        response.close()
+
+
+class ImportJobResumeTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(import_jobs._executor, 'submit')
+        self.submit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_job(self, status: str, locked_until) -> ImportJob:
+        return ImportJob.objects.create(
+            bitrix_portal_id=FAKE_PORTAL_ID, bitrix_user_id=FAKE_USER_ID, original_name='contacts.csv',
+            status=status, lease_owner='old', locked_until=locked_until)
+
+    def test_running_job_with_live_lease_is_not_resumed(self):
+        job = self.make_job(ImportJob.STATUS_RUNNING, timezone.now() + import_jobs.IMPORT_JOB_LEASE)
+        self.assertFalse(import_jobs.can_resume_import_job(job))
+        self.assertFalse(import_jobs.resume_import_job(None, job))
+        self.submit.assert_not_called()
+
+    def test_expired_lease_is_resumed_once(self):
+        job = self.make_job(ImportJob.STATUS_RUNNING, timezone.now() - import_jobs.IMPORT_JOB_LEASE)
+        self.assertTrue(import_jobs.can_resume_import_job(job))
+        self.assertTrue(import_jobs.resume_import_job(None, job))
+        # второй повтор видит свежую аренду первого
+        self.assertFalse(import_jobs.resume_import_job(None, job))
+        self.assertEqual(self.submit.call_count, 1)
+        job.refresh_from_db()
+        self.assertNotEqual(job.lease_owner, 'old')
+        self.assertEqual(job.status, ImportJob.STATUS_PENDING)
+
+    def test_heartbeat_renews_lease_until_it_is_taken_over(self):
+        job = self.make_job(ImportJob.STATUS_RUNNING, timezone.now())
+        heartbeat = import_jobs._ImportJobLeaseHeartbeat(job.id, 'old')
+        self.assertTrue(heartbeat.renew())
+        job.refresh_from_db()
+        self.assertGreater(job.locked_until, timezone.now() + import_jobs.IMPORT_JOB_LEASE / 2)
+        heartbeat.check()
+
+        # задачу перезапустил другой процесс
+        ImportJob.objects.filter(id=job.id).update(lease_owner='new')
+        self.assertFalse(heartbeat.renew())
+        with self.assertRaises(import_jobs.ImportJobLeaseLost):
+            heartbeat.check()
+
+    def test_stale_run_does_not_touch_resumed_job(self):
+        job = self.make_job(ImportJob.STATUS_FAILED, None)
+        import_jobs.resume_import_job(None, job)
+        # соединение с базой теста закрывать нельзя
+        with mock.patch.object(import_jobs, 'close_old_connections'):
+            import_jobs.run_import_job(job.id, FakeBitrixUserToken(FakeBitrixPortal(latency=0)), 'old')
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.STATUS_PENDING)
+
+
+class ImportJournalTests(FakePortalTestCase, TransactionTestCase):
+    """журнал пишет отдельный поток импорта, поэтому записи должны быть видны вне транзакции теста"""
+
+    def test_resume_resends_only_failed_rows(self):
+        token = self.make_token()
+        token.portal.contacts.clear()
+        headers = ['имя', 'фамилия', 'номер телефона', 'почта', 'компания']
+        rows = [[f'Имя{i}', 'Фамилия', f'+7911{i:07d}', '', ''] for i in range(5)]
+        journal = import_journal.ImportJournal(FAKE_PORTAL_ID, 'a' * 64)
+        pipeline = ImportPipeline(
+            token, ContactDuplicateIndex(), CompanyResolver(company_directory.CompanyDirectory()),
+            chunk_size=3, journal=journal)
+        record_chunk = pipeline._record_chunk
+
+        def reject_second_row(chunk_index, rows, methods, results, row_indexes):
+            # bitrix не принял строку 1 первого chunk-а: контакта в портале нет, в ответе ошибка
+            rejected_id = results['contact_0_1']['result'] if chunk_index == 0 else None
+            token.portal.contacts.pop(rejected_id, None)
+            results = dict(results, contact_0_1={'result': None, 'error': 'ERROR_CORE', 'error_description': 'ошибка'})
+            return record_chunk(chunk_index, rows, methods, results, row_indexes)
+
+        pipeline._record_chunk = reject_second_row
+        result = pipeline.run(iter_normalized_contacts(headers, rows))
+        self.assertEqual((result.success_count, len(result.failed_rows)), (4, 1))
+        entry = ImportBatchJournal.objects.get(chunk_index=0)
+        self.assertEqual((len(entry.contact_ids), entry.failed_rows), (2, [1]))
+
+        # повтор по журналу отправляет только непринятую строку
+        sent_rows = []
+        pipeline = ImportPipeline(
+            token, ContactDuplicateIndex.build(token), CompanyResolver(company_directory.CompanyDirectory()),
+            chunk_size=3, journal=import_journal.ImportJournal(FAKE_PORTAL_ID, 'a' * 64))
+        chunk_commands = pipeline._chunk_commands
+
+        def record_rows(chunk_index, rows, company_ids):
+            sent_rows.extend(row['NAME'] for row in rows)
+            return chunk_commands(chunk_index, rows, company_ids)
+
+        pipeline._chunk_commands = record_rows
+        result = pipeline.run(iter_normalized_contacts(headers, rows))
+        self.assertEqual(sent_rows, ['Имя1'])
+        self.assertEqual((result.resumed_count, result.success_count), (4, 1))
+        self.assertEqual(len(token.portal.contacts), 5)
+        entry.refresh_from_db()
+        self.assertEqual((len(entry.contact_ids), entry.failed_rows), (3, []))
+
+    def test_expired_chunks_are_forgotten(self):
+        ImportBatchJournal.objects.create(bitrix_portal_id=FAKE_PORTAL_ID, file_hash='a' * 64, chunk_index=0)
+        ImportBatchJournal.objects.update(created_at=timezone.now() - import_journal.IMPORT_JOURNAL_TTL)
+        journal = import_journal.ImportJournal(FAKE_PORTAL_ID, 'a' * 64)
+        self.assertIsNone(journal.pending_rows(0))
+        self.assertFalse(ImportBatchJournal.objects.exists())
+
+
+class _ScriptedBatchToken:
+    """токен, batch_api_call которого по очереди отдаёт заготовленные ответы или исключения"""
+
+    def __init__(self, *responses):
+        self.user = SimpleNamespace(portal_id=FAKE_PORTAL_ID)
+        self.responses = list(responses)
+        self.sent = []
+
+    def batch_api_call(self, methods, halt: int = 0, chunk_size: int = 50, timeout: int = 60):
+        self.sent.append([name for name, _, _ in methods])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class BatchRetryTests(FakePortalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.retry_delay = batch_scheduler.retry_delay
+        patcher = mock.patch.object(batch_scheduler, 'retry_delay', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_write_batch_is_not_resent_after_timeout(self):
+        token = _ScriptedBatchToken(requests.ReadTimeout('read timed out'))
+        with self.assertRaises(requests.ReadTimeout):
+            batch_scheduler.run_batch(token, [('crm.contact.add', {'fields': {}})])
+        self.assertEqual(len(token.sent), 1)
+
+    def test_read_batch_is_resent_after_timeout(self):
+        token = _ScriptedBatchToken(requests.ReadTimeout('read timed out'), {'cmd_0': {'result': [], 'error': None}})
+        results = batch_scheduler.run_batch(token, [('crm.contact.list', {})])
+        self.assertEqual(results, {'cmd_0': {'result': [], 'error': None}})
+        self.assertEqual(len(token.sent), 2)
+
+    def test_rejected_write_batch_is_resent(self):
+        limit_error = FakeBitrixApiError('QUERY_LIMIT_EXCEEDED', 'Too many requests', status_code=503)
+        token = _ScriptedBatchToken(limit_error, {'cmd_0': {'result': 1, 'error': None}})
+        self.assertEqual(batch_scheduler.run_batch(token, [('crm.contact.add', {})])['cmd_0']['result'], 1)
+
+    def test_only_rejected_commands_are_resent(self):
+        token = _ScriptedBatchToken(
+            {
+                'a': {'result': 1, 'error': None},
+                'b': {'result': None, 'error': 'QUERY_LIMIT_EXCEEDED'},
+                'c': {'result': None, 'error': 'INTERNAL_SERVER_ERROR'},
+            },
+            {'b': {'result': 2, 'error': None}},
+        )
+        results = batch_scheduler.run_batch(
+            token, [('a', 'crm.contact.add', {}), ('b', 'crm.contact.add', {}), ('c', 'crm.contact.add', {})])
+        # INTERNAL_SERVER_ERROR у записи могла прийти после выполнения команды - она не повторяется
+        self.assertEqual(token.sent, [['a', 'b', 'c'], ['b']])
+        self.assertEqual(results['b']['result'], 2)
+        self.assertEqual(results['c']['error'], 'INTERNAL_SERVER_ERROR')
+
+    def test_retry_delay_has_full_jitter_and_cap(self):
+        with mock.patch.object(batch_scheduler.random, 'uniform', side_effect=lambda low, high: (low, high)):
+            bounds = [self.retry_delay(attempt) for attempt in range(1, 10)]
+        self.assertEqual(bounds[0], (0, batch_scheduler.BATCH_RETRY_BASE_DELAY))
+        self.assertEqual(bounds[2], (0, batch_scheduler.BATCH_RETRY_BASE_DELAY * 4))
+        self.assertEqual(bounds[-1], (0, batch_scheduler.BATCH_RETRY_MAX_DELAY))
+
+    def test_rate_never_grows_above_configured_limit(self):
+        limiter = batch_scheduler.PortalRateLimiter(rate=2.0)
+        limiter.on_limit_exceeded()
+        self.assertEqual(limiter.rate, 1.0)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 2.0)
+
+    def test_run_batches_keeps_command_order(self):
+        token = self.make_token()
+        methods = [(f'company_{index}', 'crm.company.add', {'fields': {'TITLE': str(index)}}) for index in range(120)]
+        results = batch_scheduler.run_batches(token, methods, chunk_size=10, max_workers=3)
+        self.assertEqual(list(results), [name for name, _, _ in methods])
+        self.assertEqual(len(token.portal.companies), 130)
+
+
+def _directory_with(*titles: str) -> company_directory.CompanyDirectory:
+    directory = company_directory.CompanyDirectory()
+    for company_id, title in enumerate(titles, 1):
+        directory.add(str(company_id), title)
+    return directory
+
+
+class ExportOptionsTests(SimpleTestCase):
+
+    @override_settings(TIME_ZONE='Europe/Moscow')
+    def test_bitrix_filter_includes_whole_last_day(self):
+        export_filter = ExportFilter(
+            date_create_from=datetime.date(2024, 1, 1), date_create_to=datetime.date(2024, 1, 31), has_email=False)
+        self.assertEqual(export_filter.to_bitrix_filter(), {
+            '>=DATE_CREATE': '2024-01-01T00:00:00+03:00',
+            '<DATE_CREATE': '2024-02-01T00:00:00+03:00',
+            'HAS_EMAIL': 'N',
+        })
+
+    def test_from_request_finds_renamed_company_by_normalized_name(self):
+        directory = _directory_with('ООО "Лютик"', 'ООО "Ромашка"')
+        directory.add('2', 'ИП "Василёк"')
+        self.assertEqual(directory.id_by_name('василёк'), '2')
+        with self.assertRaises(ValueError):
+            ExportOptions.from_request(QueryDict('company=ромашка'), directory)
+
+    def test_from_request_finds_company_without_legal_form(self):
+        data = QueryDict('company=ромашка&fields=NAME&fields=PHONE&multifield_limit=2&has_phone=Y')
+        options = ExportOptions.from_request(data, _directory_with('ООО "Лютик"', 'ООО "Ромашка"'))
+        self.assertEqual(options.filter.company_id, '2')
+        self.assertTrue(options.filter.has_phone)
+        self.assertEqual(options.columns(), [
+            ('NAME', 'имя'), ('PHONE', 'номер телефона'), ('PHONE_2', 'номер телефона 2')])
+        self.assertEqual(ExportOptions.from_dict(options.to_dict()).to_dict(), options.to_dict())
+
+    def test_from_request_rejects_bad_input(self):
+        directory = _directory_with('ООО "Ромашка"')
+        for query in ['company=Лютик', 'fields=UNKNOWN', 'multifield_limit=0', 'date_create_from=31.01.2024']:
+            with self.subTest(query=query), self.assertRaises(ValueError):
+                ExportOptions.from_request(QueryDict(query), directory)
+
+
+class CompanyResolverTests(FakePortalTestCase):
+
+    def test_normalized_names_match(self):
+        for name in ['ООО "Ромашка"', 'ромашка', 'Ромашка ООО', '  «Ромашка»  ']:
+            self.assertEqual(normalize_company_name(name), 'ромашка')
+        self.assertEqual(normalize_company_name('ООО'), 'ооо')
+
+    def test_missing_companies_are_created_once(self):
+        token = self.make_token(companies_count=0)
+        directory = company_directory.CompanyDirectory()
+        resolver = CompanyResolver(directory)
+        self.assertIsNone(resolver.resolve('ООО "Лютик"'))
+        self.assertIsNone(resolver.resolve('лютик'))
+        self.assertIsNone(resolver.resolve('Ромашка'))
+
+        self.assertEqual(resolver.create_missing(token), 2)
+        self.assertEqual(token.portal.rest_calls, 1)
+        self.assertEqual(sorted(company['TITLE'] for company in token.portal.companies.values()), [
+            'ООО "Лютик"', 'Ромашка'])
+        company_id = resolver.resolve('Лютик')
+        self.assertIsNotNone(company_id)
+        self.assertTrue(resolver.matches('"Лютик" ООО', company_id))
+        self.assertFalse(resolver.has_missing)
+
+
+class DuplicateIndexTests(FakePortalTestCase):
+
+    def test_find_by_phone_or_email(self):
+        index = ContactDuplicateIndex.build(self.make_token(contacts_count=3))
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.find('8 (900) 000-00-02'), '2')
+        self.assertEqual(index.find(email=' Contact3@Example.com '), '3')
+        self.assertIsNone(index.find('+79001111111', 'nobody@example.com'))
+
+    def test_upsert_match_prefers_external_code(self):
+        token = self.make_token(contacts_count=3)
+        token.portal.contacts[1]['ORIGIN_ID'] = 'ext-1'
+        index = ContactUpsertIndex.build(token)
+        # внешний код первого контакта важнее телефона второго и почты третьего
+        self.assertEqual(
+            index.match({'ORIGIN_ID': 'ext-1', 'PHONE': '+79000000002', 'EMAIL': 'contact3@example.com'}), '1')
+        self.assertEqual(index.match({'ORIGIN_ID': 'ext-9', 'PHONE': '+79000000002', 'EMAIL': 'contact3@example.com'}), '2')
+        self.assertEqual(index.match({'PHONE': '', 'EMAIL': 'contact3@example.com'}), '3')
+        self.assertEqual(index.get('1')['PHONE'], [{'ID': '1', 'VALUE': '+79000000001', 'VALUE_TYPE': 'WORK'}])
+
+
+class UpsertImportTests(FakePortalTestCase):
+
+    def test_update_sends_only_changed_fields(self):
+        token = self.make_token(contacts_count=3, companies_count=0)
+        token.portal.contacts[1]['ORIGIN_ID'] = 'ext-1'
+        headers = ['имя', 'фамилия', 'номер телефона', 'почта', 'компания', 'внешний код']
+        rows = [
+            # найден по внешнему коду: изменилось только имя, телефон и почта те же, но записаны иначе
+            ['Новое', 'Фамилия1', '8 (900) 000-00-01', 'CONTACT1@example.com', '', 'ext-1'],
+            # найден по телефону, ничего не изменилось
+            ['Имя2', 'Фамилия2', '+7 900 000 00 02', '', '', ''],
+            ['Пётр', 'Новый', '+79001112233', '', '', ''],
+        ]
+        pipeline = ImportPipeline(
+            token, ContactUpsertIndex.build(token), CompanyResolver(company_directory.CompanyDirectory()),
+            mode=IMPORT_MODE_UPSERT)
+        sent = []
+        chunk_commands = pipeline._chunk_commands
+
+        def record_commands(*args):
+            chunk_rows, methods = chunk_commands(*args)
+            sent.extend((method, params) for _, method, params in methods)
+            return chunk_rows, methods
+
+        pipeline._chunk_commands = record_commands
+        result = pipeline.run(iter_normalized_contacts(headers, rows))
+
+        self.assertEqual([method for method, _ in sent], ['crm.contact.update', 'crm.contact.add'])
+        self.assertEqual(sent[0][1], {'id': '1', 'fields': {'NAME': 'Новое'}})
+        self.assertEqual((result.updated_count, result.unchanged_count, result.success_count), (1, 1, 2))
+        self.assertEqual(token.portal.contacts[1]['NAME'], 'Новое')
+
+
+class ImportErrorReportTests(SimpleTestCase):
+
+    def test_report_keeps_external_code_and_imports_back(self):
+        row = {'NAME': 'Иван', 'PHONE': '12345', 'ORIGIN_ID': 'ext-7', ERROR_COLUMN: 'некорректный телефон: 12345'}
+        report = io.BytesIO()
+        import_jobs._write_error_report([(row, row[ERROR_COLUMN])], report)
+        lines = report.getvalue().decode('utf-16').splitlines()
+        self.assertEqual(lines[0].split(','), import_jobs.ERROR_REPORT_HEADERS)
+        self.assertIn('внешний код', lines[0])
+
+        # исправленный отчёт загружается как обычный файл импорта, внешний код сохраняется
+        fixed = report.getvalue().decode('utf-16').replace('12345', '+79001234567')
+        contacts = list(iter_imported_file(SimpleUploadedFile('errors.csv', fixed.encode('utf-16'))))
+        self.assertEqual(contacts[0]['ORIGIN_ID'], 'ext-7')
+        self.assertEqual(contacts[0]['PHONE'], '+79001234567')
+        self.assertIsNone(contacts[0][ERROR_COLUMN])
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_unread_streaming_response_finishes_trace_on_close(self):
+        view = metrics.instrumented_view('metrics_test', lambda view: view)(
+            lambda request: ExporterFactory.get_exporter('csv').export(iter([])))
+        response = view(RequestFactory().get('/'))
+        self.assertFalse(any(trace.name == 'metrics_test' for trace in metrics.registry._recent))
+        # клиент отключился, не прочитав ни одного куска
+        response.close()
+        response.close()
+        self.assertEqual(sum(trace.name == 'metrics_test' for trace in metrics.registry._recent), 1)
+
+
+class ContactNormalizerTests(SimpleTestCase):
+
+    def test_phone_formats_share_one_form(self):
+        for phone in ['+7 (900) 123-45-67', '8 900 123 45 67', '9001234567', '79001234567', 79001234567]:
+            with self.subTest(phone=phone):
+                self.assertEqual(normalize_phone(phone), '+79001234567')
+        # иностранный номер не трогается, восьмёрка в начале меняется только у 11 цифр
+        self.assertEqual(normalize_phone('+44 20 7946 0958'), '+442079460958')
+        # номера с "+" той же длины, что и российские, остаются со своим кодом страны
+        self.assertEqual(normalize_phone('+84 912 345 678'), '+84912345678')
+        self.assertEqual(normalize_phone('+82 10 1234 567'), '+82101234567')
+        self.assertEqual(normalize_phone('+1 212 555 0123'), '+12125550123')
+        self.assertEqual(normalize_phone(' +8 123 456 78 90'), '+81234567890')
+        # десять цифр без "+" считаются российским номером только с российской первой цифры
+        self.assertEqual(normalize_phone('2125550123'), '+2125550123')
+        self.assertEqual(normalize_phone('8 10 44 20 7946 0958'), '+810442079460958')
+        self.assertIsNone(normalize_phone('нет'))
+        self.assertIsNone(normalize_phone(''))
+
+    def test_invalid_values_are_marked_not_dropped(self):
+        headers = ['имя', 'номер телефона', 'почта', 'компания', 'имя']
+        rows = [
+            ['Иван', '12-34', 'ivan@', 'ООО Ромашка', 'лишнее'],
+            ['', '+79001234567', '', '', ''],
+            ['Пётр', '8 (900) 123-45-67'],
+        ]
+        contacts = list(iter_normalized_contacts(headers, rows))
+        self.assertEqual(len(contacts), 2)
+        self.assertEqual(contacts[0]['NAME'], 'Иван')
+        self.assertEqual(contacts[0]['PHONE'], '12-34')
+        self.assertEqual(contacts[0]['COMPANY_NAME'], 'ООО "Ромашка"')
+        self.assertEqual(contacts[0][ERROR_COLUMN], 'некорректный телефон: 12-34; некорректная почта: ivan@')
+        self.assertEqual(contacts[1]['PHONE'], '+79001234567')
+        self.assertIsNone(contacts[1]['EMAIL'])
+        self.assertIsNone(contacts[1][ERROR_COLUMN])
+
+    def test_detect_encoding(self):
+        text = 'имя;фамилия\nИван;Иванов\n'
+        cases = [
+            (codecs.BOM_UTF8 + text.encode('utf-8'), 'utf-8-sig'),
+            (text.encode('utf-16'), 'utf-16'),
+            ('name;last\nIvan;Ivanov\n'.encode('utf-16-le'), 'utf-16-le'),
+            ('name;last\nIvan;Ivanov\n'.encode('utf-16-be'), 'utf-16-be'),
+            (text.encode('cp1251'), 'cp1251'),
+            # образец оборвался посреди двухбайтовой буквы - это всё ещё utf-8
+            (text.encode('utf-8')[:-2], 'utf-8'),
+        ]
+        for sample, encoding in cases:
+            with self.subTest(encoding=encoding):
+                self.assertEqual(detect_encoding(sample), encoding)
+
+    def test_detect_delimiter(self):
+        self.assertEqual(detect_delimiter('имя;фамилия;почта\nИван;Иванов;a@b.ru\nПётр;Пет'), ';')
+        self.assertEqual(detect_delimiter('\ufeffимя\tфамилия\nИван\tИванов\n'), '\t')
+        self.assertEqual(detect_delimiter('имя,фамилия'), ',')
+        self.assertEqual(detect_delimiter('имя'), ',')
+
+    def test_cp1251_file_with_bom_on_every_line(self):
+        content = '\ufeffИмя;Фамилия;Номер телефона\r\n\ufeffИван;Иванов;8 900 123-45-67\r\n'
+        contacts = list(iter_imported_file(SimpleUploadedFile('contacts.csv', content.encode('utf-8'))))
+        self.assertEqual([(contact['NAME'], contact['PHONE']) for contact in contacts], [('Иван', '+79001234567')])
+        content = 'Имя;Фамилия\nЁжик;Туманов\n'.encode('cp1251')
+        contacts = list(iter_imported_file(SimpleUploadedFile('contacts.csv', content)))
+        self.assertEqual(contacts[0]['NAME'], 'Ёжик')
@@ -0,0 +1,258 @@
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+import httpx
+from asgiref.sync import sync_to_async
+
+from . import metrics
+from .auth_cache import token_refresher
+from .batch_scheduler import (
+    BATCH_RETRY_ATTEMPTS, failed_commands, get_rate_limiter, is_limit_error, is_read_method, is_retryable_error,
+    name_commands, retry_delay,
+)
+from .list_iterator import PAGE_SIZE
+from .portal import get_portal_domain, get_portal_id
+
+# пул соединений общего клиента: keep-alive соединения к порталам переиспользуются между запросами
+ASYNC_HTTP_MAX_CONNECTIONS = 100
+ASYNC_HTTP_MAX_KEEPALIVE = 20
+ASYNC_HTTP_KEEPALIVE_EXPIRY = 30.0
+ASYNC_HTTP_TIMEOUT = 60.0
+# сколько доменов порталов помнить; лишние вытесняются по давности использования
+ASYNC_PORTAL_DOMAINS_MAX = 10000
+
+EXPIRED_TOKEN = 'expired_token'
+
+# клиент httpx привязан к циклу событий, поэтому у каждого цикла свой; под asgi цикл один на процесс.
+# рядом с клиентом - задача, которая закрывает его при остановке цикла
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[httpx.AsyncClient, asyncio.Task]]' = (
+    weakref.WeakKeyDictionary())
+# домен портала не меняется, а его чтение - запрос к базе, которого в цикле событий быть не должно
+_portal_domains: 'OrderedDict[int, str]' = OrderedDict()
+_portal_domains_lock = threading.Lock()
+
+
+class BitrixRestError(Exception):
+    """ошибка rest api bitrix; поля те же, что у ошибок integration_utils, их разбирает batch_scheduler"""
+
+    def __init__(self, error: str, error_description: str = '', status_code: Optional[int] = None):
+        super().__init__(f'{error}: {error_description}')
+        self.error = error
+        self.error_description = error_description
+        self.status_code = status_code
+
+
+def _is_retryable(error: Exception, read_only: bool) -> bool:
+    """batch_scheduler.is_retryable_error для ошибок httpx: запись повторяется, только если запрос не ушёл"""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(error, httpx.TransportError):
+        return read_only
+    return is_retryable_error(error, read_only)
+
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=ASYNC_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=ASYNC_HTTP_TIMEOUT,
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """общий на цикл событий клиент с пулом соединений"""
+    loop = asyncio.get_running_loop()
+    client, _ = _clients.get(loop, (None, None))
+    if client is None or client.is_closed:
+        client = _create_client()
+        _clients[loop] = (client, loop.create_task(_close_on_loop_shutdown(client)))
+    return client
+
+
+async def _close_on_loop_shutdown(client: httpx.AsyncClient) -> None:
+    """ждёт остановки цикла событий и закрывает соединения клиента
+
+    asyncio.run и async_to_sync перед закрытием цикла отменяют оставшиеся задачи и дожидаются их,
+    так что клиент цикла, созданного на один вызов, не оставляет открытых сокетов
+    """
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await client.aclose()
+
+
+async def _get_domain(but) -> str:
+    portal_id = get_portal_id(but)
+    with _portal_domains_lock:
+        domain = _portal_domains.get(portal_id)
+        if domain is not None:
+            _portal_domains.move_to_end(portal_id)
+    if domain is None:
+        domain = await sync_to_async(get_portal_domain)(but)
+        with _portal_domains_lock:
+            _portal_domains[portal_id] = domain
+            while len(_portal_domains) > ASYNC_PORTAL_DOMAINS_MAX:
+                _portal_domains.popitem(last=False)
+    return domain
+
+
+async def _post(but, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """один запрос к rest api без повторов; истёкший токен обновляется и запрос повторяется один раз"""
+    url = f'https://{await _get_domain(but)}/rest/{method}.json'
+    for refreshed in (False, True):
+        response = await get_async_client().post(url, params={'auth': but.auth_token}, json=params)
+        try:
+            data = response.json()
+        except ValueError:
+            raise BitrixRestError('INVALID_RESPONSE', response.text[:200], response.status_code)
+        if 'error' not in data:
+            return data
+        if data['error'] == EXPIRED_TOKEN and not refreshed:
+            # refresh_token одноразовый: запросы того же пользователя обновляют токен один раз на всех
+            await sync_to_async(token_refresher.refresh_now)(but)
+            continue
+        raise BitrixRestError(data['error'], data.get('error_description', ''), response.status_code)
+
+
+async def acall_api_method(but, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """асинхронный batch_scheduler.call_api_method: тот же лимит портала и те же повторы"""
+    limiter = get_rate_limiter(but)
+    read_only = is_read_method(method)
+    for attempt in range(BATCH_RETRY_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt))
+        await limiter.acquire_async()
+        metrics.increment(metrics.COUNTER_REST_CALLS)
+        try:
+            with metrics.span(metrics.SPAN_REST_CALL):
+                response = await _post(but, method, params or {})
+        except Exception as e:
+            metrics.increment(metrics.COUNTER_REST_ERRORS)
+            if is_limit_error(e):
+                limiter.on_limit_exceeded()
+            if _is_retryable(e, read_only) and attempt < BATCH_RETRY_ATTEMPTS - 1:
+                continue
+            raise
+        limiter.on_success()
+        return response
+
+
+def http_build_query(params: Any, prefix: str = '') -> List[str]:
+    """параметры команды batch-а в виде строки запроса php: fields[PHONE][0][VALUE]=..."""
+    if isinstance(params, bool):
+        # флаги полей crm (OPENED, EXPORT) bitrix принимает как Y/N, str(True) он не поймёт
+        params = 'Y' if params else 'N'
+    if isinstance(params, dict):
+        items = params.items()
+    elif isinstance(params, (list, tuple)):
+        items = enumerate(params)
+    else:
+        return [f'{quote(prefix, safe="[]")}={quote(str(params), safe="")}']
+    parts = []
+    for key, value in items:
+        # как и http_build_query в php, пустые значения не передаются
+        if value is None:
+            continue
+        parts.extend(http_build_query(value, f'{prefix}[{key}]' if prefix else str(key)))
+    return parts
+
+
+async def _arun_chunk(but, commands: List[Tuple[str, str, Dict[str, Any]]], halt: int) -> Dict[str, Any]:
+    """асинхронный batch_scheduler._run_chunk: временно упавшие команды переотправляются отдельно"""
+    limiter = get_rate_limiter(but)
+    results = {}
+    pending = commands
+    for attempt in range(BATCH_RETRY_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt))
+        await limiter.acquire_async()
+        metrics.increment(metrics.COUNTER_REST_CALLS)
+        metrics.increment(metrics.COUNTER_BATCH_COMMANDS, len(pending))
+        try:
+            with metrics.span(metrics.SPAN_BATCH_CALL):
+                response = await _post(but, 'batch', {
+                    'halt': halt,
+                    'cmd': {name: f'{method}?{"&".join(http_build_query(params))}' for name, method, params in pending},
+                })
+        except Exception as e:
+            metrics.increment(metrics.COUNTER_REST_ERRORS)
+            if is_limit_error(e):
+                limiter.on_limit_exceeded()
+            read_only = all(is_read_method(method) for _, method, _ in pending)
+            if _is_retryable(e, read_only) and attempt < BATCH_RETRY_ATTEMPTS - 1:
+                continue
+            raise
+
+        batch = response.get('result') or {}
+        command_results = batch.get('result') or {}
+        command_errors = batch.get('result_error') or {}
+        # пустой result у batch-а - список, а не словарь
+        command_results = command_results if isinstance(command_results, dict) else {}
+        command_errors = command_errors if isinstance(command_errors, dict) else {}
+        batch_results = {}
+        for name, _, _ in pending:
+            if name in command_errors:
+                error = command_errors[name]
+                batch_results[name] = {
+                    'result': None,
+                    'error': error.get('error'),
+                    'error_description': error.get('error_description'),
+                }
+            elif name in command_results:
+                batch_results[name] = {'result': command_results[name], 'error': None}
+        results.update(batch_results)
+        if command_errors:
+            metrics.increment(metrics.COUNTER_REST_ERRORS, len(command_errors))
+
+        failed = failed_commands(pending, batch_results)
+        if any(is_limit_error(batch_results.get(command[0], {}).get('error')) for command in failed):
+            limiter.on_limit_exceeded()
+        else:
+            limiter.on_success()
+        if not failed:
+            break
+        pending = failed
+    return {name: results[name] for name, _, _ in commands if name in results}
+
+
+async def arun_batch(but, methods: Sequence[Tuple], halt: int = 0) -> Dict[str, Any]:
+    """асинхронный batch_scheduler.run_batch: один batch не больше BATCH_CHUNK_SIZE команд"""
+    commands = name_commands(methods)
+    if not commands:
+        return {}
+    return await _arun_chunk(but, commands, halt)
+
+
+async def aiter_list_pages(
+        but,
+        method: str,
+        select: Optional[List[str]] = None,
+        list_filter: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """асинхронный list_iterator.iter_list_pages: страницы по курсору ID, без подсчёта total"""
+    select = list(select or ['*'])
+    if 'ID' not in select and '*' not in select:
+        select.append('ID')
+
+    last_id = 0
+    while True:
+        response = await acall_api_method(but, method, {
+            'select': select,
+            'filter': dict(list_filter or {}, **{'>ID': last_id}),
+            'order': {'ID': 'ASC'},
+            'start': -1,
+        })
+        page = response.get('result') or []
+        if not page:
+            return
+        yield page
+        if len(page) < PAGE_SIZE:
+            return
+        last_id = int(page[-1]['ID'])
@@ -0,0 +1,269 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import metrics
+
+# сколько секунд запрос с теми же cookie обходится без main_auth
+AUTH_CACHE_TTL = 60
+# сколько пользователей держать в памяти процесса, лишние вытесняются по давности использования
+AUTH_CACHE_MAX_ENTRIES = 1000
+# cookie, которые меняются независимо от авторизации и не должны сбрасывать кэш
+AUTH_CACHE_IGNORED_COOKIES = ['csrftoken']
+
+# токен bitrix живёт час; за столько секунд до истечения он обновляется в фоне
+BITRIX_TOKEN_LIFETIME = 60 * 60
+BITRIX_TOKEN_REFRESH_AHEAD = 5 * 60
+# сколько секунд запрос с истёкшим токеном ждёт чужого обновления, прежде чем пойти дальше без него
+BITRIX_TOKEN_REFRESH_WAIT = 10
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bitrix_token_refresh')
+
+logger = logging.getLogger(__name__)
+
+
+class _AuthEntry:
+    """то, что main_auth положил в request, и когда это перестаёт быть действительным"""
+
+    __slots__ = ('attributes', 'expires_at')
+
+    def __init__(self, attributes: Dict[str, Any], expires_at: float):
+        self.attributes = attributes
+        self.expires_at = expires_at
+
+
+class AuthCache:
+    """кэш авторизации процесса: подписанные cookie -> токен и пользователь bitrix
+
+    подписанные cookie проверяются main_auth при первом запросе, дальше в течение TTL
+    запросы с теми же cookie получают уже проверенный токен без обращения к базе
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, _AuthEntry]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry.attributes
+
+    def put(self, key: str, attributes: Dict[str, Any], now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = _AuthEntry(attributes, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard_token(self, token) -> None:
+        """убирает все записи с этим токеном: следующий запрос снова пройдёт через main_auth"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry.attributes.get('bitrix_user_token') is token]
+            for key in stale:
+                del self._entries[key]
+
+    def discard_user_copies(self, token) -> None:
+        """убирает записи с другими экземплярами токена того же пользователя
+
+        у разных cookie одного пользователя main_auth загружает свои экземпляры токена; после обновления
+        в них остался старый одноразовый refresh_token, и следующий запрос должен прочитать токен из базы заново
+        """
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if _refresh_key(entry.attributes.get('bitrix_user_token')) == _refresh_key(token)
+                and entry.attributes.get('bitrix_user_token') is not token
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+auth_cache = AuthCache()
+
+
+def auth_cache_key(request) -> Optional[str]:
+    """ключ кэша по cookie запроса; без cookie авторизации нет и кэшировать нечего"""
+    cookies = sorted(
+        (name, value) for name, value in request.COOKIES.items() if name not in AUTH_CACHE_IGNORED_COOKIES)
+    if not cookies:
+        return None
+    # в памяти хранится только хэш, а не сами подписанные значения
+    return hashlib.sha256(repr(cookies).encode('utf-8')).hexdigest()
+
+
+def _refresh_key(token) -> Any:
+    """ключ single-flight: пользователь bitrix, а не экземпляр токена или запись кэша"""
+    if token is None:
+        return None
+    return type(token), token.user_id
+
+
+class _TokenRefresher:
+    """обновление токенов с объединением одновременных запросов (single-flight)
+
+    на одного пользователя выполняется не больше одного обновления, сколько бы экземпляров его токена
+    ни лежало в кэше: refresh_token одноразовый, второе обновление разлогинило бы пользователя.
+    остальные запросы либо идут дальше со старым, ещё действующим токеном, либо ждут то же самое обновление
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Any, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, token) -> Optional[threading.Event]:
+        """событие уже идущего обновления или None, если обновлять должен вызывающий"""
+        key = _refresh_key(token)
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is not None:
+                return event
+            self._in_flight[key] = threading.Event()
+            return None
+
+    def _finish(self, token) -> None:
+        with self._lock:
+            event = self._in_flight.pop(_refresh_key(token))
+        event.set()
+
+    def _refresh(self, token, rejected: bool = False) -> None:
+        """rejected - bitrix уже отверг токен как истёкший, хотя по времени он мог бы ещё действовать"""
+        try:
+            used_token_date = getattr(token, 'auth_token_date', None)
+            # токен мог обновить другой экземпляр или другой процесс: его refresh_token уже недействителен
+            token.refresh_from_db()
+            if rejected:
+                if getattr(token, 'auth_token_date', None) != used_token_date:
+                    return
+            elif not _needs_refresh(token, timezone.now()):
+                return
+            if token.refresh() is False:
+                auth_cache.discard_token(token)
+            else:
+                auth_cache.discard_user_copies(token)
+        except Exception:
+            logger.exception('ошибка обновления токена bitrix %s', token.pk)
+            auth_cache.discard_token(token)
+        finally:
+            self._finish(token)
+
+    def _refresh_in_pool(self, token) -> None:
+        try:
+            self._refresh(token)
+        finally:
+            # поток пула живёт долго, соединение с базой за собой нужно закрывать
+            close_old_connections()
+
+    def ensure_fresh(self, token) -> None:
+        """обновляет токен, срок которого подходит к концу; истёкший токен обновляется до запуска view"""
+        now = timezone.now()
+        if not _needs_refresh(token, now):
+            return
+        event = self._start(token)
+        if now < token_expires_at(token):
+            # токен ещё действует: запрос не ждёт, обновление идёт в фоне
+            if event is None:
+                _refresh_executor.submit(self._refresh_in_pool, token)
+            return
+        if event is None:
+            self._refresh(token)
+        elif event.wait(BITRIX_TOKEN_REFRESH_WAIT):
+            # обновлял другой экземпляр токена этого пользователя, новые значения берутся из базы
+            token.refresh_from_db()
+        else:
+            # зависшее обновление не должно держать запросы: view пойдёт со старым токеном
+            logger.warning('обновление токена bitrix пользователя %s не завершилось за %s с', token.user_id,
+                           BITRIX_TOKEN_REFRESH_WAIT)
+
+
+    def refresh_now(self, token) -> None:
+        """обновляет токен, на который bitrix ответил expired_token, и загружает новые значения из базы
+
+        одновременные вызовы для одного пользователя ждут то же самое обновление, что и ensure_fresh
+        """
+        event = self._start(token)
+        if event is None:
+            self._refresh(token, rejected=True)
+        elif not event.wait(BITRIX_TOKEN_REFRESH_WAIT):
+            logger.warning('обновление токена bitrix пользователя %s не завершилось за %s с', token.user_id,
+                           BITRIX_TOKEN_REFRESH_WAIT)
+        token.refresh_from_db()
+
+
+token_refresher = _TokenRefresher()
+
+
+def _needs_refresh(token, now: datetime) -> bool:
+    expires_at = token_expires_at(token)
+    return expires_at is not None and now >= expires_at - timedelta(seconds=BITRIX_TOKEN_REFRESH_AHEAD)
+
+
+def token_expires_at(token) -> Optional[datetime]:
+    """когда истекает токен пользователя, если это известно"""
+    auth_token_date = getattr(token, 'auth_token_date', None)
+    if auth_token_date is None:
+        return None
+    return auth_token_date + timedelta(seconds=BITRIX_TOKEN_LIFETIME)
+
+
+def cached_auth(auth_decorator: Callable[[Callable], Callable]) -> Callable[[Callable], Callable]:
+    """кэширует результат декоратора авторизации (main_auth(on_cookies=True)) по cookie запроса
+
+    использование вместо @main_auth(on_cookies=True):
+        @cached_auth(main_auth(on_cookies=True))
+    """
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def authenticated(request, *args, **kwargs):
+            key = getattr(request, 'auth_cache_key', None)
+            # запоминаются только атрибуты, которые выставил сам декоратор авторизации
+            attributes = {
+                name: value for name, value in vars(request).items()
+                if name.startswith('bitrix_') and name not in request.auth_cache_before
+            }
+            if key is not None and 'bitrix_user_token' in attributes:
+                auth_cache.put(key, attributes)
+                token_refresher.ensure_fresh(attributes['bitrix_user_token'])
+            return view(request, *args, **kwargs)
+
+        protected = auth_decorator(authenticated)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = auth_cache_key(request)
+            attributes = auth_cache.get(key) if key is not None else None
+            if attributes is None:
+                metrics.increment(metrics.COUNTER_AUTH_CACHE_MISSES)
+                request.auth_cache_key = key
+                request.auth_cache_before = set(vars(request))
+                return protected(request, *args, **kwargs)
+
+            metrics.increment(metrics.COUNTER_AUTH_CACHE_HITS)
+            for name, value in attributes.items():
+                setattr(request, name, value)
+            token_refresher.ensure_fresh(attributes['bitrix_user_token'])
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
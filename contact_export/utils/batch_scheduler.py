@@ -0,0 +1,303 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import requests
+from django.db import connection
+
+from . import metrics
+from .portal import get_portal_id
+
+# лимиты bitrix24 по умолчанию: 2 запроса в секунду с запасом в 50 запросов (тариф "энтерпрайз" - 5 в секунду)
+BITRIX_RATE_LIMIT = 2.0
+BITRIX_RATE_BURST = 50
+BITRIX_RATE_LIMIT_MIN = 0.5
+
+BATCH_CHUNK_SIZE = 50
+# сколько batch-ей одного вызова run_batches идут одновременно
+BATCH_WORKERS = 4
+# общий на процесс пул потоков для batch-ей всех вызовов run_batches
+BATCH_POOL_WORKERS = 16
+# сколько всего попыток даётся запросу (и каждой команде batch-а) при временных ошибках
+BATCH_RETRY_ATTEMPTS = 5
+# экспоненциальная задержка между попытками: 0.5, 1, 2, 4... секунды, но не больше 30, со случайным разбросом
+BATCH_RETRY_BASE_DELAY = 0.5
+BATCH_RETRY_MAX_DELAY = 30.0
+
+QUERY_LIMIT_EXCEEDED = 'QUERY_LIMIT_EXCEEDED'
+# ошибки, после которых запрос имеет смысл повторить
+TRANSIENT_ERROR_CODES = [QUERY_LIMIT_EXCEEDED, 'OPERATION_TIME_LIMIT', 'INTERNAL_SERVER_ERROR', 'TIMEOUT', 'TIMED OUT']
+# ошибки, с которыми портал отклоняет запрос, не выполняя его
+NOT_APPLIED_ERROR_CODES = [QUERY_LIMIT_EXCEEDED, 'OPERATION_TIME_LIMIT']
+NOT_APPLIED_STATUS_CODE = 503
+# действия методов (последняя часть имени), повтор которых ничего не меняет в портале
+READ_METHOD_ACTIONS = ['list', 'get', 'fields', 'admin', 'current']
+
+
+class PortalRateLimiter:
+    """ограничитель частоты запросов к порталу по модели "дырявого ведра" bitrix
+
+    частота подстраивается: после QUERY_LIMIT_EXCEEDED она делится пополам,
+    а после каждого успешного запроса понемногу растёт обратно, но не выше заданной
+    """
+
+    def __init__(self, rate: float = BITRIX_RATE_LIMIT, burst: int = BITRIX_RATE_BURST):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ждёт, пока в ведре появится место для очередного запроса"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """то же, что acquire, но ожидание не занимает поток - для асинхронных view"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.05)
+
+    def on_limit_exceeded(self) -> None:
+        with self._lock:
+            self.rate = max(BITRIX_RATE_LIMIT_MIN, self.rate / 2)
+            # портал считает ведро полным - запас тоже обнуляем
+            self._tokens = 0.0
+
+
+_limiters: Dict[int, PortalRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(but) -> PortalRateLimiter:
+    """общий на процесс ограничитель для портала пользователя"""
+    portal_id = get_portal_id(but)
+    with _limiters_lock:
+        limiter = _limiters.get(portal_id)
+        if limiter is None:
+            limiter = _limiters[portal_id] = PortalRateLimiter()
+        return limiter
+
+
+def error_code(error: Any) -> Optional[str]:
+    """код ошибки bitrix из ответа команды или исключения"""
+    if error is None:
+        return None
+    if isinstance(error, dict):
+        return error.get('error') or error.get('code')
+    return getattr(error, 'error', None) or str(error)
+
+
+def is_limit_error(error: Any) -> bool:
+    code = error_code(error)
+    return bool(code) and QUERY_LIMIT_EXCEEDED in code
+
+
+def is_transient_error(error: Any) -> bool:
+    """временная ошибка: превышение лимита, таймаут, обрыв соединения или 5xx"""
+    if error is None:
+        return False
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    status_code = error.get('status') if isinstance(error, dict) else getattr(error, 'status_code', None)
+    if isinstance(status_code, int) and status_code >= 500:
+        return True
+    code = (error_code(error) or '').upper()
+    return any(transient_code in code for transient_code in TRANSIENT_ERROR_CODES)
+
+
+def is_read_method(method: str) -> bool:
+    return method.rsplit('.', 1)[-1].lower() in READ_METHOD_ACTIONS
+
+
+def is_not_applied_error(error: Any) -> bool:
+    """ошибка, после которой запрос точно не выполнен: портал его отклонил или соединение не установлено"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    status_code = error.get('status') if isinstance(error, dict) else getattr(error, 'status_code', None)
+    if status_code == NOT_APPLIED_STATUS_CODE:
+        return True
+    code = (error_code(error) or '').upper()
+    return any(not_applied_code in code for not_applied_code in NOT_APPLIED_ERROR_CODES)
+
+
+def is_retryable_error(error: Any, read_only: bool) -> bool:
+    """можно ли повторить запрос после ошибки
+
+    чтение повторяется при любой временной ошибке, запись - только если портал её точно не выполнил:
+    таймаут или обрыв соединения мог случиться уже после того, как batch создал контакты
+    """
+    if read_only:
+        return is_transient_error(error)
+    return is_not_applied_error(error)
+
+
+def retry_delay(attempt: int) -> float:
+    """задержка перед попыткой attempt (с 1): экспонента с "полным" разбросом"""
+    return random.uniform(0, min(BATCH_RETRY_MAX_DELAY, BATCH_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def call_api_method(but, method: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """одиночный rest-вызов с учётом лимита портала и повтором при временных ошибках (см. is_retryable_error)"""
+    limiter = get_rate_limiter(but)
+    read_only = is_read_method(method)
+    for attempt in range(BATCH_RETRY_ATTEMPTS):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        limiter.acquire()
+        metrics.increment(metrics.COUNTER_REST_CALLS)
+        try:
+            with metrics.span(metrics.SPAN_REST_CALL):
+                response = but.call_api_method(method, params)
+        except Exception as e:
+            metrics.increment(metrics.COUNTER_REST_ERRORS)
+            if is_limit_error(e):
+                limiter.on_limit_exceeded()
+            if is_retryable_error(e, read_only) and attempt < BATCH_RETRY_ATTEMPTS - 1:
+                continue
+            raise
+        limiter.on_success()
+        return response
+
+
+def name_commands(methods: Sequence[Tuple]) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """приводит команды к виду (имя, метод, параметры) с уникальными именами"""
+    commands = []
+    for index, command in enumerate(methods):
+        if len(command) == 3:
+            commands.append(tuple(command))
+        else:
+            method, params = command
+            commands.append((f'cmd_{index}', method, params))
+    return commands
+
+
+def failed_commands(pending: List[Tuple], batch_results: Dict[str, Any]) -> List[Tuple]:
+    """команды batch-а, которые надо переотправить: без ответа (не выполнены после halt)
+    или с ошибкой, после которой команду можно повторить"""
+    return [
+        command for command in pending
+        if command[0] not in batch_results
+        or is_retryable_error(batch_results[command[0]].get('error'), is_read_method(command[1]))
+    ]
+
+
+def _run_chunk(but, limiter: PortalRateLimiter, chunk: List[Tuple], halt: int) -> Dict[str, Any]:
+    """отправляет batch; команды, упавшие с временной ошибкой, переотправляются отдельно от остальных"""
+    results = {}
+    pending = chunk
+    for attempt in range(BATCH_RETRY_ATTEMPTS):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        limiter.acquire()
+        metrics.increment(metrics.COUNTER_REST_CALLS)
+        metrics.increment(metrics.COUNTER_BATCH_COMMANDS, len(pending))
+        try:
+            with metrics.span(metrics.SPAN_BATCH_CALL):
+                batch_results = but.batch_api_call(methods=pending, halt=halt, chunk_size=len(pending))
+        except Exception as e:
+            metrics.increment(metrics.COUNTER_REST_ERRORS)
+            # ответа на batch нет - повторять приходится все его команды, и только если это безопасно
+            if is_limit_error(e):
+                limiter.on_limit_exceeded()
+            read_only = all(is_read_method(method) for _, method, _ in pending)
+            if is_retryable_error(e, read_only) and attempt < BATCH_RETRY_ATTEMPTS - 1:
+                continue
+            raise
+        results.update(batch_results)
+        command_errors = sum(1 for result in batch_results.values() if result.get('error') is not None)
+        if command_errors:
+            metrics.increment(metrics.COUNTER_REST_ERRORS, command_errors)
+
+        failed = failed_commands(pending, batch_results)
+        if any(is_limit_error(batch_results.get(command[0], {}).get('error')) for command in failed):
+            limiter.on_limit_exceeded()
+        else:
+            limiter.on_success()
+        if not failed:
+            break
+        pending = failed
+    return {name: results[name] for name, _, _ in chunk if name in results}
+
+
+_pool = ThreadPoolExecutor(max_workers=BATCH_POOL_WORKERS, thread_name_prefix='bitrix_batch')
+
+
+def _run_chunk_in_pool(but, limiter: PortalRateLimiter, chunk: List[Tuple], halt: int) -> Dict[str, Any]:
+    try:
+        return _run_chunk(but, limiter, chunk, halt)
+    finally:
+        # соединение с базой (обновление токена) не держим за потоком пула между вызовами
+        connection.close()
+
+
+def run_batch(but, methods: Sequence[Tuple], halt: int = 0) -> Dict[str, Any]:
+    """один batch (не больше BATCH_CHUNK_SIZE команд) в текущем потоке с учётом лимита портала"""
+    commands = name_commands(methods)
+    if not commands:
+        return {}
+    return _run_chunk(but, get_rate_limiter(but), commands, halt)
+
+
+def run_batches(
+        but,
+        methods: Sequence[Tuple],
+        halt: int = 0,
+        chunk_size: int = BATCH_CHUNK_SIZE,
+        max_workers: int = BATCH_WORKERS,
+) -> Dict[str, Any]:
+    """замена but.batch_api_call: batch-и уходят параллельно в пределах лимита портала
+
+    команды - кортежи (метод, параметры) или (имя, метод, параметры);
+    результат - словарь имя -> ответ команды в исходном порядке команд
+    """
+    commands = name_commands(methods)
+    if not commands:
+        return {}
+    chunks = [commands[start:start + chunk_size] for start in range(0, len(commands), chunk_size)]
+    limiter = get_rate_limiter(but)
+
+    results = {}
+    # замеры из потоков пула относятся к тому же запросу, что и вызов run_batches
+    run_chunk = metrics.bind_trace(_run_chunk_in_pool)
+    # в общем пуле у вызова не больше max_workers batch-ей одновременно, ответы разбираются по порядку
+    in_flight = deque()
+    for chunk in chunks:
+        if len(in_flight) >= max_workers:
+            _collect_chunk(results, *in_flight.popleft())
+        in_flight.append((chunk, _pool.submit(run_chunk, but, limiter, chunk, halt)))
+    while in_flight:
+        _collect_chunk(results, *in_flight.popleft())
+    return results
+
+
+def _collect_chunk(results: Dict[str, Any], chunk: List[Tuple], future) -> None:
+    chunk_results = future.result()
+    for name, _, _ in chunk:
+        if name in chunk_results:
+            results[name] = chunk_results[name]
@@ -0,0 +1,145 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from . import metrics
+from .list_iterator import iter_list
+from .portal import get_portal_id
+
+# через сколько секунд справочник добирается дельтой по DATE_MODIFY
+COMPANY_DIRECTORY_REFRESH_INTERVAL = 60
+# время жизни справочника: после него он перечитывается целиком, так из него уходят удалённые компании
+COMPANY_DIRECTORY_TTL = 60 * 60
+# сколько порталов держать в памяти процесса, лишние вытесняются по давности использования
+COMPANY_DIRECTORY_MAX_PORTALS = 100
+
+COMPANY_DIRECTORY_FIELDS = ['ID', 'TITLE', 'DATE_MODIFY']
+
+# организационно-правовые формы, которые не учитываются при сравнении названий
+LEGAL_FORM_ABBREVIATIONS = ['ООО', 'ОАО', 'ИП', 'ЗАО', 'ПАО', 'НПАО', 'ГУП', 'МУП']
+
+_LEGAL_FORMS = {abbreviation.lower() for abbreviation in LEGAL_FORM_ABBREVIATIONS}
+_QUOTES = re.compile(r'[«»"\'“”„`]')
+
+
+def normalize_company_name(name: Optional[str]) -> str:
+    """ключ для сравнения названий: без правовой формы, кавычек, регистра и лишних пробелов
+
+    'ООО "Ромашка"', 'ромашка' и 'Ромашка ООО' дают один и тот же ключ
+    """
+    if not name:
+        return ''
+    words = _QUOTES.sub(' ', name).lower().split()
+    significant_words = [word for word in words if word not in _LEGAL_FORMS]
+    # название, целиком состоящее из правовой формы, сравниваем как есть
+    return ' '.join(significant_words or words)
+
+
+class CompanyDirectory:
+    """справочник компаний одного портала: id -> название, название -> id
+    и нормализованное название (normalize_company_name) -> id
+
+    словари не меняются на месте, при обновлении подменяются целиком,
+    поэтому их можно спокойно читать из нескольких потоков
+    """
+
+    def __init__(self):
+        self.titles_by_id: Dict[str, str] = {}
+        self.ids_by_title: Dict[str, str] = {}
+        self.ids_by_key: Dict[str, str] = {}
+        self.last_modified: Optional[str] = None
+        # загружен ли справочник хоть раз: у портала без компаний last_modified так и остаётся пустым
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.synced_at = 0.0
+        self.lock = threading.Lock()
+
+    def title_by_id(self, company_id: Optional[str]) -> str:
+        """название компании по id, пустая строка если компания неизвестна"""
+        return self.titles_by_id.get(company_id, '') if company_id else ''
+
+    def id_by_title(self, title: Optional[str]) -> Optional[str]:
+        """id компании по точному названию"""
+        return self.ids_by_title.get(title) if title else None
+
+    def id_by_name(self, name: Optional[str]) -> Optional[str]:
+        """id компании по точному названию, а если такого нет - по названию без правовой формы и кавычек"""
+        company_id = self.id_by_title(name)
+        if company_id is None and name:
+            company_id = self.ids_by_key.get(normalize_company_name(name))
+        return company_id
+
+    def add(self, company_id: str, title: str) -> None:
+        """добавляет компанию, созданную приложением, не дожидаясь следующей синхронизации"""
+        with self.lock:
+            self._apply({company_id: (title, None)}, full=False)
+
+    def refresh(self, but, now: Optional[float] = None) -> None:
+        """обновляет справочник, если он устарел"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if not self.loaded or now - self.loaded_at >= COMPANY_DIRECTORY_TTL:
+                self._apply(self._fetch(but, {}), full=True)
+                self.loaded = True
+                self.loaded_at = now
+            elif now - self.synced_at < COMPANY_DIRECTORY_REFRESH_INTERVAL:
+                return
+            elif self.last_modified:
+                # ">=" вместо ">": компании, изменённые в ту же секунду, что и прошлая синхронизация, не теряются
+                companies = self._fetch(but, {'>=DATE_MODIFY': self.last_modified})
+                self._apply(companies, full=False)
+            else:
+                # в портале не было компаний, отметки для дельты нет: список перечитывается целиком, это один запрос
+                self._apply(self._fetch(but, {}), full=True)
+            self.synced_at = now
+
+    def _fetch(self, but, company_filter: Dict[str, str]) -> Dict[str, Tuple[str, Optional[str]]]:
+        with metrics.span(metrics.SPAN_COMPANY_FETCH):
+            companies = iter_list(but, 'crm.company.list', select=COMPANY_DIRECTORY_FIELDS, list_filter=company_filter)
+            return {company['ID']: (company['TITLE'], company.get('DATE_MODIFY')) for company in companies}
+
+    def _apply(self, companies: Dict[str, Tuple[str, Optional[str]]], full: bool) -> None:
+        if full:
+            self.last_modified = None
+        titles_by_id = {} if full else dict(self.titles_by_id)
+        ids_by_title = {} if full else dict(self.ids_by_title)
+        ids_by_key = {} if full else dict(self.ids_by_key)
+        for company_id, (title, date_modify) in companies.items():
+            # при переименовании старое название больше не должно указывать на компанию
+            old_title = titles_by_id.get(company_id)
+            if old_title is not None and ids_by_title.get(old_title) == company_id:
+                del ids_by_title[old_title]
+            if old_title is not None and ids_by_key.get(normalize_company_name(old_title)) == company_id:
+                del ids_by_key[normalize_company_name(old_title)]
+            titles_by_id[company_id] = title
+            ids_by_title[title] = company_id
+            # из одинаковых без правовой формы названий (ООО и ИП "Ромашка") ключ остаётся за первым
+            ids_by_key.setdefault(normalize_company_name(title), company_id)
+            if date_modify and (not self.last_modified
+                                or datetime.fromisoformat(date_modify) > datetime.fromisoformat(self.last_modified)):
+                self.last_modified = date_modify
+        self.titles_by_id = titles_by_id
+        self.ids_by_title = ids_by_title
+        self.ids_by_key = ids_by_key
+
+
+_directories: 'OrderedDict[int, CompanyDirectory]' = OrderedDict()
+_directories_lock = threading.Lock()
+
+
+def get_company_directory(but) -> CompanyDirectory:
+    """справочник компаний портала пользователя, обновлённый при необходимости"""
+    portal_id = get_portal_id(but)
+    with _directories_lock:
+        directory = _directories.get(portal_id)
+        if directory is None:
+            directory = CompanyDirectory()
+            _directories[portal_id] = directory
+        _directories.move_to_end(portal_id)
+        while len(_directories) > COMPANY_DIRECTORY_MAX_PORTALS:
+            _directories.popitem(last=False)
+    directory.refresh(but)
+    return directory
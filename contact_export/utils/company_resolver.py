@@ -0,0 +1,65 @@
+import logging
+from typing import Dict, Optional
+
+from .batch_scheduler import run_batches
+from .company_directory import CompanyDirectory, normalize_company_name
+
+logger = logging.getLogger(__name__)
+
+
+class CompanyResolver:
+    """сопоставляет названия компаний из файла импорта с компаниями портала
+
+    словарь по нормализованному ключу берётся из справочника, ненайденные
+    названия копятся и создаются одним дедуплицированным batch-ем crm.company.add
+    """
+
+    def __init__(self, directory: CompanyDirectory):
+        self._directory = directory
+        self._ids_by_key: Dict[str, str] = dict(directory.ids_by_key)
+        # ключ -> название в том виде, в каком оно впервые встретилось в файле
+        self._unresolved: Dict[str, str] = {}
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """id компании по названию, ненайденное название запоминается для создания"""
+        key = normalize_company_name(name)
+        if not key:
+            return None
+        company_id = self._ids_by_key.get(key)
+        if company_id is None:
+            self._unresolved.setdefault(key, name.strip())
+        return company_id
+
+    def matches(self, name: Optional[str], company_id: Optional[str]) -> bool:
+        """то же ли название у компании company_id (с точностью до правовой формы, кавычек и регистра)"""
+        title = self._directory.titles_by_id.get(company_id) if company_id else None
+        return title is not None and normalize_company_name(title) == normalize_company_name(name)
+
+    @property
+    def has_missing(self) -> bool:
+        """есть ли названия, которые ещё нужно создать в bitrix"""
+        return bool(self._unresolved)
+
+    def create_missing(self, but) -> int:
+        """создаёт все ненайденные компании одним набором batch-ей, возвращает число созданных"""
+        if not self._unresolved:
+            return 0
+        keys = list(self._unresolved)
+        methods = [
+            (f'company_{index}', 'crm.company.add', {'fields': {'TITLE': self._unresolved[key]}})
+            for index, key in enumerate(keys)
+        ]
+        results = run_batches(but, methods, halt=0)
+
+        created_count = 0
+        for index, key in enumerate(keys):
+            result = results.get(f'company_{index}') or {}
+            if result.get('error') is None and result.get('result'):
+                company_id = str(result['result'])
+                self._ids_by_key[key] = company_id
+                self._directory.add(company_id, self._unresolved[key])
+                created_count += 1
+            else:
+                logger.warning('не удалось создать компанию "%s": %s', self._unresolved[key], result.get('error'))
+        self._unresolved.clear()
+        return created_count
@@ -0,0 +1,333 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from contact_export.models import ContactMirrorState, MirroredContact
+from . import metrics
+from .async_bitrix import aiter_list_pages
+from .batch_scheduler import call_api_method
+from .contact_source import iter_contact_pages, iter_export_contacts, aiter_export_contact_pages
+from .export_options import ExportOptions, multifield_key
+from .portal import get_portal_id
+
+CONTACT_MIRROR_FIELDS = ['ID', 'NAME', 'LAST_NAME', 'PHONE', 'EMAIL', 'COMPANY_ID', 'DATE_CREATE', 'DATE_MODIFY']
+# удалённый на портале контакт остаётся в зеркале, пока его не найдёт сверка. чтобы экспорт не отдавал
+# его часами, после дельты число контактов в зеркале сравнивается с total портала (один запрос, не чаще
+# раза в CONTACT_MIRROR_COUNT_CHECK_INTERVAL секунд): зеркало после дельты содержит все контакты портала,
+# так что расхождение означает удаление и запускает сверку сразу. полная сверка раз в
+# CONTACT_MIRROR_RECONCILE_INTERVAL остаётся страховкой; удалённый контакт пропадает из экспорта
+# не позже чем через CONTACT_MIRROR_COUNT_CHECK_INTERVAL
+CONTACT_MIRROR_COUNT_CHECK_INTERVAL = 60
+CONTACT_MIRROR_RECONCILE_INTERVAL = timedelta(hours=1)
+# сколько контактов читать из зеркала за один запрос к базе
+CONTACT_MIRROR_READ_CHUNK = 500
+MIRRORED_CONTACT_UPDATE_FIELDS = ['name', 'last_name', 'phones', 'emails', 'company_id', 'date_create', 'date_modify']
+# зеркало общее для портала и заполняется с правами того, кто его синхронизирует, поэтому читают
+# и пишут его только администраторы портала: они видят все контакты. права пользователя кэшируются
+CONTACT_MIRROR_ADMIN_TTL = 10 * 60
+CONTACT_MIRROR_MAX_USERS = 10000
+
+logger = logging.getLogger(__name__)
+
+# синхронизация одного портала не должна идти в несколько потоков одновременно
+_sync_locks: Dict[int, threading.Lock] = {}
+_sync_locks_guard = threading.Lock()
+
+
+# когда портал последний раз сверялся по числу контактов, по порталам
+_counted_at: Dict[int, float] = {}
+# (портал, пользователь) -> (администратор ли, когда проверено)
+_admin_users: 'OrderedDict[Tuple[int, int], Tuple[bool, float]]' = OrderedDict()
+_admin_users_lock = threading.Lock()
+
+
+def _get_sync_lock(portal_id: int) -> threading.Lock:
+    with _sync_locks_guard:
+        return _sync_locks.setdefault(portal_id, threading.Lock())
+
+
+def user_sees_all_contacts(but) -> bool:
+    """видит ли пользователь все контакты портала (user.admin), то есть можно ли ему зеркало"""
+    key = (get_portal_id(but), but.user_id)
+    now = time.monotonic()
+    with _admin_users_lock:
+        cached = _admin_users.get(key)
+    if cached is not None and now - cached[1] < CONTACT_MIRROR_ADMIN_TTL:
+        return cached[0]
+    is_admin = bool(call_api_method(but, 'user.admin').get('result'))
+    with _admin_users_lock:
+        _admin_users[key] = (is_admin, now)
+        _admin_users.move_to_end(key)
+        while len(_admin_users) > CONTACT_MIRROR_MAX_USERS:
+            _admin_users.popitem(last=False)
+    return is_admin
+
+
+def _multifield_values(values: Optional[List[Dict[str, Any]]]) -> List[str]:
+    return [value.get('VALUE', '') for value in values or [] if value.get('VALUE')]
+
+
+def _to_mirrored_contact(portal_id: int, contact: Dict[str, Any]) -> MirroredContact:
+    return MirroredContact(
+        bitrix_portal_id=portal_id,
+        bitrix_id=int(contact['ID']),
+        name=contact.get('NAME') or '',
+        last_name=contact.get('LAST_NAME') or '',
+        phones=_multifield_values(contact.get('PHONE')),
+        emails=_multifield_values(contact.get('EMAIL')),
+        company_id=contact.get('COMPANY_ID') or '',
+        date_create=parse_datetime(contact['DATE_CREATE']) if contact.get('DATE_CREATE') else None,
+        date_modify=parse_datetime(contact['DATE_MODIFY']) if contact.get('DATE_MODIFY') else None,
+    )
+
+
+def sync_contact_mirror(but, reconcile: bool = False) -> ContactMirrorState:
+    """догружает в зеркало контакты, изменённые после последней синхронизации
+
+    при reconcile=True (или раз в CONTACT_MIRROR_RECONCILE_INTERVAL) из зеркала
+    дополнительно удаляются контакты, которых больше нет на портале
+    """
+    portal_id = get_portal_id(but)
+    with _get_sync_lock(portal_id), metrics.span(metrics.SPAN_CONTACT_FETCH):
+        state, contact_filter = _start_sync(portal_id)
+        watermark = state.watermark
+        for page in iter_contact_pages(but, select=CONTACT_MIRROR_FIELDS, contact_filter=contact_filter):
+            watermark = _store_page(portal_id, page, watermark)
+        return _finish_sync(but, state, watermark, reconcile)
+
+
+async def async_sync_contact_mirror(but, reconcile: bool = False) -> ContactMirrorState:
+    """то же, что sync_contact_mirror, но страницы портала запрашиваются без занятого потока
+
+    в поток уходят только запись в базу и редкая сверка удалённых контактов
+    """
+    portal_id = get_portal_id(but)
+    lock = _get_sync_lock(portal_id)
+    # ожидание блокировки, которую держит другая синхронизация, тоже не должно занимать цикл событий
+    await sync_to_async(lock.acquire, thread_sensitive=False)()
+    try:
+        with metrics.span(metrics.SPAN_CONTACT_FETCH):
+            state, contact_filter = await sync_to_async(_start_sync)(portal_id)
+            watermark = state.watermark
+            async for page in aiter_list_pages(
+                    but, 'crm.contact.list', select=CONTACT_MIRROR_FIELDS, list_filter=contact_filter):
+                watermark = await sync_to_async(_store_page)(portal_id, page, watermark)
+            return await sync_to_async(_finish_sync)(but, state, watermark, reconcile)
+    finally:
+        lock.release()
+
+
+def _start_sync(portal_id: int) -> Tuple[ContactMirrorState, Dict[str, str]]:
+    state, _ = ContactMirrorState.objects.get_or_create(bitrix_portal_id=portal_id)
+    # ">=" вместо ">": контакты, изменённые в ту же секунду, что и прошлая синхронизация, не теряются
+    contact_filter = {'>=DATE_MODIFY': state.watermark.isoformat()} if state.watermark else {}
+    return state, contact_filter
+
+
+def _store_page(portal_id: int, page: List[Dict[str, Any]], watermark: Optional[datetime]) -> Optional[datetime]:
+    """записывает страницу контактов в зеркало и возвращает сдвинутую отметку DATE_MODIFY"""
+    contacts = [_to_mirrored_contact(portal_id, contact) for contact in page]
+    MirroredContact.objects.bulk_create(
+        contacts,
+        update_conflicts=True,
+        unique_fields=['bitrix_portal_id', 'bitrix_id'],
+        update_fields=MIRRORED_CONTACT_UPDATE_FIELDS,
+    )
+    for contact in contacts:
+        if contact.date_modify and (watermark is None or contact.date_modify > watermark):
+            watermark = contact.date_modify
+    return watermark
+
+
+def _finish_sync(
+        but,
+        state: ContactMirrorState,
+        watermark: Optional[datetime],
+        reconcile: bool,
+) -> ContactMirrorState:
+    # первая загрузка забирает портал целиком, сверять удаления после неё незачем
+    full_sync = state.watermark is None
+    now = timezone.now()
+    state.watermark = watermark
+    state.synced_at = now
+    if full_sync:
+        state.reconciled_at = now
+        _counted_at[state.bitrix_portal_id] = time.monotonic()
+    elif (reconcile or state.reconciled_at is None or now - state.reconciled_at >= CONTACT_MIRROR_RECONCILE_INTERVAL
+          or _has_deleted_contacts(but, state.bitrix_portal_id)):
+        _reconcile_deleted_contacts(but, state.bitrix_portal_id)
+        state.reconciled_at = now
+    state.save()
+    return state
+
+
+def _has_deleted_contacts(but, portal_id: int) -> bool:
+    """есть ли в зеркале контакты, удалённые на портале: сравнение числа контактов с total портала"""
+    now = time.monotonic()
+    if now - _counted_at.get(portal_id, float('-inf')) < CONTACT_MIRROR_COUNT_CHECK_INTERVAL:
+        return False
+    _counted_at[portal_id] = now
+    response = call_api_method(but, 'crm.contact.list', {'select': ['ID'], 'order': {'ID': 'ASC'}, 'start': 0})
+    return MirroredContact.objects.filter(bitrix_portal_id=portal_id).count() != response.get('total', 0)
+
+
+def _reconcile_deleted_contacts(but, portal_id: int) -> int:
+    """удаляет из зеркала контакты, которых больше нет на портале"""
+    portal_ids = set()
+    for page in iter_contact_pages(but, select=['ID']):
+        portal_ids.update(int(contact['ID']) for contact in page)
+
+    mirrored_ids = MirroredContact.objects.filter(bitrix_portal_id=portal_id).values_list('bitrix_id', flat=True)
+    deleted_ids = [bitrix_id for bitrix_id in mirrored_ids.iterator() if bitrix_id not in portal_ids]
+    for chunk_start in range(0, len(deleted_ids), CONTACT_MIRROR_READ_CHUNK):
+        MirroredContact.objects.filter(
+            bitrix_portal_id=portal_id,
+            bitrix_id__in=deleted_ids[chunk_start:chunk_start + CONTACT_MIRROR_READ_CHUNK],
+        ).delete()
+    if deleted_ids:
+        logger.info('из зеркала портала %s удалено контактов: %s', portal_id, len(deleted_ids))
+    return len(deleted_ids)
+
+
+def iter_mirror_export_contacts(
+        portal_id: int,
+        company_dict: Dict[str, str],
+        on_page: Optional[Callable[[int], None]] = None,
+        options: Optional[ExportOptions] = None,
+) -> Iterator[Dict[str, Any]]:
+    """контакты из зеркала портала в том же виде, что и prepare_export_row
+
+    читаются кусками по bitrix_id, без offset и без загрузки всей таблицы в память;
+    фильтр экспорта уходит в WHERE, из базы читаются только выбранные поля
+    """
+    options = options or ExportOptions()
+    last_id = 0
+    while True:
+        rows = _read_mirror_chunk(portal_id, company_dict, options, last_id)
+        if not rows:
+            return
+        if on_page is not None:
+            on_page(len(rows))
+        yield from rows
+        last_id = int(rows[-1]['ID'])
+
+
+async def aiter_mirror_export_pages(
+        portal_id: int,
+        company_dict: Dict[str, str],
+        options: ExportOptions,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """то же, что iter_mirror_export_contacts, кусками; каждый кусок читается из базы в потоке"""
+    last_id = 0
+    while True:
+        rows = await sync_to_async(_read_mirror_chunk)(portal_id, company_dict, options, last_id)
+        if not rows:
+            return
+        yield rows
+        last_id = int(rows[-1]['ID'])
+
+
+def _read_mirror_chunk(
+        portal_id: int,
+        company_dict: Dict[str, str],
+        options: ExportOptions,
+        last_id: int,
+) -> List[Dict[str, Any]]:
+    """строки экспорта следующих CONTACT_MIRROR_READ_CHUNK контактов зеркала после last_id"""
+    columns = ['bitrix_id'] + [column for field, column in _MIRROR_COLUMNS.items() if field in options.fields]
+    contacts = options.filter.filter_queryset(MirroredContact.objects.filter(bitrix_portal_id=portal_id))
+    chunk = list(
+        contacts
+        .filter(bitrix_id__gt=last_id)
+        .order_by('bitrix_id')
+        .values(*columns)[:CONTACT_MIRROR_READ_CHUNK]
+    )
+    with metrics.span(metrics.SPAN_TRANSFORM):
+        rows = [_mirror_export_row(contact, company_dict, options) for contact in chunk]
+    metrics.increment(metrics.COUNTER_ROWS_EXPORTED, len(rows))
+    return rows
+
+
+# поле экспорта -> колонка зеркала
+_MIRROR_COLUMNS = {
+    'NAME': 'name',
+    'LAST_NAME': 'last_name',
+    'PHONE': 'phones',
+    'EMAIL': 'emails',
+    'COMPANY': 'company_id',
+}
+
+
+def _mirror_export_row(contact: Dict[str, Any], company_dict: Dict[str, str], options: ExportOptions) -> Dict[str, Any]:
+    row = {'ID': str(contact['bitrix_id'])}
+    for field in options.fields:
+        value = contact[_MIRROR_COLUMNS[field]]
+        if field == 'COMPANY':
+            row['COMPANY'] = company_dict.get(value, '') if value else ''
+        elif field in ('PHONE', 'EMAIL'):
+            for index in range(options.multifield_limit):
+                row[multifield_key(field, index)] = value[index] if index < len(value) else ''
+        else:
+            row[field] = value
+    return row
+
+
+def export_uses_mirror(but, options: ExportOptions) -> bool:
+    """читается ли экспорт из зеркала
+
+    только для администраторов портала (см. user_sees_all_contacts): остальным crm.contact.list
+    отдаёт лишь разрешённые контакты, и общее зеркало показало бы им чужие. у администратора - да,
+    если зеркало портала уже есть или выгружается весь портал; выгрузка с фильтром на портале
+    без зеркала идёт прямо из crm.contact.list, чтобы не тянуть весь портал ради части контактов
+    """
+    if not user_sees_all_contacts(but):
+        return False
+    if options.filter.is_empty():
+        return True
+    return ContactMirrorState.objects.filter(bitrix_portal_id=get_portal_id(but), watermark__isnull=False).exists()
+
+
+def iter_export_rows(
+        but,
+        company_dict: Dict[str, str],
+        options: ExportOptions,
+        on_page: Optional[Callable[[int], None]] = None,
+        synced: bool = False,
+) -> Iterator[Dict[str, Any]]:
+    """строки экспорта с учётом фильтра и выбранных полей
+
+    зеркало догружается дельтой и фильтруется запросом к базе, без зеркала фильтр уходит в FILTER
+    crm.contact.list (см. export_uses_mirror). synced=True - зеркало только что синхронизировано вызывающим
+    """
+    portal_id = get_portal_id(but)
+    if export_uses_mirror(but, options):
+        if not synced:
+            sync_contact_mirror(but)
+        return iter_mirror_export_contacts(portal_id, company_dict, on_page=on_page, options=options)
+    return iter_export_contacts(but, company_dict, on_page=on_page, options=options)
+
+
+async def aiter_export_pages(
+        but,
+        company_dict: Dict[str, str],
+        options: ExportOptions,
+        synced: bool = False,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """то же, что iter_export_rows, для асинхронного экспорта: строки отдаются кусками"""
+    portal_id = get_portal_id(but)
+    if await sync_to_async(export_uses_mirror)(but, options):
+        if not synced:
+            await async_sync_contact_mirror(but)
+        pages = aiter_mirror_export_pages(portal_id, company_dict, options)
+    else:
+        pages = aiter_export_contact_pages(but, company_dict, options)
+    async for page in pages:
+        yield page
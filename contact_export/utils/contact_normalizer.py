@@ -0,0 +1,125 @@
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from .company_directory import LEGAL_FORM_ABBREVIATIONS
+
+# колонка файла (заголовок в нижнем регистре) -> поле контакта
+IMPORT_COLUMNS = {
+    'имя': 'NAME',
+    'фамилия': 'LAST_NAME',
+    'номер телефона': 'PHONE',
+    'почта': 'EMAIL',
+    'компания': 'COMPANY_NAME',
+    # необязательная колонка: код контакта во внешней системе, по нему upsert находит контакт раньше, чем по телефону
+    'внешний код': 'ORIGIN_ID',
+}
+# колонка с описанием ошибки: строка с ошибкой в bitrix не отправляется, а попадает в отчёт
+ERROR_COLUMN = 'ERROR'
+
+# E.164: не больше 15 цифр кода страны и номера; короче 11 цифр номер в россии неполный
+E164_MIN_DIGITS = 11
+E164_MAX_DIGITS = 15
+
+_NOT_DIGITS = re.compile(r'\D')
+# первая цифра десятизначного российского номера без кода страны: мобильные 9, городские 3 и 4, 8-800
+_RU_LOCAL_FIRST_DIGITS = '9348'
+_LEGAL_FORM = re.compile(r'^(' + '|'.join(LEGAL_FORM_ABBREVIATIONS) + r') +(?!["«])(.+)$')
+_EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s.]+')
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """телефон в виде E.164 (+79001234567): только цифры после "+", None - если цифр нет
+
+    номер с "+" уже содержит код страны и остаётся как есть, только цифрами. без "+" российские
+    8XXXXXXXXXX и XXXXXXXXXX (10 цифр с кода 9, 3, 4 или 8) приводятся к +7XXXXXXXXXX.
+    единственная нормализация телефона: ей же строятся ключи индекса дубликатов и сравниваются значения при upsert
+    """
+    if not phone:
+        return None
+    phone = str(phone)
+    digits = _NOT_DIGITS.sub('', phone)
+    if not phone.lstrip().startswith('+'):
+        if len(digits) == 11 and digits[0] == '8':
+            digits = '7' + digits[1:]
+        elif len(digits) == 10 and digits[0] in _RU_LOCAL_FIRST_DIGITS:
+            digits = '7' + digits
+    return '+' + digits if digits else None
+
+
+def is_valid_phone(phone: Optional[str]) -> bool:
+    """нормализованный телефон полной длины"""
+    return phone is not None and E164_MIN_DIGITS <= len(phone) - 1 <= E164_MAX_DIGITS
+
+
+def quote_company_name(name: str) -> str:
+    """ООО Ромашка -> ООО "Ромашка"; уже взятые в кавычки названия не меняются"""
+    return _LEGAL_FORM.sub(r'\1 "\2"', name)
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ''
+    # из csv приходят только строки, приводить к str нужно лишь значения ячеек xlsx
+    return (value if isinstance(value, str) else str(value)).strip()
+
+
+class ContactNormalizer:
+    """нормализует строки файла по одной
+
+    строки без имени и фамилии отбрасываются, строки с неверным телефоном или почтой
+    остаются, но помечаются ошибкой в колонке ERROR. на выходе - поля контакта, пустые значения - None
+    """
+
+    def __init__(self, headers: Sequence[str]):
+        # позиция колонки в строке файла; из повторяющихся заголовков берётся первый
+        positions = {}
+        for position, header in enumerate(headers):
+            positions.setdefault(header, position)
+        self._positions = [positions.get(header) for header in IMPORT_COLUMNS]
+        # названия компаний в файле повторяются, поэтому каждое правится один раз
+        self._companies: Dict[str, str] = {}
+
+    def normalize(self, row: Sequence[Any]) -> Optional[Dict[str, Any]]:
+        width = len(row)
+        name, last_name, phone, email, company_name, origin_id = [
+            _cell(row[position]) if position is not None and position < width else ''
+            for position in self._positions
+        ]
+        # минимальная валидация: нужны хотя бы имя или фамилия
+        if not name and not last_name:
+            return None
+
+        errors = []
+        if phone:
+            normalized_phone = normalize_phone(phone)
+            if is_valid_phone(normalized_phone):
+                phone = normalized_phone
+            else:
+                # неверный телефон остаётся в отчёте об ошибках в исходном виде
+                errors.append(f'некорректный телефон: {phone}')
+        if email and not _EMAIL.fullmatch(email):
+            errors.append(f'некорректная почта: {email}')
+        if company_name:
+            quoted = self._companies.get(company_name)
+            if quoted is None:
+                quoted = self._companies[company_name] = quote_company_name(company_name)
+            company_name = quoted
+
+        return {
+            'NAME': name or None,
+            'LAST_NAME': last_name or None,
+            'PHONE': phone or None,
+            'EMAIL': email or None,
+            'COMPANY_NAME': company_name or None,
+            'ORIGIN_ID': origin_id or None,
+            ERROR_COLUMN: '; '.join(errors) or None,
+        }
+
+
+def iter_normalized_contacts(headers: List[str], rows: Iterable[Sequence[Any]]) -> Iterator[Dict[str, Any]]:
+    """нормализованные контакты строк файла; headers - заголовки в нижнем регистре"""
+    normalizer = ContactNormalizer(headers)
+    for row in rows:
+        contact = normalizer.normalize(row)
+        if contact is not None:
+            yield contact
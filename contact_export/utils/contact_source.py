@@ -0,0 +1,75 @@
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Callable
+
+from .async_bitrix import aiter_list_pages
+from .export_options import ExportOptions, multifield_key
+from .list_iterator import iter_list_pages
+
+# поля контакта, которые реально нужны для экспорта
+CONTACT_EXPORT_FIELDS = ['ID', 'NAME', 'LAST_NAME', 'PHONE', 'EMAIL', 'COMPANY_ID']
+
+
+def iter_contact_pages(
+        but,
+        select: Optional[List[str]] = None,
+        contact_filter: Optional[Dict[str, Any]] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """лениво отдаёт страницы crm.contact.list с явным select (пагинация по курсору ID)"""
+    return iter_list_pages(but, 'crm.contact.list', select=select or CONTACT_EXPORT_FIELDS, list_filter=contact_filter)
+
+
+def first_multifield_value(values: Optional[List[Dict[str, Any]]]) -> str:
+    """первое значение мультиполя (PHONE, EMAIL) или пустая строка"""
+    return values[0].get('VALUE', '') if values else ''
+
+
+def prepare_export_row(
+        contact: Dict[str, Any],
+        company_dict: Dict[str, str],
+        options: Optional[ExportOptions] = None,
+) -> Dict[str, Any]:
+    """оставляет только нужные для экспорта поля контакта"""
+    options = options or ExportOptions()
+    row = {'ID': contact.get('ID')}
+    for field in options.fields:
+        if field == 'COMPANY':
+            company_id = contact.get('COMPANY_ID')
+            row['COMPANY'] = company_dict.get(company_id, '') if company_id else ''
+        elif field in ('PHONE', 'EMAIL'):
+            values = contact.get(field) or []
+            for index in range(options.multifield_limit):
+                row[multifield_key(field, index)] = values[index].get('VALUE', '') if index < len(values) else ''
+        else:
+            row[field] = contact.get(field)
+    return row
+
+
+def iter_export_contacts(
+        but,
+        company_dict: Dict[str, str],
+        on_page: Optional[Callable[[int], None]] = None,
+        options: Optional[ExportOptions] = None,
+) -> Iterator[Dict[str, Any]]:
+    """контакты портала, готовые к передаче в экспортер
+
+    фильтр экспорта передаётся в FILTER crm.contact.list, а select ограничен выбранными полями.
+    on_page вызывается после получения каждой страницы с числом контактов на ней
+    """
+    options = options or ExportOptions()
+    pages = iter_contact_pages(but, select=options.bitrix_select(), contact_filter=options.filter.to_bitrix_filter())
+    for page in pages:
+        if on_page is not None:
+            on_page(len(page))
+        for contact in page:
+            yield prepare_export_row(contact, company_dict, options)
+
+
+async def aiter_export_contact_pages(
+        but,
+        company_dict: Dict[str, str],
+        options: ExportOptions,
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """то же, что iter_export_contacts, для асинхронного экспорта: по странице crm.contact.list"""
+    pages = aiter_list_pages(
+        but, 'crm.contact.list', select=options.bitrix_select(), list_filter=options.filter.to_bitrix_filter())
+    async for page in pages:
+        yield [prepare_export_row(contact, company_dict, options) for contact in page]
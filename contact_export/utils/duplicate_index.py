@@ -0,0 +1,136 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import metrics
+from .async_bitrix import aiter_list_pages
+from .contact_normalizer import normalize_phone
+from .contact_source import iter_contact_pages
+
+DUPLICATE_INDEX_FIELDS = ['ID', 'PHONE', 'EMAIL']
+# для upsert кроме ключей нужны текущие значения полей, с которыми сравнивается строка файла
+UPSERT_INDEX_FIELDS = DUPLICATE_INDEX_FIELDS + ['NAME', 'LAST_NAME', 'COMPANY_ID', 'ORIGIN_ID']
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    if not email:
+        return None
+    return str(email).strip().lower() or None
+
+
+class ContactDuplicateIndex:
+    """индекс контактов портала по нормализованным телефону и почте
+
+    строится один раз на импорт, после чего проверка строки на дубликат - O(1) без rest-запросов
+    """
+    index_fields = DUPLICATE_INDEX_FIELDS
+
+    def __init__(self):
+        self._by_phone: Dict[str, str] = {}
+        self._by_email: Dict[str, str] = {}
+
+    def __len__(self):
+        return len(set(self._by_phone.values()) | set(self._by_email.values()))
+
+    def add(self, contact_id: str, phones: Iterable[Optional[str]] = (), emails: Iterable[Optional[str]] = ()) -> None:
+        for phone in phones:
+            key = normalize_phone(phone)
+            if key:
+                self._by_phone.setdefault(key, contact_id)
+        for email in emails:
+            key = normalize_email(email)
+            if key:
+                self._by_email.setdefault(key, contact_id)
+
+    def find(self, phone: Optional[str] = None, email: Optional[str] = None) -> Optional[str]:
+        """id уже существующего контакта с тем же телефоном или почтой"""
+        phone_key = normalize_phone(phone)
+        if phone_key and phone_key in self._by_phone:
+            return self._by_phone[phone_key]
+        email_key = normalize_email(email)
+        if email_key and email_key in self._by_email:
+            return self._by_email[email_key]
+        return None
+
+    @classmethod
+    def build(cls, but) -> 'ContactDuplicateIndex':
+        """индекс всех контактов портала, собранный постраничным crm.contact.list"""
+        index = cls()
+        with metrics.span(metrics.SPAN_DUPLICATE_INDEX):
+            for page in iter_contact_pages(but, select=cls.index_fields):
+                index.add_page(page)
+        return index
+
+    @classmethod
+    async def abuild(cls, but) -> 'ContactDuplicateIndex':
+        """то же, что build, но страницы запрашиваются без занятого потока"""
+        index = cls()
+        with metrics.span(metrics.SPAN_DUPLICATE_INDEX):
+            async for page in aiter_list_pages(but, 'crm.contact.list', select=cls.index_fields):
+                index.add_page(page)
+        return index
+
+    def add_page(self, contacts: List[Dict[str, Any]]) -> None:
+        for contact in contacts:
+            self.add(
+                contact['ID'],
+                phones=_multifield_values(contact.get('PHONE')),
+                emails=_multifield_values(contact.get('EMAIL')),
+            )
+
+
+class ContactUpsertIndex(ContactDuplicateIndex):
+    """индекс для upsert: кроме телефона и почты - внешний код и текущие значения полей контакта
+
+    значения хранятся в памяти, чтобы сравнение строки файла с контактом не стоило rest-запроса
+    """
+    index_fields = UPSERT_INDEX_FIELDS
+
+    def __init__(self):
+        super().__init__()
+        self._by_origin: Dict[str, str] = {}
+        self._contacts: Dict[str, Dict[str, Any]] = {}
+
+    def add_page(self, contacts: List[Dict[str, Any]]) -> None:
+        super().add_page(contacts)
+        for contact in contacts:
+            origin_id = (contact.get('ORIGIN_ID') or '').strip()
+            if origin_id:
+                self._by_origin.setdefault(origin_id, contact['ID'])
+            self._contacts[contact['ID']] = {
+                'NAME': contact.get('NAME') or '',
+                'LAST_NAME': contact.get('LAST_NAME') or '',
+                'COMPANY_ID': str(contact.get('COMPANY_ID') or ''),
+                'ORIGIN_ID': origin_id,
+                # id значений мультиполей нужны, чтобы изменить значение, а не добавить ещё одно
+                'PHONE': [_multifield_item(value) for value in contact.get('PHONE') or []],
+                'EMAIL': [_multifield_item(value) for value in contact.get('EMAIL') or []],
+            }
+
+    def add(
+            self,
+            contact_id: str,
+            phones: Iterable[Optional[str]] = (),
+            emails: Iterable[Optional[str]] = (),
+            origin_id: Optional[str] = None,
+    ) -> None:
+        super().add(contact_id, phones, emails)
+        if origin_id:
+            self._by_origin.setdefault(origin_id, contact_id)
+
+    def match(self, contact_data: Dict[str, Any]) -> Optional[str]:
+        """id контакта для строки файла: сначала по внешнему коду, затем по телефону или почте"""
+        origin_id = contact_data.get('ORIGIN_ID')
+        if origin_id and origin_id in self._by_origin:
+            return self._by_origin[origin_id]
+        return self.find(contact_data.get('PHONE'), contact_data.get('EMAIL'))
+
+    def get(self, contact_id: str) -> Optional[Dict[str, Any]]:
+        """текущие значения полей контакта или None для контакта, созданного этим же импортом"""
+        return self._contacts.get(contact_id)
+
+
+def _multifield_item(value: Dict[str, str]) -> Dict[str, str]:
+    return {'ID': value.get('ID'), 'VALUE': value.get('VALUE') or '', 'VALUE_TYPE': value.get('VALUE_TYPE') or 'WORK'}
+
+
+def _multifield_values(values: Optional[List[Dict[str, str]]]) -> List[str]:
+    return [value.get('VALUE') for value in values or []]
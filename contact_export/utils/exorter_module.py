@@ -1,76 +1,317 @@
+import codecs
 import csv
-from django.http import HttpResponse
+import json
+import pickle
+import tempfile
+import time
+import zlib
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
 import openpyxl
+from openpyxl.utils import get_column_letter
 from abc import ABC, abstractmethod
-from typing import List, Dict,Any
+from typing import List, Dict, Any, AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, Tuple
+
+from . import metrics
+
+# заголовки выгружаемого файла
+EXPORT_HEADERS = ['имя', 'фамилия', 'номер телефона', 'почта', 'компания']
+# колонки по умолчанию: (ключ в строке экспорта, заголовок)
+DEFAULT_EXPORT_COLUMNS = list(zip(['NAME', 'LAST_NAME', 'PHONE', 'EMAIL', 'COMPANY'], EXPORT_HEADERS))
 
 class BaseExporter(ABC):
     """абстрактный базовый класс для экспорта в разные форматы"""
+    content_type = 'application/octet-stream'
+    file_extension = ''
+    # отдаётся ли файл кусками по мере чтения контактов (и асинхронно, через aexport)
+    streaming = False
+
+    def __init__(self, columns: Optional[List[Tuple[str, str]]] = None):
+        # выбранные пользователем поля; ID в строке экспорта есть всегда, в колонки он не входит
+        self.columns = columns or DEFAULT_EXPORT_COLUMNS
+
+    @property
+    def headers(self) -> List[str]:
+        return [header for _, header in self.columns]
+
+    @property
+    def filename(self) -> str:
+        return f'contact_export.{self.file_extension}'
+
+    def export(self, contacts: Iterable[Dict[str, Any]]) -> HttpResponse:
+        """файл собирается во временном файле (формату нужен весь файл, например для метаданных
+        в конце) и отдаётся клиенту кусками; файл удаляется сам после закрытия ответа"""
+        file = tempfile.TemporaryFile()
+        try:
+            self.write(contacts, file)
+        except Exception:
+            file.close()
+            raise
+        file.seek(0)
+        return FileResponse(file, as_attachment=True, filename=self.filename, content_type=self.content_type)
+
     @abstractmethod
-    def export(self,contacts: List[Dict[str,Any]]) -> HttpResponse:
+    def write(self, contacts: Iterable[Dict[str, Any]], file) -> None:
+        """запись файла экспорта в открытый бинарный файл (для фоновых задач)"""
         pass
+
     def _prepare_contact_data(self, contact: Dict[str,Any]) -> Dict[str,str]:
         """подготовка данных контакта к экспорту"""
-        return {
-            'имя': contact.get('NAME', ''),
-            'фамилия': contact.get('LAST_NAME', ''),
-            'номер телефона': contact.get('PHONE', ''),
-            'почта': contact.get('EMAIL', ''),
-            'компания': contact.get('COMPANY', ''),
-        }
-
-class  CSVExporter(BaseExporter):
-    """Экспортирует в .csv формат"""
-    def export(self,contacts: List[Dict[str,Any]]) -> HttpResponse:
-        response = HttpResponse(content_type='text/csv; charset=utf-16')
-        response['Content-Disposition'] = 'attachment; filename="contact_export.csv"'
-
-        fieldnames = ['имя', 'фамилия', 'номер телефона', 'почта', 'компания']
-        writer = csv.DictWriter(response, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for contact in contacts:
-            contact_data = self._prepare_contact_data(contact)
-            writer.writerow(contact_data)
+        return {header: contact.get(key, '') for key, header in self.columns}
+
+class _Echo:
+    """псевдо-файл для csv.writer: вместо записи возвращает переданную строку"""
+    def write(self, value: str) -> str:
+        return value
+
+
+class _ChunkStream(ABC):
+    """кодирование файла по кускам строк: начало файла, очередной кусок, конец файла"""
+
+    def begin(self) -> bytes:
+        return b''
+
+    @abstractmethod
+    def encode(self, contacts: List[Dict[str, Any]]) -> bytes:
+        pass
+
+    def end(self) -> bytes:
+        return b''
+
+
+def _iter_pages(contacts: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    page = []
+    for contact in contacts:
+        page.append(contact)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+class _StreamingExporter(BaseExporter):
+    """экспортер, который отдаёт файл клиенту кусками по мере чтения контактов"""
+    streaming = True
+    # сколько строк копить перед отправкой очередного куска (размер страницы bitrix)
+    rows_per_chunk = 50
+
+    def export(self, contacts: Iterable[Dict[str, Any]]) -> StreamingHttpResponse:
+        # файл формируется уже при отдаче ответа, там же и замеряется
+        chunks = metrics.timed_iter(metrics.SPAN_RENDER, self._iter_chunks(contacts))
+        return self._streaming_response(chunks)
+
+    def aexport(self, pages: AsyncIterable[List[Dict[str, Any]]]) -> StreamingHttpResponse:
+        """то же, что export, для асинхронного view: строки приходят асинхронно, страницами"""
+        return self._streaming_response(self._aiter_chunks(pages))
+
+    def write(self, contacts: Iterable[Dict[str, Any]], file) -> None:
+        with metrics.span(metrics.SPAN_RENDER):
+            for chunk in self._iter_chunks(contacts):
+                file.write(chunk)
+
+    def _streaming_response(self, chunks) -> StreamingHttpResponse:
+        response = StreamingHttpResponse(chunks, content_type=self.content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.filename}"'
         return response
 
+    def _iter_chunks(self, contacts: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+        stream = self._open_stream()
+        # начало файла (заголовок csv) уходит сразу, ещё до первой строки
+        yield stream.begin()
+        for page in _iter_pages(contacts, self.rows_per_chunk):
+            chunk = stream.encode(page)
+            if chunk:
+                yield chunk
+        yield stream.end()
+
+    async def _aiter_chunks(self, pages: AsyncIterable[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+        stream = self._open_stream()
+        # время кодирования копится отдельно от ожидания страниц
+        total = 0.0
+        try:
+            started = time.perf_counter()
+            chunk = stream.begin()
+            total += time.perf_counter() - started
+            yield chunk
+            async for page in pages:
+                started = time.perf_counter()
+                chunk = stream.encode(page)
+                total += time.perf_counter() - started
+                if chunk:
+                    yield chunk
+            started = time.perf_counter()
+            chunk = stream.end()
+            total += time.perf_counter() - started
+            yield chunk
+        finally:
+            metrics.record_span(metrics.SPAN_RENDER, total)
+
+    @abstractmethod
+    def _open_stream(self) -> _ChunkStream:
+        pass
+
+
+class _CSVStream(_ChunkStream):
+    def __init__(self, exporter: 'CSVExporter'):
+        self.exporter = exporter
+        # инкрементальный кодировщик пишет BOM только один раз, в начале файла
+        self.encoder = codecs.getincrementalencoder(exporter.encoding)()
+        self.writer = csv.DictWriter(_Echo(), fieldnames=exporter.headers)
+
+    def begin(self) -> bytes:
+        return self.encoder.encode(self.writer.writeheader())
+
+    def encode(self, contacts: List[Dict[str, Any]]) -> bytes:
+        prepare = self.exporter._prepare_contact_data
+        return self.encoder.encode(''.join(self.writer.writerow(prepare(contact)) for contact in contacts))
+
+    def end(self) -> bytes:
+        return self.encoder.encode('', final=True)
+
+
+class  CSVExporter(_StreamingExporter):
+    """Экспортирует в .csv формат потоком, не накапливая файл в памяти"""
+    content_type = 'text/csv; charset=utf-16'
+    file_extension = 'csv'
+    encoding = 'utf-16'
+
+    def _open_stream(self) -> _ChunkStream:
+        return _CSVStream(self)
+
 class ExcelExporter(BaseExporter):
-    """Экспорт в .xlsx формат"""
-
-    def export(self,contacts: List[Dict[str,Any]]) -> HttpResponse:
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = 'Контакты'
-
-        # заголовки
-        headers = ['имя', 'фамилия', 'номер телефона', 'почта', 'компания']
-        for col_num,  header in enumerate(headers,1):
-            ws.cell(row=1, column=col_num,value=header)
-
-        # данные
-        for row_num, contact in enumerate(contacts,2):
-            contact_data = self._prepare_contact_data(contact)
-            for header_index, header_title in enumerate(headers,1):
-                ws.cell(row=row_num, column=header_index,value=contact_data[header_title] or '')
-
-        # автоподбор ширрины колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
+    """Экспорт в .xlsx формат через write-only книгу openpyxl"""
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    file_extension = 'xlsx'
+    max_column_width = 50
+
+    def write(self, contacts: Iterable[Dict[str, Any]], file) -> None:
+        """записывает контакты в книгу за один проход по данным"""
+        with metrics.span(metrics.SPAN_RENDER):
+            self._write_workbook(contacts, file)
+
+    def _write_workbook(self, contacts: Iterable[Dict[str, Any]], file) -> None:
+        # write-only лист принимает ширину колонок только до первой строки,
+        # поэтому строки сначала сбрасываются в спул-файл, а ширина считается по пути
+        widths = [len(header) for header in self.headers]
+        with tempfile.TemporaryFile() as spool:
+            for contact in contacts:
+                contact_data = self._prepare_contact_data(contact)
+                row = [contact_data[header] or '' for header in self.headers]
+                for column_index, value in enumerate(row):
+                    value_length = len(str(value))
+                    if value_length > widths[column_index]:
+                        widths[column_index] = value_length
+                pickle.dump(row, spool, protocol=pickle.HIGHEST_PROTOCOL)
+
+            wb = openpyxl.Workbook(write_only=True)
+            ws = wb.create_sheet('Контакты')
+            # автоподбор ширины колонок
+            for column_index, width in enumerate(widths, 1):
+                ws.column_dimensions[get_column_letter(column_index)].width = min(width + 2, self.max_column_width)
+
+            ws.append(self.headers)
+            spool.seek(0)
+            while True:
                 try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except Exception as e:
-                    raise ValueError(f'ошибка при обработке строки: {str(e)}')
-                adjusted_width = min(max_length + 2, 50)
-                ws.column_dimensions[column_letter].width = adjusted_width
+                    ws.append(pickle.load(spool))
+                except EOFError:
+                    break
+            wb.save(file)
 
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename="contact_export.xlsx"'
+class GzipCSVExporter(CSVExporter):
+    """csv, сжатый gzip на лету: сжимается каждый кусок, в памяти только состояние компрессора"""
+    content_type = 'application/gzip'
+    file_extension = 'csv.gz'
+    # utf-8 вдвое компактнее utf-16 на латинице и цифрах, BOM оставлен для excel
+    encoding = 'utf-8-sig'
+    compress_level = 6
+
+    def _open_stream(self) -> _ChunkStream:
+        return _GzipStream(super()._open_stream(), self.compress_level)
+
+
+class _GzipStream(_ChunkStream):
+    def __init__(self, stream: _ChunkStream, compress_level: int):
+        self.stream = stream
+        # wbits=31 - формат gzip (заголовок и контрольная сумма), а не голый zlib
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+
+    def begin(self) -> bytes:
+        return self.compressor.compress(self.stream.begin())
+
+    def encode(self, contacts: List[Dict[str, Any]]) -> bytes:
+        return self.compressor.compress(self.stream.encode(contacts))
+
+    def end(self) -> bytes:
+        return self.compressor.compress(self.stream.end()) + self.compressor.flush()
+
+
+class _MachineExporter(BaseExporter):
+    """форматы для обработки данных: ключи - имена полей bitrix в нижнем регистре, ID числом"""
+
+    @property
+    def record_keys(self) -> List[str]:
+        return ['id'] + [key.lower() for key, _ in self.columns]
+
+    def _machine_record(self, contact: Dict[str, Any]) -> Dict[str, Any]:
+        record = {'id': int(contact['ID']) if contact.get('ID') else None}
+        for key, _ in self.columns:
+            record[key.lower()] = contact.get(key) or None
+        return record
+
+
+class NDJSONExporter(_StreamingExporter, _MachineExporter):
+    """по одному json-объекту контакта на строку, потоком"""
+    content_type = 'application/x-ndjson; charset=utf-8'
+    file_extension = 'ndjson'
+
+    def _open_stream(self) -> _ChunkStream:
+        return _NDJSONStream(self)
+
+
+class _NDJSONStream(_ChunkStream):
+    def __init__(self, exporter: NDJSONExporter):
+        self.exporter = exporter
+
+    def encode(self, contacts: List[Dict[str, Any]]) -> bytes:
+        lines = [json.dumps(self.exporter._machine_record(contact), ensure_ascii=False) for contact in contacts]
+        return ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+
+
+class ParquetExporter(_MachineExporter):
+    """parquet группами строк: в памяти только текущая группа, а не весь портал"""
+    content_type = 'application/vnd.apache.parquet'
+    file_extension = 'parquet'
+    row_group_size = 10000
+
+    def write(self, contacts: Iterable[Dict[str, Any]], file) -> None:
+        pa, pq = _import_pyarrow()
+        schema = pa.schema([('id', pa.int64())] + [(key, pa.string()) for key in self.record_keys[1:]])
+        with metrics.span(metrics.SPAN_RENDER):
+            writer = pq.ParquetWriter(file, schema)
+            try:
+                columns = {key: [] for key in schema.names}
+                for contact in contacts:
+                    for key, value in self._machine_record(contact).items():
+                        columns[key].append(value)
+                    if len(columns['id']) >= self.row_group_size:
+                        writer.write_table(pa.table(columns, schema=schema))
+                        columns = {key: [] for key in schema.names}
+                if columns['id']:
+                    writer.write_table(pa.table(columns, schema=schema))
+            finally:
+                writer.close()
+
+
+def _import_pyarrow():
+    """pyarrow нужен только для parquet, поэтому импортируется при первом экспорте в этот формат"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('для экспорта в parquet нужен пакет pyarrow')
+    return pyarrow, pyarrow.parquet
 
-        wb.save(response)
-        return response
 
 class ExporterFactory:
     """фабрика для создания экспортеров"""
@@ -80,13 +321,18 @@ class ExporterFactory:
     }
 
     @classmethod
-    def get_exporter(cls, format_type: str) -> BaseExporter:
+    def get_exporter(cls, format_type: str, columns: Optional[List[Tuple[str, str]]] = None) -> BaseExporter:
         exporter_class = cls._exporters.get(format_type)
         if not exporter_class:
             raise ValueError(f'Неиспользуемый формат экспорта: {format_type}')
-        return exporter_class()
+        return exporter_class(columns)
 
     @classmethod
     def register_exporter(cls, format_type:str, exporter_class):
         """метод для регистрации новых экспортеров"""
-        cls._exporters[format_type] = exporter_class
\ No newline at end of file
+        cls._exporters[format_type] = exporter_class
+
+
+ExporterFactory.register_exporter('csv.gz', GzipCSVExporter)
+ExporterFactory.register_exporter('ndjson', NDJSONExporter)
+ExporterFactory.register_exporter('parquet', ParquetExporter)
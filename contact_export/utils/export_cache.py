@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import IO, Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+
+from contact_export.models import ContactMirrorState, MirroredContact
+from . import metrics
+from .async_bitrix import acall_api_method
+from .batch_scheduler import call_api_method
+from .company_directory import CompanyDirectory
+from .contact_mirror import async_sync_contact_mirror, export_uses_mirror, sync_contact_mirror
+from .export_options import ExportOptions
+from .portal import get_portal_id
+
+# готовые файлы экспорта лежат на локальном диске процесса
+EXPORT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'contact_export_cache')
+# сколько места может занимать кэш; сверх этого удаляются файлы, которые дольше всех не отдавались
+EXPORT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# расширение недописанного файла: такие файлы не отдаются и не учитываются при вытеснении
+_PARTIAL_SUFFIX = '.partial'
+
+_evict_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def export_watermark(but, options: ExportOptions, company_directory: CompanyDirectory) -> str:
+    """отметка состояния данных экспорта: меняется, как только меняются контакты или компании
+
+    если экспорт читается из зеркала, зеркало догружается дельтой (один запрос, когда изменений нет),
+    а отметка - DATE_MODIFY последнего изменённого контакта и число контактов в зеркале.
+    без зеркала это один crm.contact.list с фильтром экспорта: DATE_MODIFY последнего изменённого
+    контакта и total. число контактов нужно, чтобы удаление контакта тоже меняло отметку
+    """
+    portal_id = get_portal_id(but)
+    if export_uses_mirror(but, options):
+        contacts = _mirror_watermark(portal_id, sync_contact_mirror(but))
+    else:
+        contacts = _list_watermark(call_api_method(but, 'crm.contact.list', _watermark_list_params(options)))
+    return f'{contacts};{_companies_watermark(company_directory)}'
+
+
+async def aexport_watermark(but, options: ExportOptions, company_directory: CompanyDirectory) -> str:
+    """то же, что export_watermark, для асинхронного экспорта"""
+    portal_id = get_portal_id(but)
+    if await sync_to_async(export_uses_mirror)(but, options):
+        state = await async_sync_contact_mirror(but)
+        contacts = await sync_to_async(_mirror_watermark)(portal_id, state)
+    else:
+        contacts = _list_watermark(await acall_api_method(but, 'crm.contact.list', _watermark_list_params(options)))
+    return f'{contacts};{_companies_watermark(company_directory)}'
+
+
+def _mirror_watermark(portal_id: int, state: ContactMirrorState) -> str:
+    count = MirroredContact.objects.filter(bitrix_portal_id=portal_id).count()
+    # из базы отметка возвращается в utc, а сразу после синхронизации - в поясе портала
+    return f'{state.watermark.timestamp() if state.watermark else ""}/{count}'
+
+
+def _watermark_list_params(options: ExportOptions) -> Dict[str, Any]:
+    return {
+        'select': ['ID', 'DATE_MODIFY'],
+        'filter': options.filter.to_bitrix_filter(),
+        'order': {'DATE_MODIFY': 'DESC'},
+    }
+
+
+def _list_watermark(response: Dict[str, Any]) -> str:
+    result = response.get('result') or []
+    return f'{result[0]["DATE_MODIFY"] if result else ""}/{response.get("total", len(result))}'
+
+
+def _companies_watermark(company_directory: CompanyDirectory) -> str:
+    # названия компаний попадают в файл, их переименование тоже должно сбрасывать кэш
+    return f'{company_directory.last_modified or ""}/{len(company_directory.titles_by_id)}'
+
+
+def export_cache_key(
+        portal_id: int, user_id: int, exporter_format: str, options: ExportOptions, watermark: str) -> str:
+    """ключ готового файла: портал, пользователь, формат, параметры экспорта и отметка состояния данных
+
+    bitrix отбирает контакты по правам пользователя в crm, поэтому файл одного пользователя
+    другому не отдаётся
+    """
+    payload = json.dumps(
+        [portal_id, user_id, exporter_format, options.to_dict(), watermark], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """совпадает ли ETag с заголовком If-None-Match клиента
+
+    "*" не совпадает ни с чем: клиент, у которого нет файла, должен получить файл, а не 304
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    # слабое сравнение: W/"..." совпадает с "..."
+    return any(candidate.removeprefix('W/') == etag for candidate in candidates)
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(EXPORT_CACHE_DIR, key)
+
+
+def open_cached_export(key: str) -> Optional[IO[bytes]]:
+    """открытый файл из кэша или None; отданный файл становится самым свежим для вытеснения"""
+    path = _cache_path(key)
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        metrics.increment(metrics.COUNTER_EXPORT_CACHE_MISSES)
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        # файл могли вытеснить между открытием и обновлением времени, открытый дескриптор это переживёт
+        pass
+    metrics.increment(metrics.COUNTER_EXPORT_CACHE_HITS)
+    return file
+
+
+def cache_streaming_export(key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """отдаёт куски файла клиенту и параллельно пишет их в кэш
+
+    файл попадает в кэш, только если ответ сформирован до конца: при обрыве соединения
+    или ошибке экспорта недописанный файл удаляется
+    """
+    partial = _open_partial()
+    complete = False
+    try:
+        with partial:
+            for chunk in chunks:
+                partial.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        _close_partial(key, partial, complete)
+
+
+async def acache_streaming_export(key: str, chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """то же, что cache_streaming_export, для асинхронного ответа"""
+    partial = _open_partial()
+    complete = False
+    try:
+        with partial:
+            async for chunk in chunks:
+                partial.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        _close_partial(key, partial, complete)
+
+
+def _open_partial() -> IO[bytes]:
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=EXPORT_CACHE_DIR, suffix=_PARTIAL_SUFFIX, delete=False)
+
+
+def _close_partial(key: str, partial: IO[bytes], complete: bool) -> None:
+    if complete:
+        # переименование атомарно: параллельный запрос увидит либо старый файл, либо целиком новый
+        os.replace(partial.name, _cache_path(key))
+        evict_export_cache()
+    else:
+        os.unlink(partial.name)
+
+
+def evict_export_cache(max_bytes: Optional[int] = None) -> int:
+    """удаляет файлы, которые дольше всех не отдавались, пока кэш не уложится в max_bytes"""
+    max_bytes = EXPORT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _evict_lock:
+        entries = []
+        for entry in os.scandir(EXPORT_CACHE_DIR):
+            if entry.name.endswith(_PARTIAL_SUFFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+    if evicted:
+        logger.info('из кэша экспорта удалено файлов: %s', evicted)
+    return evicted
@@ -0,0 +1,107 @@
+import logging
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from django.core.files import File
+from django.db import close_old_connections
+from django.utils import timezone
+
+from contact_export.models import ExportJob
+from .company_directory import get_company_directory
+from .contact_mirror import iter_export_rows
+from .exorter_module import ExporterFactory
+from .export_options import ExportOptions
+from . import metrics
+from .portal import get_portal_id
+
+# сколько экспортов может выполняться одновременно в одном процессе
+EXPORT_JOB_WORKERS = 2
+# как часто (в секундах) сохранять прогресс задачи в базу
+EXPORT_JOB_PROGRESS_INTERVAL = 1.0
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix='contact_export_job')
+
+logger = logging.getLogger(__name__)
+
+
+class _ExportJobProgress:
+    """счётчики прогресса задачи, которые периодически сбрасываются в базу"""
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.pages_fetched = 0
+        self.rows_written = 0
+        self._saved_at = 0.0
+
+    def page_fetched(self, _page_size: int) -> None:
+        self.pages_fetched += 1
+        self.save()
+
+    def count_rows(self, contacts: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        for contact in contacts:
+            yield contact
+            self.rows_written += 1
+
+    def save(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._saved_at < EXPORT_JOB_PROGRESS_INTERVAL:
+            return
+        self._saved_at = now
+        ExportJob.objects.filter(id=self.job_id).update(
+            pages_fetched=self.pages_fetched,
+            rows_written=self.rows_written,
+        )
+
+
+def enqueue_export_job(but, exporter_format: str, options: Optional[ExportOptions] = None) -> ExportJob:
+    """создаёт задачу экспорта и ставит её в очередь фонового пула"""
+    # неизвестный формат должен отсекаться сразу, а не в фоне
+    ExporterFactory.get_exporter(exporter_format)
+    job = ExportJob.objects.create(
+        bitrix_portal_id=get_portal_id(but),
+        bitrix_user_id=but.user_id,
+        exporter_format=exporter_format,
+        export_options=(options or ExportOptions()).to_dict(),
+    )
+    _executor.submit(run_export_job, job.id, but)
+    return job
+
+
+def run_export_job(job_id: int, but) -> None:
+    """выполняет задачу экспорта: выгрузка контактов, запись файла, сохранение результата"""
+    # все замеры задачи (в том числе из потоков batch-ей) собираются в одну запись метрик
+    with metrics.traced('export_job', get_portal_id(but)):
+        progress = _ExportJobProgress(job_id)
+        try:
+            ExportJob.objects.filter(id=job_id).update(status=ExportJob.STATUS_RUNNING)
+            job = ExportJob.objects.get(id=job_id)
+            options = ExportOptions.from_dict(job.export_options)
+            exporter = ExporterFactory.get_exporter(job.exporter_format, columns=options.columns())
+
+            company_dict = get_company_directory(but).titles_by_id
+            contacts = progress.count_rows(iter_export_rows(
+                but, company_dict, options, on_page=progress.page_fetched))
+            with tempfile.TemporaryFile() as file:
+                exporter.write(contacts, file)
+                file.seek(0)
+                job.result_file.save(f'contact_export_{job_id}.{exporter.file_extension}', File(file), save=False)
+
+            progress.save(force=True)
+            ExportJob.objects.filter(id=job_id).update(
+                status=ExportJob.STATUS_DONE,
+                result_file=job.result_file.name,
+                finished_at=timezone.now(),
+            )
+        except Exception as e:
+            logger.exception('ошибка фонового экспорта #%s', job_id)
+            progress.save(force=True)
+            ExportJob.objects.filter(id=job_id).update(
+                status=ExportJob.STATUS_FAILED,
+                error=str(e),
+                finished_at=timezone.now(),
+            )
+        finally:
+            # поток пула живёт долго, соединение с базой за собой нужно закрывать
+            close_old_connections()
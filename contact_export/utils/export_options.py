@@ -0,0 +1,220 @@
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from .company_directory import CompanyDirectory
+
+# поля, которые можно выбрать для экспорта, и их заголовки в файле
+EXPORT_FIELD_HEADERS = {
+    'NAME': 'имя',
+    'LAST_NAME': 'фамилия',
+    'PHONE': 'номер телефона',
+    'EMAIL': 'почта',
+    'COMPANY': 'компания',
+}
+# мультиполя, у которых можно выгрузить несколько значений
+MULTIFIELDS = ['PHONE', 'EMAIL']
+MAX_MULTIFIELD_VALUES = 5
+
+# поля crm.contact.list, нужные для каждого поля экспорта
+_BITRIX_SELECT = {
+    'NAME': ['NAME'],
+    'LAST_NAME': ['LAST_NAME'],
+    'PHONE': ['PHONE'],
+    'EMAIL': ['EMAIL'],
+    'COMPANY': ['COMPANY_ID'],
+}
+
+
+def multifield_key(field: str, index: int) -> str:
+    """ключ index-го (с 0) значения мультиполя в строке экспорта: PHONE, PHONE_2, PHONE_3..."""
+    return field if index == 0 else f'{field}_{index + 1}'
+
+
+def _parse_date(value: Optional[str], name: str) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'неверная дата в поле "{name}": {value}')
+
+
+def _parse_flag(value: Optional[str]) -> Optional[bool]:
+    """'Y' - есть, 'N' - нет, пусто - не важно"""
+    if value == 'Y':
+        return True
+    if value == 'N':
+        return False
+    return None
+
+
+class ExportFilter:
+    """фильтр экспорта; переводится и в FILTER crm.contact.list, и в запрос к зеркалу контактов"""
+
+    def __init__(
+            self,
+            company_id: Optional[str] = None,
+            date_create_from: Optional[date] = None,
+            date_create_to: Optional[date] = None,
+            date_modify_from: Optional[date] = None,
+            date_modify_to: Optional[date] = None,
+            has_phone: Optional[bool] = None,
+            has_email: Optional[bool] = None,
+    ):
+        self.company_id = company_id
+        self.date_create_from = date_create_from
+        self.date_create_to = date_create_to
+        self.date_modify_from = date_modify_from
+        self.date_modify_to = date_modify_to
+        self.has_phone = has_phone
+        self.has_email = has_email
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.to_dict().values())
+
+    def _date_ranges(self) -> List[Tuple[str, str, Optional[date], Optional[date]]]:
+        return [
+            ('DATE_CREATE', 'date_create', self.date_create_from, self.date_create_to),
+            ('DATE_MODIFY', 'date_modify', self.date_modify_from, self.date_modify_to),
+        ]
+
+    def to_bitrix_filter(self) -> Dict[str, Any]:
+        """FILTER для crm.contact.list: отбор идёт на стороне bitrix"""
+        bitrix_filter = {}
+        if self.company_id:
+            bitrix_filter['=COMPANY_ID'] = self.company_id
+        # дату без времени bitrix понимает в часовом поясе пользователя, а зеркало - в TIME_ZONE проекта,
+        # поэтому границы дней уходят со смещением: оба источника отбирают одни и те же контакты.
+        # конец диапазона включительно
+        for field, _, date_from, date_to in self._date_ranges():
+            if date_from:
+                bitrix_filter[f'>={field}'] = _start_of_day(date_from).isoformat()
+            if date_to:
+                bitrix_filter[f'<{field}'] = _start_of_day(date_to + timedelta(days=1)).isoformat()
+        if self.has_phone is not None:
+            bitrix_filter['HAS_PHONE'] = 'Y' if self.has_phone else 'N'
+        if self.has_email is not None:
+            bitrix_filter['HAS_EMAIL'] = 'Y' if self.has_email else 'N'
+        return bitrix_filter
+
+    def filter_queryset(self, contacts: QuerySet) -> QuerySet:
+        """тот же отбор для зеркала: условия уходят в WHERE запроса к базе"""
+        if self.company_id:
+            contacts = contacts.filter(company_id=self.company_id)
+        for _, field, date_from, date_to in self._date_ranges():
+            if date_from:
+                contacts = contacts.filter(**{f'{field}__gte': _start_of_day(date_from)})
+            if date_to:
+                contacts = contacts.filter(**{f'{field}__lt': _start_of_day(date_to + timedelta(days=1))})
+        for field, flag in [('phones', self.has_phone), ('emails', self.has_email)]:
+            if flag is True:
+                contacts = contacts.exclude(**{field: []})
+            elif flag is False:
+                contacts = contacts.filter(**{field: []})
+        return contacts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'company_id': self.company_id,
+            'date_create_from': self.date_create_from.isoformat() if self.date_create_from else None,
+            'date_create_to': self.date_create_to.isoformat() if self.date_create_to else None,
+            'date_modify_from': self.date_modify_from.isoformat() if self.date_modify_from else None,
+            'date_modify_to': self.date_modify_to.isoformat() if self.date_modify_to else None,
+            'has_phone': self.has_phone,
+            'has_email': self.has_email,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ExportFilter':
+        return cls(
+            company_id=data.get('company_id'),
+            date_create_from=_parse_date(data.get('date_create_from'), 'создан с'),
+            date_create_to=_parse_date(data.get('date_create_to'), 'создан по'),
+            date_modify_from=_parse_date(data.get('date_modify_from'), 'изменён с'),
+            date_modify_to=_parse_date(data.get('date_modify_to'), 'изменён по'),
+            has_phone=data.get('has_phone'),
+            has_email=data.get('has_email'),
+        )
+
+
+def _start_of_day(day: date) -> datetime:
+    """начало дня в часовом поясе проекта (TIME_ZONE)"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class ExportOptions:
+    """что выгружать: фильтр, набор полей и число значений телефона и почты"""
+
+    def __init__(
+            self,
+            export_filter: Optional[ExportFilter] = None,
+            fields: Optional[List[str]] = None,
+            multifield_limit: int = 1,
+    ):
+        self.filter = export_filter or ExportFilter()
+        self.fields = [field for field in EXPORT_FIELD_HEADERS if field in (fields or EXPORT_FIELD_HEADERS)]
+        self.multifield_limit = multifield_limit
+
+    def columns(self) -> List[Tuple[str, str]]:
+        """колонки файла: (ключ в строке экспорта, заголовок)"""
+        columns = []
+        for field in self.fields:
+            header = EXPORT_FIELD_HEADERS[field]
+            if field in MULTIFIELDS:
+                for index in range(self.multifield_limit):
+                    columns.append((multifield_key(field, index), header if index == 0 else f'{header} {index + 1}'))
+            else:
+                columns.append((field, header))
+        return columns
+
+    def bitrix_select(self) -> List[str]:
+        """select для crm.contact.list: только то, что попадёт в файл"""
+        select = ['ID']
+        for field in self.fields:
+            select.extend(_BITRIX_SELECT[field])
+        return select
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'filter': self.filter.to_dict(), 'fields': self.fields, 'multifield_limit': self.multifield_limit}
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> 'ExportOptions':
+        data = data or {}
+        return cls(
+            export_filter=ExportFilter.from_dict(data.get('filter') or {}),
+            fields=data.get('fields'),
+            multifield_limit=data.get('multifield_limit') or 1,
+        )
+
+    @classmethod
+    def from_request(cls, data, company_directory: CompanyDirectory) -> 'ExportOptions':
+        """параметры формы экспорта; ValueError с понятным пользователю текстом, если они неверны"""
+        company_id = None
+        company_name = (data.get('company') or '').strip()
+        if company_name:
+            company_id = company_directory.id_by_name(company_name)
+            if company_id is None:
+                raise ValueError(f'компания "{company_name}" не найдена')
+
+        export_filter = ExportFilter(
+            company_id=company_id,
+            date_create_from=_parse_date(data.get('date_create_from'), 'создан с'),
+            date_create_to=_parse_date(data.get('date_create_to'), 'создан по'),
+            date_modify_from=_parse_date(data.get('date_modify_from'), 'изменён с'),
+            date_modify_to=_parse_date(data.get('date_modify_to'), 'изменён по'),
+            has_phone=_parse_flag(data.get('has_phone')),
+            has_email=_parse_flag(data.get('has_email')),
+        )
+
+        fields = [field for field in data.getlist('fields') if field in EXPORT_FIELD_HEADERS]
+        if 'fields' in data and not fields:
+            raise ValueError('не выбрано ни одного поля для экспорта')
+
+        multifield_limit = data.get('multifield_limit') or '1'
+        if not multifield_limit.isdigit() or not 1 <= int(multifield_limit) <= MAX_MULTIFIELD_VALUES:
+            raise ValueError(f'число телефонов и почт должно быть от 1 до {MAX_MULTIFIELD_VALUES}')
+        return cls(export_filter, fields or None, int(multifield_limit))
+
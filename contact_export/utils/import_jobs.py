@@ -0,0 +1,246 @@
+import csv
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import TextIOWrapper
+from typing import Any, Dict, List, Tuple
+
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from contact_export.models import ImportJob
+from .company_directory import get_company_directory
+from .company_resolver import CompanyResolver
+from .contact_normalizer import IMPORT_COLUMNS
+from .import_journal import ImportJournal, compute_file_hash
+from .import_pipeline import IMPORT_MODE_CREATE, IMPORT_MODE_UPSERT, ImportPipeline, ImportResult, contact_index_class
+from .importer_module import iter_imported_file
+from . import metrics
+from .portal import get_portal_id
+
+# сколько импортов может выполняться одновременно в одном процессе
+IMPORT_JOB_WORKERS = 2
+# как часто (в секундах) сохранять прогресс задачи в базу
+IMPORT_JOB_PROGRESS_INTERVAL = 1.0
+# на сколько продлевается аренда задачи при каждом сохранении прогресса; задачу без живой аренды
+# (процесс упал или перезапущен) можно запустить повторно из любого процесса
+IMPORT_JOB_LEASE = timedelta(minutes=5)
+# как часто аренда продлевается в фоне, пока задача выполняется: словарь компаний и индекс дубликатов
+# большого портала строятся дольше IMPORT_JOB_LEASE, а прогресс до начала отправки не сохраняется
+IMPORT_JOB_LEASE_RENEW_INTERVAL = timedelta(minutes=1)
+
+# заголовок отчёта об ошибках: все колонки, которые понимает импорт (с внешним кодом), плюс текст ошибки.
+# исправленный отчёт загружается обратно как файл импорта, колонку ошибки импорт пропускает
+ERROR_REPORT_HEADERS = list(IMPORT_COLUMNS) + ['ошибка']
+
+_executor = ThreadPoolExecutor(max_workers=IMPORT_JOB_WORKERS, thread_name_prefix='contact_import_job')
+
+logger = logging.getLogger(__name__)
+
+
+class ImportJobLeaseLost(Exception):
+    """аренду задачи перехватил другой запуск: этот запуск останавливается, ничего не записывая"""
+
+
+class _ImportJobProgress:
+    """сбрасывает счётчики импорта в базу не чаще IMPORT_JOB_PROGRESS_INTERVAL и продлевает аренду"""
+
+    def __init__(self, job_id: int, lease_owner: str):
+        self.job_id = job_id
+        self.lease_owner = lease_owner
+        self._saved_at = 0.0
+        self._lock = threading.Lock()
+
+    def save(self, result: ImportResult, force: bool = False) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._saved_at < IMPORT_JOB_PROGRESS_INTERVAL:
+                return
+            self._saved_at = now
+        saved = ImportJob.objects.filter(id=self.job_id, lease_owner=self.lease_owner).update(
+            locked_until=timezone.now() + IMPORT_JOB_LEASE,
+            rows_processed=result.total_count,
+            success_count=result.success_count,
+            updated_count=result.updated_count,
+            unchanged_count=result.unchanged_count,
+            duplicate_count=result.duplicate_count,
+            resumed_count=result.resumed_count,
+            failed_count=len(result.failed_rows),
+        )
+        if not saved:
+            raise ImportJobLeaseLost(f'задача импорта {self.job_id} запущена повторно')
+
+
+class _ImportJobLeaseHeartbeat:
+    """продлевает аренду задачи из фонового потока, пока запуск жив, и замечает её потерю"""
+
+    def __init__(self, job_id: int, lease_owner: str):
+        self.job_id = job_id
+        self.lease_owner = lease_owner
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'contact_import_job_lease_{job_id}', daemon=True)
+
+    def __enter__(self) -> '_ImportJobLeaseHeartbeat':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def renew(self) -> bool:
+        renewed = ImportJob.objects.filter(id=self.job_id, lease_owner=self.lease_owner).update(
+            locked_until=timezone.now() + IMPORT_JOB_LEASE)
+        if not renewed:
+            self.lost = True
+        return bool(renewed)
+
+    def check(self) -> None:
+        if self.lost:
+            raise ImportJobLeaseLost(f'задача импорта {self.job_id} запущена повторно')
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.wait(IMPORT_JOB_LEASE_RENEW_INTERVAL.total_seconds()):
+                if not self.renew():
+                    return
+        except Exception:
+            logger.exception('не удалось продлить аренду фонового импорта #%s', self.job_id)
+        finally:
+            connection.close()
+
+
+def enqueue_import_job(but, uploaded_file: UploadedFile, mode: str = IMPORT_MODE_CREATE) -> ImportJob:
+    """сохраняет загруженный файл на диск и ставит импорт в очередь фонового пула"""
+    job = ImportJob(
+        bitrix_portal_id=get_portal_id(but),
+        bitrix_user_id=but.user_id,
+        original_name=uploaded_file.name,
+        import_mode=mode,
+        lease_owner=_new_lease_owner(),
+        locked_until=timezone.now() + IMPORT_JOB_LEASE,
+    )
+    job.source_file.save(uploaded_file.name, uploaded_file, save=False)
+    job.save()
+    _executor.submit(run_import_job, job.id, but, job.lease_owner)
+    return job
+
+
+def can_resume_import_job(job: ImportJob) -> bool:
+    """упавшую задачу или задачу, аренда которой истекла (процесс потерян), можно запустить повторно"""
+    if job.status == ImportJob.STATUS_FAILED:
+        return True
+    if job.status in (ImportJob.STATUS_PENDING, ImportJob.STATUS_RUNNING):
+        return job.locked_until is None or job.locked_until <= timezone.now()
+    return False
+
+
+def resume_import_job(but, job: ImportJob) -> bool:
+    """повторный запуск задачи: уже отправленные chunk-и пропускаются по журналу
+
+    задача перехватывается под select_for_update, так что из двух одновременных повторов
+    (в том числе из разных процессов) запускается один; False - задачу запускать нельзя.
+    у upsert журнала нет: уже применённые строки при повторе совпадают с контактами и ничего не стоят
+    """
+    with transaction.atomic():
+        job = ImportJob.objects.select_for_update().get(id=job.id)
+        if not can_resume_import_job(job):
+            return False
+        job.status = ImportJob.STATUS_PENDING
+        job.error = ''
+        job.finished_at = None
+        job.lease_owner = _new_lease_owner()
+        job.locked_until = timezone.now() + IMPORT_JOB_LEASE
+        job.save(update_fields=['status', 'error', 'finished_at', 'lease_owner', 'locked_until'])
+    _executor.submit(run_import_job, job.id, but, job.lease_owner)
+    return True
+
+
+def _new_lease_owner() -> str:
+    return uuid.uuid4().hex
+
+
+def _write_error_report(failed_rows: List[Tuple[Dict[str, Any], str]], file) -> None:
+    """csv с непринятыми строками в той же кодировке, что и экспорт, и с колонками файла импорта"""
+    text = TextIOWrapper(file, encoding='utf-16', newline='')
+    try:
+        writer = csv.writer(text)
+        writer.writerow(ERROR_REPORT_HEADERS)
+        for row, error in failed_rows:
+            writer.writerow([row.get(field) or '' for field in IMPORT_COLUMNS.values()] + [error])
+        text.flush()
+    finally:
+        text.detach()
+
+
+def run_import_job(job_id: int, but, lease_owner: str) -> None:
+    """выполняет задачу импорта и сохраняет отчёт о непринятых строках
+
+    lease_owner - id запуска из enqueue_import_job или resume_import_job; если задачу тем временем
+    перезапустили, аренда у другого запуска и этот запуск завершается, ничего не меняя
+    """
+    # все замеры задачи (в том числе из потоков batch-ей) собираются в одну запись метрик
+    with metrics.traced('import_job', get_portal_id(but)):
+        progress = _ImportJobProgress(job_id, lease_owner)
+        result = None
+        leased = ImportJob.objects.filter(id=job_id, lease_owner=lease_owner)
+        try:
+            if not leased.update(status=ImportJob.STATUS_RUNNING, locked_until=timezone.now() + IMPORT_JOB_LEASE):
+                return
+            job = ImportJob.objects.get(id=job_id)
+
+            # аренда продлевается всё время запуска, в том числе пока строятся словарь и индекс
+            with _ImportJobLeaseHeartbeat(job_id, lease_owner) as heartbeat:
+                company_resolver = CompanyResolver(get_company_directory(but))
+                duplicate_index = contact_index_class(job.import_mode).build(but)
+                heartbeat.check()
+                with open(job.source_file.path, 'rb') as source:
+                    journal = None
+                    if job.import_mode != IMPORT_MODE_UPSERT:
+                        journal = ImportJournal(job.bitrix_portal_id, compute_file_hash(source))
+                    pipeline = ImportPipeline(
+                        but, duplicate_index, company_resolver,
+                        on_chunk_done=progress.save, journal=journal, mode=job.import_mode)
+                    result = pipeline.result
+                    # имя нужно импортёру для определения формата по расширению
+                    pipeline.run(iter_imported_file(File(source, name=job.original_name)))
+                heartbeat.check()
+
+            if result.failed_rows:
+                with tempfile.TemporaryFile() as report:
+                    _write_error_report(result.failed_rows, report)
+                    report.seek(0)
+                    job.error_report.save(f'import_errors_{job_id}.csv', File(report), save=False)
+
+            progress.save(result, force=True)
+            leased.update(
+                status=ImportJob.STATUS_DONE,
+                error_report=job.error_report.name or '',
+                locked_until=None,
+                finished_at=timezone.now(),
+            )
+        except ImportJobLeaseLost:
+            logger.warning('фоновый импорт #%s перезапущен другим запуском, этот запуск остановлен', job_id)
+        except Exception as e:
+            logger.exception('ошибка фонового импорта #%s', job_id)
+            if result is not None:
+                try:
+                    progress.save(result, force=True)
+                except ImportJobLeaseLost:
+                    return
+            leased.update(
+                status=ImportJob.STATUS_FAILED,
+                error=str(e),
+                locked_until=None,
+                finished_at=timezone.now(),
+            )
+        finally:
+            close_old_connections()
@@ -0,0 +1,62 @@
+import hashlib
+from datetime import timedelta
+from typing import Dict, List, Optional, Set
+
+from django.utils import timezone
+
+from contact_export.models import ImportBatchJournal
+
+# сколько помнить отправленные chunk-и: повтор того же файла позже считается новым импортом,
+# а старые записи журнала удаляются при следующем импорте на портал
+IMPORT_JOURNAL_TTL = timedelta(days=7)
+
+
+def compute_file_hash(file) -> str:
+    """sha256 содержимого загруженного файла, файл читается кусками"""
+    file_hash = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks() if hasattr(file, 'chunks') else iter(lambda: file.read(64 * 1024), b''):
+        file_hash.update(chunk)
+    file.seek(0)
+    return file_hash.hexdigest()
+
+
+class ImportJournal:
+    """какие строки файла уже отправлены в портал
+
+    chunk-и нумеруются по позиции строк в файле, поэтому номера совпадают
+    при любом повторе импорта того же файла в пределах IMPORT_JOURNAL_TTL.
+    для каждого отправленного chunk-а помнятся номера строк, которые bitrix не принял:
+    повтор отправляет только их
+    """
+
+    def __init__(self, portal_id: int, file_hash: str):
+        self.portal_id = portal_id
+        self.file_hash = file_hash
+        ImportBatchJournal.objects.filter(
+            bitrix_portal_id=portal_id, created_at__lt=timezone.now() - IMPORT_JOURNAL_TTL).delete()
+        self._failed_rows: Dict[int, Set[int]] = {
+            chunk_index: set(failed_rows)
+            for chunk_index, failed_rows in ImportBatchJournal.objects
+            .filter(bitrix_portal_id=portal_id, file_hash=file_hash)
+            .values_list('chunk_index', 'failed_rows')
+        }
+
+    def pending_rows(self, chunk_index: int) -> Optional[Set[int]]:
+        """None - chunk ещё не отправлялся, иначе номера его строк, которые нужно отправить снова"""
+        return self._failed_rows.get(chunk_index)
+
+    def commit(self, chunk_index: int, contact_ids: List[str], failed_rows: List[int]) -> None:
+        """записывает ответ bitrix на chunk; повтор chunk-а дописывает созданные контакты к прошлым"""
+        entry, created = ImportBatchJournal.objects.get_or_create(
+            bitrix_portal_id=self.portal_id,
+            file_hash=self.file_hash,
+            chunk_index=chunk_index,
+            defaults={'contact_ids': contact_ids, 'failed_rows': failed_rows},
+        )
+        if not created:
+            # повтор отправлял только непринятые строки: те из них, что снова не приняты, и остаются в журнале
+            entry.contact_ids = entry.contact_ids + contact_ids
+            entry.failed_rows = failed_rows
+            entry.save(update_fields=['contact_ids', 'failed_rows'])
+        self._failed_rows[chunk_index] = set(failed_rows)
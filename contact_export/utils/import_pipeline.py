@@ -0,0 +1,476 @@
+import asyncio
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+
+from . import metrics
+from .async_bitrix import arun_batch
+from .batch_scheduler import BATCH_CHUNK_SIZE, BATCH_WORKERS, run_batch
+from .company_resolver import CompanyResolver
+from .contact_normalizer import ERROR_COLUMN, normalize_phone
+from .duplicate_index import ContactDuplicateIndex, ContactUpsertIndex, normalize_email
+from .import_journal import ImportJournal
+
+# сколько готовых chunk-ов может ждать отправки, пока разбор файла идёт дальше
+IMPORT_QUEUE_SIZE = 4
+
+# create - каждая строка без дубликата создаёт контакт; upsert - найденный контакт обновляется,
+# причём отправляются только изменившиеся поля, а контакт без изменений не стоит ни одной команды
+IMPORT_MODE_CREATE = 'create'
+IMPORT_MODE_UPSERT = 'upsert'
+IMPORT_MODES = [IMPORT_MODE_CREATE, IMPORT_MODE_UPSERT]
+
+# chunk в очереди отправки: номер, строки и их номера в chunk-е файла (только у create, который ведёт журнал)
+_QueuedChunk = Tuple[int, List[Dict[str, Any]], Optional[List[int]]]
+# ответ bitrix на chunk для журнала: номер chunk-а, id созданных контактов и номера непринятых строк
+_ChunkRecord = Tuple[int, List[str], Optional[List[int]]]
+
+# поле строки, в которое upsert кладёт id найденного контакта
+MATCHED_ID_FIELD = 'ID'
+
+
+class ImportResult:
+    """итог импорта: счётчики и строки, которые bitrix не принял"""
+
+    def __init__(self):
+        self.total_count = 0
+        self.success_count = 0
+        self.duplicate_count = 0
+        # строки, отбракованные при нормализации (неверный телефон или почта); они же есть в failed_rows
+        self.invalid_count = 0
+        # строки chunk-ов, отправленных ещё при прошлом запуске импорта этого файла
+        self.resumed_count = 0
+        # upsert: сколько из принятых строк обновили существующий контакт и сколько совпали с ним полностью
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.failed_rows: List[Tuple[Dict[str, Any], str]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def submitted_count(self) -> int:
+        return self.success_count + len(self.failed_rows) - self.invalid_count
+
+    def add_invalid_row(self, row: Dict[str, Any], error: str) -> None:
+        with self._lock:
+            self.invalid_count += 1
+            self.failed_rows.append((row, error))
+
+    def add_chunk_results(self, rows: List[Dict[str, Any]], errors: List[Optional[str]]) -> None:
+        with self._lock:
+            for row, error in zip(rows, errors):
+                if error is None:
+                    self.success_count += 1
+                    if row.get(MATCHED_ID_FIELD) is not None:
+                        self.updated_count += 1
+                else:
+                    self.failed_rows.append((row, error))
+
+    def add_unchanged(self, count: int) -> None:
+        with self._lock:
+            self.unchanged_count += count
+
+
+def build_contact_fields(contact_data: Dict[str, Any], company_id: Optional[str]) -> Dict[str, Any]:
+    """поля crm.contact.add из нормализованной строки файла"""
+    return {
+        'NAME': contact_data['NAME'],
+        'LAST_NAME': contact_data['LAST_NAME'],
+        'PHONE': [{'VALUE': contact_data['PHONE'], 'VALUE_TYPE': 'WORK'}] if contact_data['PHONE'] else None,
+        'EMAIL': [{'VALUE': contact_data['EMAIL'], 'VALUE_TYPE': 'WORK'}] if contact_data['EMAIL'] else None,
+        'COMPANY_ID': company_id,
+        'ORIGIN_ID': contact_data.get('ORIGIN_ID'),
+    }
+
+
+def diff_contact_fields(
+        current: Dict[str, Any],
+        contact_data: Dict[str, Any],
+        company_id: Optional[str],
+) -> Dict[str, Any]:
+    """поля crm.contact.update, которые отличаются от текущих значений контакта
+
+    пустая ячейка файла поле не очищает. телефон и почта сравниваются в нормализованном виде:
+    если значения из файла нет среди значений контакта, им заменяется первое значение мультиполя
+    """
+    fields = {}
+    for field in ('NAME', 'LAST_NAME', 'ORIGIN_ID'):
+        value = contact_data.get(field)
+        if value and value != current[field]:
+            fields[field] = value
+    if company_id and company_id != current['COMPANY_ID']:
+        fields['COMPANY_ID'] = company_id
+    for field, normalize in (('PHONE', normalize_phone), ('EMAIL', normalize_email)):
+        value = contact_data.get(field)
+        if not value:
+            continue
+        items = current[field]
+        if any(normalize(item['VALUE']) == normalize(value) for item in items):
+            continue
+        if items:
+            # значение с ID заменяет существующее, без ID - добавилось бы к нему
+            fields[field] = [{'ID': items[0]['ID'], 'VALUE': value, 'VALUE_TYPE': items[0]['VALUE_TYPE']}]
+        else:
+            fields[field] = [{'VALUE': value, 'VALUE_TYPE': 'WORK'}]
+    return fields
+
+
+def contact_index_class(mode: str) -> type:
+    """индекс контактов портала, который нужен импорту в этом режиме"""
+    return ContactUpsertIndex if mode == IMPORT_MODE_UPSERT else ContactDuplicateIndex
+
+
+class ImportPipeline:
+    """импорт в два этапа, работающих одновременно
+
+    поток вызывающего разбирает файл, отсеивает дубликаты и складывает строки
+    в chunk-и по 50 команд; chunk-и через ограниченную очередь забирают потоки
+    отправки, так что время импорта близко к max(разбор, сеть), а не к их сумме
+    """
+
+    def __init__(
+            self,
+            but,
+            duplicate_index: ContactDuplicateIndex,
+            company_resolver: CompanyResolver,
+            chunk_size: int = BATCH_CHUNK_SIZE,
+            workers: int = BATCH_WORKERS,
+            on_chunk_done: Optional[Callable[[ImportResult], None]] = None,
+            journal: Optional[ImportJournal] = None,
+            mode: str = IMPORT_MODE_CREATE,
+    ):
+        self.but = but
+        self.duplicate_index = duplicate_index
+        self.company_resolver = company_resolver
+        self.chunk_size = chunk_size
+        self.workers = workers
+        # вызывается после каждого обработанного chunk-а из того же потока, что пишет журнал
+        self.on_chunk_done = on_chunk_done
+        # журнал отправленных chunk-ов; без него импорт не возобновляемый
+        self.journal = journal
+        # в режиме upsert duplicate_index - ContactUpsertIndex с текущими значениями полей
+        self.mode = mode
+        self.result = ImportResult()
+        self._chunks: 'queue.Queue[Optional[_QueuedChunk]]' = queue.Queue(maxsize=IMPORT_QUEUE_SIZE)
+        # ответы bitrix на chunk-и: журнал и прогресс пишет в базу один поток, а не каждый поток отправки
+        self._records: 'queue.Queue[Optional[_ChunkRecord]]' = queue.Queue()
+        self._errors: List[Exception] = []
+        # создание недостающих компаний и их поиск не должны пересекаться между потоками
+        self._company_lock = threading.Lock()
+        # контакты, которые уже обновляет одна из строк файла
+        self._matched_ids = set()
+        # upsert: изменившиеся строки, ещё не набравшие полный chunk
+        self._pending_rows: List[Dict[str, Any]] = []
+        self._packed_chunks = 0
+
+    def run(self, contacts: Iterable[Dict[str, Any]]) -> ImportResult:
+        # замеры потоков отправки относятся к тому же запросу, что и сам импорт
+        submit_worker = metrics.bind_trace(self._submit_worker)
+        threads = [
+            threading.Thread(target=submit_worker, name=f'contact_import_{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        recorder = threading.Thread(target=self._record_worker, name='contact_import_journal', daemon=True)
+        recorder.start()
+        # время разбора файла копится только на получении строк, без ожидания очереди отправки
+        parsed_contacts = metrics.timed_iter(metrics.SPAN_PARSE, contacts)
+        try:
+            self._produce(parsed_contacts)
+        finally:
+            # недочитанный генератор разбора закрываем сразу, пока исходный файл ещё открыт
+            parsed_contacts.close()
+            for _ in threads:
+                self._chunks.put(None)
+            for thread in threads:
+                thread.join()
+            self._records.put(None)
+            recorder.join()
+            self._count_metrics()
+        if self._errors:
+            raise self._errors[0]
+        return self.result
+
+    def _count_metrics(self) -> None:
+        metrics.increment(metrics.COUNTER_ROWS_PARSED, self.result.total_count)
+        metrics.increment(metrics.COUNTER_DUPLICATES, self.result.duplicate_count)
+        metrics.increment(metrics.COUNTER_INVALID_ROWS, self.result.invalid_count)
+        metrics.increment(metrics.COUNTER_ROWS_IMPORTED, self.result.success_count)
+        metrics.increment(metrics.COUNTER_ROWS_UPDATED, self.result.updated_count)
+        metrics.increment(metrics.COUNTER_ROWS_UNCHANGED, self.result.unchanged_count)
+        metrics.increment(metrics.COUNTER_ROWS_FAILED, len(self.result.failed_rows))
+
+    def _produce(self, contacts: Iterable[Dict[str, Any]]) -> None:
+        # chunk-и режутся по позиции строк в файле, до отсева дубликатов:
+        # так номер chunk-а одинаков при любом повторе импорта и сверяется с журналом
+        chunk_index = 0
+        raw_chunk = []
+        for contact_data in contacts:
+            if self._errors:
+                return
+            self.result.total_count += 1
+            raw_chunk.append(contact_data)
+            if len(raw_chunk) >= self.chunk_size:
+                self._dispatch(chunk_index, raw_chunk)
+                chunk_index += 1
+                raw_chunk = []
+        if raw_chunk:
+            self._dispatch(chunk_index, raw_chunk)
+        if self._pending_rows:
+            self._enqueue((self._packed_chunks, self._pending_rows, None))
+
+    def _dispatch(self, chunk_index: int, raw_chunk: List[Dict[str, Any]]) -> None:
+        # по журналу из уже отправленного chunk-а снова отправляются только строки, которые bitrix не принял
+        pending_rows = self.journal.pending_rows(chunk_index) if self.journal is not None else None
+        if pending_rows is not None and not pending_rows:
+            self.result.resumed_count += len(raw_chunk)
+            return
+        rows = []
+        row_indexes = []
+        with metrics.span(metrics.SPAN_TRANSFORM):
+            for row_index, contact_data in enumerate(raw_chunk):
+                if pending_rows is not None and row_index not in pending_rows:
+                    self.result.resumed_count += 1
+                    continue
+                # строка с ошибкой нормализации в bitrix не отправляется, а сразу уходит в отчёт
+                if contact_data.get(ERROR_COLUMN):
+                    self.result.add_invalid_row(contact_data, contact_data[ERROR_COLUMN])
+                    continue
+                if self.mode == IMPORT_MODE_UPSERT:
+                    contact_data = self._match_existing(contact_data)
+                    if contact_data is not None and self._is_unchanged(contact_data):
+                        self.result.add_unchanged(1)
+                        continue
+                elif self.duplicate_index.find(contact_data['PHONE'], contact_data['EMAIL']):
+                    contact_data = None
+                else:
+                    # повтор внутри самого файла тоже считается дубликатом
+                    self.duplicate_index.add('new', phones=[contact_data['PHONE']], emails=[contact_data['EMAIL']])
+                if contact_data is None:
+                    self.result.duplicate_count += 1
+                    continue
+                rows.append(contact_data)
+                row_indexes.append(row_index)
+        if self.mode == IMPORT_MODE_UPSERT:
+            # журнала у upsert нет, поэтому изменившиеся строки разных chunk-ов файла
+            # упаковываются в полные batch-и: 1% изменений - это 1% команд и столько же batch-ей
+            self._pending_rows.extend(rows)
+            while len(self._pending_rows) >= self.chunk_size:
+                self._enqueue((self._packed_chunks, self._pending_rows[:self.chunk_size], None))
+                self._pending_rows = self._pending_rows[self.chunk_size:]
+                self._packed_chunks += 1
+        elif rows:
+            self._enqueue((chunk_index, rows, row_indexes))
+
+    def _match_existing(self, contact_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """строка с id найденного контакта, строка нового контакта или None для повтора внутри файла"""
+        contact_id = self.duplicate_index.match(contact_data)
+        if contact_id is None:
+            self.duplicate_index.add(
+                'new',
+                phones=[contact_data['PHONE']],
+                emails=[contact_data['EMAIL']],
+                origin_id=contact_data.get('ORIGIN_ID'),
+            )
+            return contact_data
+        # контакт, созданный или уже обновлённый строкой выше, второй раз не меняется
+        if contact_id in self._matched_ids or self.duplicate_index.get(contact_id) is None:
+            return None
+        self._matched_ids.add(contact_id)
+        return dict(contact_data, **{MATCHED_ID_FIELD: contact_id})
+
+    def _is_unchanged(self, contact_data: Dict[str, Any]) -> bool:
+        """найденный контакт, который строка не меняет; такая строка не доходит до отправки"""
+        contact_id = contact_data.get(MATCHED_ID_FIELD)
+        if contact_id is None:
+            return False
+        current = self.duplicate_index.get(contact_id)
+        company_name = contact_data['COMPANY_NAME']
+        if company_name and not self.company_resolver.matches(company_name, current['COMPANY_ID']):
+            return False
+        return not diff_contact_fields(current, contact_data, None)
+
+    def _enqueue(self, item: _QueuedChunk) -> None:
+        self._chunks.put(item)
+
+    def _submit_worker(self) -> None:
+        try:
+            while True:
+                item = self._chunks.get()
+                if item is None:
+                    return
+                if self._errors:
+                    # после ошибки очередь только разгружается, чтобы разбор файла не завис на put
+                    continue
+                try:
+                    self._submit_chunk(*item)
+                except Exception as e:
+                    self._errors.append(e)
+        finally:
+            connection.close()
+
+    def _record_worker(self) -> None:
+        try:
+            while True:
+                record = self._records.get()
+                if record is None:
+                    return
+                # ответы, полученные и после ошибки в другом потоке, в журнал записываются:
+                # эти контакты уже созданы, и повтор импорта не должен отправлять их снова
+                try:
+                    self._save_record(*record)
+                except Exception as e:
+                    self._errors.append(e)
+        finally:
+            connection.close()
+
+    def _submit_chunk(self, chunk_index: int, rows: List[Dict[str, Any]], row_indexes: Optional[List[int]]) -> None:
+        company_ids = self._resolve_companies(rows)
+        rows, methods = self._chunk_commands(chunk_index, rows, company_ids)
+        results = run_batch(self.but, methods, halt=0)
+        self._records.put(self._record_chunk(chunk_index, rows, methods, results, row_indexes))
+
+    def _resolve_companies(self, rows: List[Dict[str, Any]]) -> List[Optional[str]]:
+        with self._company_lock:
+            # недостающие компании chunk-а создаются одним batch-ем до отправки его контактов
+            for contact_data in rows:
+                self.company_resolver.resolve(contact_data['COMPANY_NAME'])
+            self.company_resolver.create_missing(self.but)
+            return [self.company_resolver.resolve(contact_data['COMPANY_NAME']) for contact_data in rows]
+
+    def _chunk_commands(
+            self,
+            chunk_index: int,
+            rows: List[Dict[str, Any]],
+            company_ids: List[Optional[str]],
+    ) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str, Dict[str, Any]]]]:
+        """команды chunk-а и строки, для которых они отправляются; строки без изменений отбрасываются"""
+        sent_rows = []
+        methods = []
+        for row_index, (contact_data, company_id) in enumerate(zip(rows, company_ids)):
+            name = f'contact_{chunk_index}_{row_index}'
+            contact_id = contact_data.get(MATCHED_ID_FIELD)
+            if contact_id is None:
+                methods.append((name, 'crm.contact.add', {'fields': build_contact_fields(contact_data, company_id)}))
+            else:
+                current = self.duplicate_index.get(contact_id)
+                if self.company_resolver.matches(contact_data['COMPANY_NAME'], current['COMPANY_ID']):
+                    # компания та же, даже если в портале есть одноимённая с другим id
+                    company_id = None
+                fields = diff_contact_fields(current, contact_data, company_id)
+                if not fields:
+                    continue
+                methods.append((name, 'crm.contact.update', {'id': contact_id, 'fields': fields}))
+            sent_rows.append(contact_data)
+        self.result.add_unchanged(len(rows) - len(sent_rows))
+        return sent_rows, methods
+
+    def _record_chunk(
+            self,
+            chunk_index: int,
+            rows: List[Dict[str, Any]],
+            methods: List[Tuple[str, str, Dict[str, Any]]],
+            results: Dict[str, Any],
+            row_indexes: Optional[List[int]] = None,
+    ) -> _ChunkRecord:
+        """разбирает ответ bitrix на chunk; row_indexes - номера строк в chunk-е файла, без них chunk не журналируется
+
+        у create строки chunk-а отправляются все, поэтому row_indexes совпадают со строками по порядку
+        """
+        errors = []
+        contact_ids = []
+        for (name, _, _), row in zip(methods, rows):
+            result = results.get(name)
+            if result is None:
+                errors.append('нет ответа bitrix на команду')
+            elif result.get('error') is not None:
+                errors.append(str(result.get('error_description') or result.get('error')))
+            else:
+                errors.append(None)
+                # crm.contact.update возвращает true, id обновлённого контакта берётся из строки
+                contact_ids.append(str(row.get(MATCHED_ID_FIELD) or result.get('result')))
+        self.result.add_chunk_results(rows, errors)
+        # в журнал попадают номера строк, которые bitrix не принял: повтор отправит только их,
+        # а строки с созданными контактами пропустит
+        failed_rows = None
+        if row_indexes is not None:
+            failed_rows = [row_index for row_index, error in zip(row_indexes, errors) if error is not None]
+        return chunk_index, contact_ids, failed_rows
+
+    def _save_record(self, chunk_index: int, contact_ids: List[str], failed_rows: Optional[List[int]]) -> None:
+        if self.journal is not None and failed_rows is not None:
+            self.journal.commit(chunk_index, contact_ids, failed_rows)
+        if self.on_chunk_done is not None:
+            self.on_chunk_done(self.result)
+
+
+class AsyncImportPipeline(ImportPipeline):
+    """тот же импорт для асинхронного view
+
+    файл разбирается в отдельном потоке, а chunk-и отправляются задачами цикла событий
+    через общий http-клиент: ожидание ответа bitrix не занимает поток
+    """
+
+    async def arun(self, contacts: Iterable[Dict[str, Any]]) -> ImportResult:
+        self._loop = asyncio.get_running_loop()
+        self._async_chunks: 'asyncio.Queue[Optional[_QueuedChunk]]' = asyncio.Queue(maxsize=IMPORT_QUEUE_SIZE)
+        self._async_company_lock = asyncio.Lock()
+        workers = [asyncio.create_task(self._asubmit_worker()) for _ in range(self.workers)]
+        parsed_contacts = metrics.timed_iter(metrics.SPAN_PARSE, contacts)
+        try:
+            # разбор не должен занимать поток запроса: в нём пишется журнал отправленных chunk-ов
+            await sync_to_async(self._produce_in_thread, thread_sensitive=False)(parsed_contacts)
+        finally:
+            parsed_contacts.close()
+            for _ in workers:
+                await self._async_chunks.put(None)
+            await asyncio.gather(*workers)
+            self._count_metrics()
+        if self._errors:
+            raise self._errors[0]
+        return self.result
+
+    def _produce_in_thread(self, contacts: Iterable[Dict[str, Any]]) -> None:
+        try:
+            self._produce(contacts)
+        finally:
+            # соединение, открытое в потоке пула, а не запроса, по окончании запроса само не закроется
+            connection.close()
+
+    def _enqueue(self, item: _QueuedChunk) -> None:
+        # вызывается из потока разбора: ждёт места в очереди цикла событий
+        asyncio.run_coroutine_threadsafe(self._async_chunks.put(item), self._loop).result()
+
+    async def _asubmit_worker(self) -> None:
+        while True:
+            item = await self._async_chunks.get()
+            if item is None:
+                return
+            if self._errors:
+                # после ошибки очередь только разгружается, чтобы разбор файла не завис на put
+                continue
+            try:
+                await self._asubmit_chunk(*item)
+            except Exception as e:
+                self._errors.append(e)
+
+    async def _asubmit_chunk(
+            self, chunk_index: int, rows: List[Dict[str, Any]], row_indexes: Optional[List[int]]) -> None:
+        async with self._async_company_lock:
+            company_ids = await self._aresolve_companies(rows)
+        rows, methods = self._chunk_commands(chunk_index, rows, company_ids)
+        results = await arun_batch(self.but, methods, halt=0)
+        record = self._record_chunk(chunk_index, rows, methods, results, row_indexes)
+        # журнал пишется в одном потоке запроса (thread_sensitive), а не из потоков пула
+        await sync_to_async(self._save_record)(*record)
+
+    async def _aresolve_companies(self, rows: List[Dict[str, Any]]) -> List[Optional[str]]:
+        # названия сверяются со словарём прямо в цикле событий, в поток уходит только создание компаний
+        for contact_data in rows:
+            self.company_resolver.resolve(contact_data['COMPANY_NAME'])
+        if self.company_resolver.has_missing:
+            await sync_to_async(self.company_resolver.create_missing, thread_sensitive=False)(self.but)
+        return [self.company_resolver.resolve(contact_data['COMPANY_NAME']) for contact_data in rows]
@@ -1,169 +1,95 @@
+import codecs
 import csv
-import os
-from random import sample
+import logging
 
 import openpyxl
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Sequence
 from io import TextIOWrapper
 from django.core.files.uploadedfile import UploadedFile
+from .contact_normalizer import iter_normalized_contacts
+
+logger = logging.getLogger(__name__)
+
 
 class BaseImporter(ABC):
-    """абстрактный базовый класс для импортёров"""
+    """абстрактный базовый класс для импортёров
+
+    импортёр только читает строки файла, нормализация и проверка строк - в contact_normalizer
+    """
 
     @abstractmethod
-    def import_file(self, file: UploadedFile) -> List[Dict[str, Any]]:
+    def iter_rows(self, file: UploadedFile) -> Iterator[Sequence[Any]]:
+        """лениво отдаёт строки файла как есть, первая строка - заголовки"""
         pass
-    def _validate_row(self, row:  Dict[str, Any]) -> bool:
-        """валидация строковых данных"""
-        # минимальная валидация будет в том, что необходимы хотя бы имя + фамилия
-        name = row.get('имя', '').strip()
-        last_name = row.get('фамилия','').strip()
-        return bool(name or last_name)
-
-    def _normalize_row(self, row: Dict[str, Any]) -> Dict[str, Any]:
-        """нормализация строковых данных"""
-        normalized = {
-            'NAME': row.get('имя','').strip(),
-            'LAST_NAME': row.get('фамилия', '').strip(),
-            'PHONE': row.get('номер телефона', '').strip(),
-            'EMAIL': row.get('почта', '').strip(),
-            'COMPANY_NAME': row.get('компания', '').strip(),
-        }
-
-        # очистка от пробелов
-        for key in normalized:
-            if normalized[key] is not None:
-                normalized[key] = normalized[key].strip()
-            else:
-                normalized[key] = ''
-
-            # очистка от пустых значений
-        for key in normalized:
-            if normalized[key] == '':
-                normalized[key] = None
-
-        return normalized
 
-class CSVImporter(BaseImporter):
-    """импортирует из .csv-формата"""
+    def iter_contacts(self, file: UploadedFile) -> Iterator[Dict[str, Any]]:
+        """лениво отдаёт нормализованные контакты; у строк с неверным телефоном или почтой заполнено поле ERROR"""
+        rows = self.iter_rows(file)
+        try:
+            header_row = next(rows, None)
+            if header_row is None:
+                return
+            headers = [str(value).strip().lower() if value is not None else '' for value in header_row]
+            yield from iter_normalized_contacts(headers, rows)
+        finally:
+            rows.close()
+
     def import_file(self, file: UploadedFile) -> List[Dict[str, Any]]:
-        contacts = []
-        # декодирование файла с правильной кодировкой
+        contacts = list(self.iter_contacts(file))
+        logger.info('успешно обработано контактов: %s', len(contacts))
+        return contacts
+
+
+class CSVImporter(BaseImporter):
+    """импортирует из .csv-формата потоково: память зависит от размера куска чтения, а не файла"""
+    # сколько байт из начала файла смотреть при определении кодировки и разделителя
+    sniff_sample_size = 64 * 1024
+
+    def iter_rows(self, file: UploadedFile) -> Iterator[Sequence[Any]]:
+        """лениво отдаёт строки csv"""
+        raw = file.file
+        raw.seek(0)
+        sample = raw.read(self.sniff_sample_size)
+        if not sample:
+            raise ValueError('файл пуст')
+        encoding = detect_encoding(sample)
+        delimiter = detect_delimiter(sample.decode(encoding, errors='ignore'))
+        raw.seek(0)
+
+        # TextIOWrapper декодирует файл кусками по мере чтения, newline='' оставляет переводы строк csv-модулю
+        text = TextIOWrapper(raw, encoding=encoding, errors='replace', newline='')
         try:
-            # сброс файла на начало
-            file.file.seek(0)
-            text_content = file.file.read()
-
-            decoded_content = text_content.decode('utf-16')
-            if decoded_content is None:
-                raise ValueError("не удалось декодировать файл с поддерживаемыми кодировками")
-            #убрать BOM если есть
-            if decoded_content.startswith('\ufeff'):
-                decoded_content = decoded_content[1:]
-                # print('>> BOM удалён')
-            lines = decoded_content.splitlines()
-            if not lines:
-                raise ValueError("файл пуст")
-            # print(f">> получено строк: {len(lines)}")
-            # print(f">> первые 2 строки: {lines[:2]}")
-
-            cleaned_lines = []
-            for line in lines:
-                # Убираем BOM из каждой строки
-                if '\ufeff' in line:
-                    line = line.replace('\ufeff', '')
-                    line = line.replace('"', '')
-
-                cleaned_lines.append(line)
-
-            # print(f">> очищенные строки: {cleaned_lines[:2]}")
-
-            # определение разделителя
-            first_line = cleaned_lines[0]
-            possible_delimiters = [',',';','\t']
-            delimiter = ','
-
-            for delimiter_variant in possible_delimiters:
-                if delimiter_variant in first_line:
-                    delimiter = delimiter_variant
-                    break
-            # print(f">> определен разделитель: '{delimiter}'")
-
-            reader = csv.DictReader(cleaned_lines, delimiter=delimiter)
-            # print(f'>> определены заголовки: {reader.fieldnames}')
-
-            possible_abbreviations = ['ООО', 'ОАО', 'ИП', 'ЗАО', 'ПАО', 'НПАО', 'ГУП', 'МУП']
-
-            for row_num, row in enumerate(reader, 1):
-                try:
-                    # print(f">> сырая строка {row_num}: {dict(row)}")
-
-                    # проверяем, что значения не None
-                    cleaned_row = {}
-                    for key, value in row.items():
-                        if value is None:
-                            cleaned_row[key] = ''
-                        else:
-                            cleaned_row[key] = value
-
-                    if self._validate_row(row):
-                        normalized_row = self._normalize_row(row)
-                        if normalized_row['COMPANY_NAME'].split(' ')[0] in possible_abbreviations:
-                            company_name_splitted = normalized_row['COMPANY_NAME'].split(' ')
-                            normalized_row['COMPANY_NAME'] = (
-                                    company_name_splitted[0]
-                                    + ' "'
-                                    + ' '.join(company_name_splitted[1:])
-                                    +'"')
-                        contacts.append(normalized_row)
-                        # print(f">> строка {row_num} прошла валидацию: {normalized_row}")
-                    else:
-                        # print(f">> строка {row_num} не прошла валидацию: {row}")
-                        pass
-                except Exception as e:
-                    print(f">> Ошибка в строке {row_num}: {e}")
-                    continue
-
-            print(f">> успешно обработано контактов: {len(contacts)}")
-            return contacts
-
-        except Exception as e:
-            print(f">> критическая ошибка при обработке CSV: {str(e)}")
+            # старые выгрузки содержат BOM перед каждой строкой - убираем его на лету
+            lines = (line.replace('\ufeff', '') for line in text)
+            reader = csv.reader(lines, delimiter=delimiter)
+            header_row = next(reader, None)
+            if header_row is None:
+                raise ValueError('файл пуст')
+            yield header_row
+            yield from reader
+        except csv.Error as e:
+            logger.error('критическая ошибка при обработке CSV: %s', e)
             raise ValueError(f'ошибка при обработке CSV файла: {str(e)}')
+        finally:
+            # закрывать загруженный файл вместе с обёрткой нельзя
+            text.detach()
 
 
 class XLSXImporter(BaseImporter):
-    """импортирует из xlsx файлов"""
+    """импортирует из xlsx файлов потоково, за один проход по листу"""
 
-    def import_file(self, file: UploadedFile) -> List[Dict[str, Any]]:
-        contacts = []
-
-        wb = openpyxl.load_workbook(filename=file.file, read_only=True)
-        ws = wb.active
-
-        # считывание заголовков
-        headers = []
-        for cell in ws[1]:
-            headers.append(cell.value.strip().lower() if cell else '')
-
-        # считываем данные
-        for row_num in range(2, ws.max_row + 1):
-            row_data = {}
-            for col_num, header in enumerate(headers, 1):
-                cell_value = ws.cell(row=row_num, column=col_num).value
-                row_data[header] = str(cell_value) if cell_value is not None else ''
-
-            try:
-                if self._validate_row(row_data):
-                    normalized_row = self._normalize_row(row_data)
-                    contacts.append(normalized_row)
-            except Exception as e:
-                print(f'Ошибка при импорте из .xslx файла {e}')
-                raise ValueError(f'Ошибка при импорте из .xslx файла {e}')
-                return []
-
-        return contacts
+    def iter_rows(self, file: UploadedFile) -> Iterator[Sequence[Any]]:
+        """лениво отдаёт строки xlsx; значения ячеек в строки приводит нормализация"""
+        file.file.seek(0)
+        wb = openpyxl.load_workbook(filename=file.file, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            # размер листа в файле может отсутствовать или быть неверным - читаем до последней реальной строки
+            ws.reset_dimensions()
+            yield from ws.iter_rows(values_only=True)
+        finally:
+            wb.close()
 
 
 class ImporterFactory:
@@ -188,6 +114,42 @@ class ImporterFactory:
     
     
 # утилиты для работы с импортом
+def detect_encoding(sample: bytes) -> str:
+    """кодировка csv по BOM, а без него - по пробному декодированию начала файла"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    # utf-16 без BOM выдают нулевые байты на месте старших байтов ascii-символов
+    half = len(sample) // 4
+    if sample[1::2].count(0) > half:
+        return 'utf-16-le'
+    if sample[0::2].count(0) > half:
+        return 'utf-16-be'
+    try:
+        # final=False: образец мог оборваться посреди многобайтового символа
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+
+def detect_delimiter(sample_text: str) -> str:
+    """разделитель csv по первым строкам файла"""
+    lines = sample_text.replace('\ufeff', '').splitlines()[:20]
+    # последняя строка образца может быть оборвана
+    if len(lines) > 1:
+        lines = lines[:-1]
+    try:
+        return csv.Sniffer().sniff('\n'.join(lines), delimiters=',;\t').delimiter
+    except csv.Error:
+        first_line = lines[0] if lines else ''
+        for delimiter_variant in [',', ';', '\t']:
+            if delimiter_variant in first_line:
+                return delimiter_variant
+        return ','
+
+
 def detect_file_format(filename: str) -> str:
     """опрределение формата файла по расширению"""
     extension = filename.split('.')[-1].lower()
@@ -196,10 +158,17 @@ def detect_file_format(filename: str) -> str:
     elif extension in ['xlsx', 'xls']:
         return 'xlsx'
     else:
-        print(f'неподдерживаемый формат файла {extension}')
+        logger.warning('неподдерживаемый формат файла %s', extension)
         raise ValueError(f'неподдерживаемый формат файла {extension}')
 
 
+def iter_imported_file(file: UploadedFile) -> Iterator[Dict[str, Any]]:
+    """то же, что process_imported_file, но контакты отдаются лениво"""
+    format_type = detect_file_format(file.name)
+    importer = ImporterFactory.get_importer(format_type)
+    return importer.iter_contacts(file)
+
+
 def process_imported_file(file: UploadedFile) -> List[Dict[str, Any]]:
     """основная функция обработки загруженного файла"""
     try:
@@ -0,0 +1,50 @@
+from typing import Any, Dict, Iterator, List, Optional
+
+from .batch_scheduler import call_api_method
+
+# bitrix отдаёт списочные методы страницами по 50 записей
+PAGE_SIZE = 50
+
+
+def iter_list_pages(
+        but,
+        method: str,
+        select: Optional[List[str]] = None,
+        list_filter: Optional[Dict[str, Any]] = None,
+) -> Iterator[List[Dict[str, Any]]]:
+    """ленивый постраничный обход списочного метода bitrix (crm.*.list) по курсору ID
+
+    вместо offset каждая страница запрашивается с фильтром ">ID" от последнего
+    полученного ID, сортировкой ID ASC и start=-1: bitrix не считает total,
+    а время ответа не растёт с глубиной страницы. запросы идут через общий ограничитель портала
+    """
+    select = list(select or ['*'])
+    if 'ID' not in select and '*' not in select:
+        select.append('ID')
+
+    last_id = 0
+    while True:
+        response = call_api_method(but, method, {
+            'select': select,
+            'filter': dict(list_filter or {}, **{'>ID': last_id}),
+            'order': {'ID': 'ASC'},
+            'start': -1,
+        })
+        page = response.get('result') or []
+        if not page:
+            return
+        yield page
+        if len(page) < PAGE_SIZE:
+            return
+        last_id = int(page[-1]['ID'])
+
+
+def iter_list(
+        but,
+        method: str,
+        select: Optional[List[str]] = None,
+        list_filter: Optional[Dict[str, Any]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """то же, что iter_list_pages, но по одной записи"""
+    for page in iter_list_pages(but, method, select=select, list_filter=list_filter):
+        yield from page
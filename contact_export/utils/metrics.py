@@ -0,0 +1,411 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Deque, Dict, Iterable, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+
+# сколько последних запросов держать в памяти для эндпоинта метрик
+METRICS_RECENT_TRACES = 100
+
+# этапы, которые замеряются в экспорте и импорте
+SPAN_AUTH = 'auth'
+SPAN_COMPANY_FETCH = 'company_fetch'
+SPAN_CONTACT_FETCH = 'contact_fetch'
+SPAN_DUPLICATE_INDEX = 'duplicate_index'
+SPAN_REST_CALL = 'rest_call'
+SPAN_BATCH_CALL = 'batch_call'
+SPAN_TRANSFORM = 'transform'
+SPAN_RENDER = 'render'
+SPAN_PARSE = 'parse'
+
+# счётчики
+COUNTER_REST_CALLS = 'rest_calls'
+COUNTER_REST_ERRORS = 'rest_errors'
+COUNTER_BATCH_COMMANDS = 'batch_commands'
+COUNTER_ROWS_EXPORTED = 'rows_exported'
+COUNTER_ROWS_PARSED = 'rows_parsed'
+COUNTER_INVALID_ROWS = 'invalid_rows'
+COUNTER_ROWS_IMPORTED = 'rows_imported'
+COUNTER_ROWS_UPDATED = 'rows_updated'
+COUNTER_ROWS_UNCHANGED = 'rows_unchanged'
+COUNTER_ROWS_FAILED = 'rows_failed'
+COUNTER_DUPLICATES = 'duplicates'
+COUNTER_BYTES_SENT = 'bytes_sent'
+COUNTER_BYTES_RECEIVED = 'bytes_received'
+COUNTER_EXPORT_CACHE_HITS = 'export_cache_hits'
+COUNTER_EXPORT_CACHE_MISSES = 'export_cache_misses'
+COUNTER_AUTH_CACHE_HITS = 'auth_cache_hits'
+COUNTER_AUTH_CACHE_MISSES = 'auth_cache_misses'
+
+logger = logging.getLogger(__name__)
+
+
+class SpanStats:
+    """сколько раз выполнялся этап, суммарное и максимальное время"""
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float, count: int = 1) -> None:
+        self.count += count
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: 'SpanStats') -> None:
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total, 4),
+            'avg_seconds': round(self.total / self.count, 4) if self.count else 0.0,
+            'max_seconds': round(self.max, 4),
+        }
+
+
+class RequestTrace:
+    """замеры одного запроса или фоновой задачи
+
+    этапы и счётчики могут добавляться из нескольких потоков (пул batch-ей, потоки импорта)
+    """
+
+    def __init__(self, name: str, portal_id: Optional[int] = None):
+        self.name = name
+        self.portal_id = portal_id
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        self.spans: Dict[str, SpanStats] = {}
+        self.counters: Dict[str, float] = {}
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            self.spans.setdefault(name, SpanStats()).add(seconds, count)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self) -> bool:
+        """фиксирует длительность; False, если запрос уже был закрыт раньше"""
+        with self._lock:
+            if self.duration is not None:
+                return False
+            self.duration = time.perf_counter() - self._started
+            return True
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'name': self.name,
+                'portal_id': self.portal_id,
+                'started_at': self.started_at,
+                'duration_seconds': round(self.duration, 4) if self.duration is not None else None,
+                'spans': {name: stats.as_dict() for name, stats in self.spans.items()},
+                'counters': dict(self.counters),
+            }
+
+    def summary(self) -> str:
+        spans = ', '.join(f'{name}={stats.total:.3f}s/{stats.count}' for name, stats in self.spans.items())
+        counters = ', '.join(f'{name}={value:g}' for name, value in self.counters.items())
+        return f'{self.name} портал {self.portal_id}: {self.duration or 0:.3f}s [{spans}] [{counters}]'
+
+
+class MetricsRegistry:
+    """накопленные с запуска процесса замеры и счётчики, отдельно по каждому порталу"""
+
+    def __init__(self, recent_traces: int = METRICS_RECENT_TRACES):
+        self._portals: Dict[Optional[int], Dict[str, Any]] = {}
+        self._recent: Deque[RequestTrace] = deque(maxlen=recent_traces)
+        self._lock = threading.Lock()
+
+    def _portal(self, portal_id: Optional[int]) -> Dict[str, Any]:
+        return self._portals.setdefault(portal_id, {'requests': {}, 'spans': {}, 'counters': {}})
+
+    def add_trace(self, trace: RequestTrace) -> None:
+        with self._lock:
+            portal = self._portal(trace.portal_id)
+            portal['requests'].setdefault(trace.name, SpanStats()).add(trace.duration or 0.0)
+            for name, stats in trace.spans.items():
+                portal['spans'].setdefault(name, SpanStats()).merge(stats)
+            for name, value in trace.counters.items():
+                portal['counters'][name] = portal['counters'].get(name, 0) + value
+            self._recent.append(trace)
+
+    def add_span(self, portal_id: Optional[int], name: str, seconds: float, count: int = 1) -> None:
+        with self._lock:
+            self._portal(portal_id)['spans'].setdefault(name, SpanStats()).add(seconds, count)
+
+    def increment(self, portal_id: Optional[int], name: str, value: float = 1) -> None:
+        with self._lock:
+            counters = self._portal(portal_id)['counters']
+            counters[name] = counters.get(name, 0) + value
+
+    def snapshot(self, portal_id: Optional[int] = None) -> Dict[str, Any]:
+        """метрики всех порталов или только одного"""
+        with self._lock:
+            portals = {
+                key: {
+                    'requests': {name: stats.as_dict() for name, stats in portal['requests'].items()},
+                    'spans': {name: stats.as_dict() for name, stats in portal['spans'].items()},
+                    'counters': dict(portal['counters']),
+                }
+                for key, portal in self._portals.items()
+                if portal_id is None or key == portal_id
+            }
+            recent = [trace for trace in self._recent if portal_id is None or trace.portal_id == portal_id]
+        return {
+            'portals': {str(key): value for key, value in portals.items()},
+            'recent': [trace.as_dict() for trace in recent],
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._portals.clear()
+            self._recent.clear()
+
+
+registry = MetricsRegistry()
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar('contact_export_trace', default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def record_span(name: str, seconds: float, count: int = 1) -> None:
+    """замер этапа уходит в текущий запрос, а вне запроса - сразу в общие метрики"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, seconds, count)
+    else:
+        registry.add_span(None, name, seconds, count)
+
+
+def increment(name: str, value: float = 1) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.increment(name, value)
+    else:
+        registry.increment(None, name, value)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """замеряет время блока как этап name"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def timed_iter(name: str, iterable: Iterable[Any]) -> Iterator[Any]:
+    """отдаёт элементы iterable, суммируя время их получения в один замер этапа name
+
+    нужен для ленивых этапов (разбор файла, чтение зеркала), которые перемежаются с другой работой
+    """
+    iterator = iter(iterable)
+    total = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                total += time.perf_counter() - started
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+        record_span(name, total)
+
+
+def bind_trace(function: Callable) -> Callable:
+    """привязывает функцию к текущему запросу: её замеры из другого потока попадут в этот же запрос"""
+    trace = _current_trace.get()
+
+    @wraps(function)
+    def bound(*args, **kwargs):
+        token = _current_trace.set(trace)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return bound
+
+
+def start_trace(name: str, portal_id: Optional[int] = None) -> RequestTrace:
+    return RequestTrace(name, portal_id)
+
+
+def finish_trace(trace: RequestTrace) -> None:
+    """закрывает запрос и учитывает его в реестре; повторный вызов ничего не делает"""
+    if not trace.finish():
+        return
+    registry.add_trace(trace)
+    logger.debug('метрики %s', trace.summary())
+
+
+def _trace_streaming_response(trace: RequestTrace, response) -> None:
+    """запрос потокового ответа закрывается по окончании отдачи, а если ответ так и не начали
+    читать (клиент отключился до первого куска) - при закрытии самого ответа"""
+    if response.is_async:
+        response.streaming_content = _aiter_streaming_in_trace(trace, response.streaming_content)
+    else:
+        response.streaming_content = _iter_streaming_in_trace(trace, response.streaming_content)
+    response._resource_closers.append(lambda: finish_trace(trace))
+
+
+@contextmanager
+def traced(name: str, portal_id: Optional[int] = None) -> Iterator[RequestTrace]:
+    """всё, что замеряется внутри блока, относится к одной задаче name"""
+    trace = start_trace(name, portal_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        finish_trace(trace)
+
+
+def _iter_streaming_in_trace(trace: RequestTrace, content: Iterable[bytes]) -> Iterator[bytes]:
+    """потоковый ответ формируется уже после выхода из view - запрос закрывается по его окончании
+
+    контекст запроса выставляется только на время получения очередного куска,
+    пока кусок отправляется клиентом, он снят
+    """
+    iterator = iter(content)
+    try:
+        while True:
+            token = _current_trace.set(trace)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _current_trace.reset(token)
+            trace.increment(COUNTER_BYTES_SENT, len(chunk))
+            yield chunk
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+        finish_trace(trace)
+
+
+async def _aiter_streaming_in_trace(trace: RequestTrace, content: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """то же, что _iter_streaming_in_trace, для асинхронного потокового ответа"""
+    iterator = content.__aiter__()
+    try:
+        while True:
+            token = _current_trace.set(trace)
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _current_trace.reset(token)
+            trace.increment(COUNTER_BYTES_SENT, len(chunk))
+            yield chunk
+    finally:
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose()
+        finish_trace(trace)
+
+
+def instrumented_view(name: str, auth_decorator: Callable[[Callable], Callable]) -> Callable[[Callable], Callable]:
+    """оборачивает view в замер запроса, а декоратор авторизации (main_auth) - в этап auth
+
+    использование вместо @main_auth(...):
+        @instrumented_view('export_contacts', main_auth(on_cookies=True))
+    """
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def authenticated(request, *args, **kwargs):
+            trace = _current_trace.get()
+            trace.add_span(SPAN_AUTH, time.perf_counter() - request.metrics_auth_started)
+            but = getattr(request, 'bitrix_user_token', None)
+            if but is not None:
+                trace.portal_id = but.user.portal_id
+            return view(request, *args, **kwargs)
+
+        protected = auth_decorator(authenticated)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            trace = start_trace(name)
+            token = _current_trace.set(trace)
+            streaming = False
+            try:
+                request.metrics_auth_started = time.perf_counter()
+                response = protected(request, *args, **kwargs)
+                if getattr(response, 'streaming', False):
+                    _trace_streaming_response(trace, response)
+                    streaming = True
+                return response
+            finally:
+                _current_trace.reset(token)
+                if not streaming:
+                    finish_trace(trace)
+        return wrapper
+    return decorator
+
+
+def instrumented_async_view(
+        name: str,
+        auth_decorator: Callable[[Callable], Callable],
+) -> Callable[[Callable], Callable]:
+    """то же, что instrumented_view, для асинхронного view
+
+    декоратор авторизации синхронный (main_auth ходит в базу), поэтому он выполняется в потоке,
+    а сам view - уже в цикле событий. ответ декоратора без вызова view (редирект, 403) отдаётся как есть
+    """
+    def decorator(view: Callable) -> Callable:
+        def authenticated(request, *args, **kwargs):
+            trace = _current_trace.get()
+            trace.add_span(SPAN_AUTH, time.perf_counter() - request.metrics_auth_started)
+            but = getattr(request, 'bitrix_user_token', None)
+            if but is not None:
+                trace.portal_id = but.user.portal_id
+            request.metrics_authenticated = True
+            return None
+
+        authenticate = sync_to_async(auth_decorator(authenticated))
+
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            trace = start_trace(name)
+            token = _current_trace.set(trace)
+            streaming = False
+            try:
+                request.metrics_auth_started = time.perf_counter()
+                request.metrics_authenticated = False
+                response = await authenticate(request, *args, **kwargs)
+                if not request.metrics_authenticated:
+                    return response
+                response = await view(request, *args, **kwargs)
+                if getattr(response, 'streaming', False):
+                    _trace_streaming_response(trace, response)
+                    streaming = True
+                return response
+            finally:
+                _current_trace.reset(token)
+                if not streaming:
+                    finish_trace(trace)
+        return wrapper
+    return decorator
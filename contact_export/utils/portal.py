@@ -0,0 +1,8 @@
+def get_portal_id(but) -> int:
+    """идентификатор портала, к которому относится токен пользователя"""
+    return but.user.portal_id
+
+
+def get_portal_domain(but) -> str:
+    """домен портала (example.bitrix24.ru), на который уходят rest-запросы токена"""
+    return but.user.portal.domain
@@ -1,4 +1,7 @@
 from django.urls import reverse
 
-def url_with_message_parameters(redirect_url_string="index_after", status="success", content=""):
-    return f'{reverse(f"{redirect_url_string}")}?message_type={status}&message_content={content}'
+def url_with_message_parameters(redirect_url_string="index_after", status="success", content="", extra_parameters=None):
+    url = f'{reverse(f"{redirect_url_string}")}?message_type={status}&message_content={content}'
+    for key, value in (extra_parameters or {}).items():
+        url += f'&{key}={value}'
+    return url
@@ -1,11 +1,31 @@
 
+from typing import Optional
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from contact_export.utils.exorter_module import ExporterFactory
-from contact_export.utils.importer_module import process_imported_file
+from contact_export.utils.importer_module import iter_imported_file
+from contact_export.utils.contact_mirror import iter_export_rows, aiter_export_pages
+from contact_export.utils.export_options import ExportOptions
+from contact_export.utils.export_cache import (
+    export_watermark, aexport_watermark, export_cache_key, etag_matches, open_cached_export,
+    cache_streaming_export, acache_streaming_export)
+from contact_export.utils.company_directory import get_company_directory
+from contact_export.utils.export_jobs import enqueue_export_job
+from contact_export.utils.portal import get_portal_id
+from contact_export.utils.import_pipeline import (
+    IMPORT_MODE_CREATE, IMPORT_MODE_UPSERT, IMPORT_MODES, ImportPipeline, AsyncImportPipeline, ImportResult,
+    contact_index_class)
+from contact_export.utils.company_resolver import CompanyResolver
+from contact_export.utils.import_jobs import enqueue_import_job, can_resume_import_job, resume_import_job
+from contact_export.utils.import_journal import ImportJournal, compute_file_hash
+from contact_export.utils.metrics import (
+    instrumented_view, instrumented_async_view, increment, registry, COUNTER_BYTES_RECEIVED, COUNTER_EXPORT_CACHE_HITS)
+from contact_export.models import ExportJob, ImportJob
 from integration_utils.bitrix24.bitrix_user_auth.main_auth import main_auth
+from contact_export.utils.auth_cache import cached_auth
 # from integration_utils.bitrix24.functions.batch_api_call import _batch_api_call
-from django.http import JsonResponse, HttpResponse, JsonResponse
+from django.http import JsonResponse, HttpResponse, JsonResponse, FileResponse, HttpResponseNotModified
 from .utils.url_with_message_parameters import url_with_message_parameters
 
 
@@ -15,7 +35,7 @@ from .utils.url_with_message_parameters import url_with_message_parameters
 def start_index(request):
     return render(request, 'index.html')
 
-@main_auth(on_cookies=True)
+@cached_auth(main_auth(on_cookies=True))
 def index_after(request):
     message_type = request.GET.get('message_type')
     message_content = request.GET.get('message_content')
@@ -26,112 +46,402 @@ def index_after(request):
             'type': message_type,
             'content': message_content
         }
+    # если на странице нужно показать прогресс фоновой задачи - передаём адрес её статуса
+    for parameter, status_url_name in [('export_job_id', 'export_job_status'), ('import_job_id', 'import_job_status')]:
+        job_id = request.GET.get(parameter)
+        if job_id and job_id.isdigit():
+            context['job_status_url'] = reverse(status_url_name, args=[int(job_id)])
     return render(request, 'index.html', context)
 
 # --- экспорт контактов в xcel или csv
-@main_auth(on_cookies=True)
+@instrumented_view('export_contacts', cached_auth(main_auth(on_cookies=True)))
 def export_contacts(request):
     if request.method == 'POST':
-        but = request.bitrix_user_token
         try:
-            # --- подготовка данныхк контактов для экспорта
-            contact_ids = [contact['ID'] for contact in but.call_list_method('crm.contact.list', {'SELECT': ['ID']})]
-
-            methods = []
-            for contact_id in contact_ids:
-                methods.append((
-                    f'contact_{contact_id}',
-                    'crm.contact.get',  # Этот метод ВСЕГДА возвращает все поля
-                    {'ID': contact_id}  # SELECT здесь не работает!
-                ))
-            contacts = but.batch_api_call(methods=methods, halt=0, chunk_size=50)
-
-            # получаем структурированный словарь с названиями компаний
-            company_dict = {company['ID']: company['TITLE'] for company in but.call_list_method("crm.company.list", {
-                "select": ["ID", "TITLE"]
-            })}
-            print(f'получили словарь с id + название компании: {contact_ids}')
-            # фильтруем только нужные поля
-            filtered_contacts = []
-            for contact_data in contacts.values():
-                if contact_data['error'] is None:
-                    contact = contact_data['result']
-                    filtered_contacts.append({
-                        'ID': contact.get('ID'),
-                        'NAME': contact.get('NAME'),
-                        'LAST_NAME': contact.get('LAST_NAME'),
-                        'PHONE': contact.get('PHONE')[0].get('VALUE', '') if contact.get('PHONE') else '',
-                        'EMAIL': contact.get('EMAIL')[0].get('VALUE', '') if contact.get('EMAIL') else '',
-                        'COMPANY': company_dict[contact.get('COMPANY_ID')] if contact.get('COMPANY_ID') else ''
-                    })
-
-            # print(f'>>> ответ от api получен. Список ОТФИЛЬТРОВАННЫХ контактов следующий!: {filtered_contacts}')
-
-            # --- подготовка экспортера для переноса данных
-            exporter_format = request.POST.get('exporter_format')
-
-            exporter = ExporterFactory.get_exporter(exporter_format)
-            return exporter.export(filtered_contacts)
+            return _export_contacts(request, request.POST)
+        except Exception as e:
+            return HttpResponse(f'Ошибка экспорта контактов: {e}', status=500)
+    # GET-запросы с теми же параметрами принимает export_contacts_download
+    return HttpResponse(f'Ошибка 405: недопустимый метод {request.method}', status=405)
+
+
+# --- тот же экспорт по ссылке: параметры формы в строке запроса, повторное скачивание
+# неизменившегося файла отвечает 304 на If-None-Match
+@instrumented_view('export_contacts_download', cached_auth(main_auth(on_cookies=True)))
+def export_contacts_download(request):
+    if request.method == 'GET':
+        try:
+            return _export_contacts(request, request.GET)
+        except Exception as e:
+            return HttpResponse(f'Ошибка экспорта контактов: {e}', status=500)
+    return HttpResponse(f'Ошибка 405: недопустимый метод {request.method}', status=405)
+
 
+def _export_contacts(request, data) -> HttpResponse:
+    but = request.bitrix_user_token
+    # словарь id -> название компании берём из кэша справочника портала
+    company_directory = get_company_directory(but)
+    company_dict = company_directory.titles_by_id
+    exporter_format = data.get('exporter_format')
+
+    # --- фильтр и набор полей из формы; неверные значения возвращают пользователя на форму
+    try:
+        options = ExportOptions.from_request(data, company_directory)
+    except ValueError as e:
+        return _export_options_error(e)
+
+    # --- большой портал выгружаем в фоне, клиент опрашивает статус задачи; задача ставится только POST-ом
+    if request.method == 'POST' and data.get('run_in_background'):
+        return _export_job_queued(enqueue_export_job(but, exporter_format, options))
+
+    # --- подготовка экспортера для переноса данных
+    exporter = ExporterFactory.get_exporter(exporter_format, columns=options.columns())
+
+    # --- готовый файл ищется в кэше по отметке последнего изменения контактов и компаний:
+    # если данные не менялись, повторный экспорт стоит одного дешёвого запроса
+    cache_key = export_cache_key(
+        get_portal_id(but), but.user_id, exporter_format, options,
+        export_watermark(but, options, company_directory))
+    cached_response = _cached_export_response(request, data, exporter, cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    # --- зеркало уже догружено дельтой по DATE_MODIFY и фильтруется запросом к базе,
+    # строки читаются кусками и сразу уходят в экспортер, csv отдаётся клиенту по мере чтения
+    # и одновременно пишется в кэш
+    response = exporter.export(iter_export_rows(but, company_dict, options, synced=True))
+    response.streaming_content = cache_streaming_export(cache_key, response.streaming_content)
+    return _with_cache_headers(response, request, data, cache_key)
+
+
+# --- тот же экспорт для asgi: ожидание ответов bitrix не занимает поток, запросы идут через общий http-клиент
+@instrumented_async_view('export_contacts', cached_auth(main_auth(on_cookies=True)))
+async def export_contacts_async(request):
+    if request.method == 'POST':
+        try:
+            return await _aexport_contacts(request, request.POST)
         except Exception as e:
             return HttpResponse(f'Ошибка экспорта контактов: {e}', status=500)
-    # GET-запроса быть не может, возвращаем ошибку
     return HttpResponse(f'Ошибка 405: недопустимый метод {request.method}', status=405)
 
 
-@main_auth(on_cookies=True)
+@instrumented_async_view('export_contacts_download', cached_auth(main_auth(on_cookies=True)))
+async def export_contacts_download_async(request):
+    if request.method == 'GET':
+        try:
+            return await _aexport_contacts(request, request.GET)
+        except Exception as e:
+            return HttpResponse(f'Ошибка экспорта контактов: {e}', status=500)
+    return HttpResponse(f'Ошибка 405: недопустимый метод {request.method}', status=405)
+
+
+async def _aexport_contacts(request, data) -> HttpResponse:
+    but = request.bitrix_user_token
+    exporter_format = data.get('exporter_format')
+    exporter = ExporterFactory.get_exporter(exporter_format)
+    # xlsx и parquet собираются во временном файле целиком, их формирование остаётся в потоке
+    if not exporter.streaming:
+        return await sync_to_async(_export_contacts)(request, data)
+
+    company_directory = await sync_to_async(get_company_directory)(but)
+    company_dict = company_directory.titles_by_id
+    try:
+        options = ExportOptions.from_request(data, company_directory)
+    except ValueError as e:
+        return _export_options_error(e)
+
+    if request.method == 'POST' and data.get('run_in_background'):
+        return _export_job_queued(await sync_to_async(enqueue_export_job)(but, exporter_format, options))
+
+    exporter = ExporterFactory.get_exporter(exporter_format, columns=options.columns())
+    cache_key = export_cache_key(
+        get_portal_id(but), but.user_id, exporter_format, options,
+        await aexport_watermark(but, options, company_directory))
+    cached_response = _cached_export_response(request, data, exporter, cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    # страницы контактов приходят асинхронно и кодируются по мере получения
+    response = exporter.aexport(aiter_export_pages(but, company_dict, options, synced=True))
+    response.streaming_content = acache_streaming_export(cache_key, response.streaming_content)
+    return _with_cache_headers(response, request, data, cache_key)
+
+
+def _export_options_error(error: ValueError) -> HttpResponse:
+    return redirect(url_with_message_parameters(
+        redirect_url_string='index_after',
+        status='error',
+        content=f'Ошибка в параметрах экспорта: {error}'))
+
+
+def _export_job_queued(job: ExportJob) -> HttpResponse:
+    return redirect(url_with_message_parameters(
+        redirect_url_string='index_after',
+        status='info',
+        content=f'Экспорт поставлен в очередь, задача №{job.id}',
+        extra_parameters={'export_job_id': job.id}))
+
+
+def _cached_export_response(request, data, exporter, cache_key: str):
+    """304, если у клиента уже есть этот файл, готовый файл из кэша или None
+
+    304 отдаётся только на GET: на POST условных ответов не бывает, браузер If-None-Match к нему не шлёт
+    """
+    if request.method == 'GET' and etag_matches(request.headers.get('If-None-Match'), f'"{cache_key}"'):
+        increment(COUNTER_EXPORT_CACHE_HITS)
+        return _with_cache_headers(HttpResponseNotModified(), request, data, cache_key)
+    cached_file = open_cached_export(cache_key)
+    if cached_file is None:
+        return None
+    response = FileResponse(
+        cached_file,
+        as_attachment=True,
+        filename=exporter.filename,
+        content_type=exporter.content_type,
+    )
+    return _with_cache_headers(response, request, data, cache_key)
+
+
+def _with_cache_headers(response, request, data, cache_key: str):
+    """ETag и Cache-Control ответа экспорта
+
+    файл собран по правам пользователя: хранить его может только браузер, и перед повторным
+    использованием он сверяется с сервером. ответ на POST ссылается на GET-адрес того же экспорта,
+    по которому работает If-None-Match
+    """
+    response['ETag'] = f'"{cache_key}"'
+    response['Cache-Control'] = 'private, no-cache'
+    if request.method == 'POST':
+        query = data.copy()
+        for parameter in ('csrfmiddlewaretoken', 'run_in_background'):
+            query.pop(parameter, None)
+        response['Content-Location'] = f'{reverse("export_contacts_download")}?{query.urlencode()}'
+    return response
+
+
+def _get_user_job(request, job_model, job_id):
+    """фоновая задача текущего пользователя или None"""
+    but = request.bitrix_user_token
+    return job_model.objects.filter(
+        id=job_id,
+        bitrix_portal_id=get_portal_id(but),
+        bitrix_user_id=but.user_id,
+    ).first()
+
+
+@cached_auth(main_auth(on_cookies=True))
+def export_job_status(request, job_id):
+    job = _get_user_job(request, ExportJob, job_id)
+    if job is None:
+        return JsonResponse({'error': f'задача экспорта {job_id} не найдена'}, status=404)
+    return JsonResponse({
+        'id': job.id,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'exporter_format': job.exporter_format,
+        'pages_fetched': job.pages_fetched,
+        'rows_written': job.rows_written,
+        'progress': f'страниц получено: {job.pages_fetched}, строк записано: {job.rows_written}',
+        'error': job.error,
+        'download_url': reverse('export_job_download', args=[job.id]) if job.status == ExportJob.STATUS_DONE else None,
+    })
+
+
+@cached_auth(main_auth(on_cookies=True))
+def export_job_download(request, job_id):
+    job = _get_user_job(request, ExportJob, job_id)
+    if job is None or job.status != ExportJob.STATUS_DONE or not job.result_file:
+        return HttpResponse(f'Ошибка 404: результат экспорта {job_id} не найден', status=404)
+    exporter = ExporterFactory.get_exporter(job.exporter_format)
+    return FileResponse(
+        job.result_file.open('rb'),
+        as_attachment=True,
+        filename=exporter.filename,
+        content_type=exporter.content_type,
+    )
+
+
+@instrumented_view('import_contacts', cached_auth(main_auth(on_cookies=True)))
 def import_contacts(request):
     if request.method == 'POST':
         but = request.bitrix_user_token
         try:
             if 'contacts_file' not in request.FILES:
-                print()
-                return redirect(url_with_message_parameters(
-                    redirect_url_string='index_after',
-                    status='error',
-                    content='файл  не был загружен, перевод на главную страницу'))
+                return _import_file_missing()
             uploaded_file = request.FILES['contacts_file']
-            contacts_to_import = process_imported_file(uploaded_file)
-            if not contacts_to_import:
-                return redirect(url_with_message_parameters(
-                    redirect_url_string='index_after',
-                    status='error',
-                    content='Не удалось извлечь контактов из файла или файл пуст'))
-            # получаем структурированный словарь с названиями компаний
-            company_dict = { company['TITLE']: company['ID'] for company in but.call_list_method("crm.company.list", {
-                "select": ["ID", "TITLE"]
-            })}
-            company_title_list = list(company_dict.keys())
-            print(f'Получен список компаний: {company_dict} \n\
-            И список названий компаний: {company_title_list}\n\
-            \n\
-            Из файла получен следующий наобр контактов: {contacts_to_import}')
-
-
-            methods = []
-            for contact_data in contacts_to_import:
-                fields = {
-                    'NAME': contact_data['NAME'],
-                    'LAST_NAME': contact_data['LAST_NAME'],
-                    'PHONE': [{'VALUE': contact_data['PHONE'], 'VALUE_TYPE': 'WORK'}] if contact_data['PHONE'] else None,
-                    'EMAIL': [{'VALUE': contact_data['EMAIL'], 'VALUE_TYPE': 'WORK'}] if contact_data['EMAIL'] else None,
-                    'COMPANY_ID': company_dict[contact_data['COMPANY_NAME']] if (
-                            contact_data['COMPANY_NAME']
-                            and contact_data['COMPANY_NAME'] in company_title_list
-                    ) else None,
-                }
-                methods.append(('crm.contact.add', {'fields': fields}))
-            results = but.batch_api_call(methods, halt=0)
-            # анализируем результаты
-            success_count = 0
-            for _, result in results.items():
-                if result.get('error') is None:
-                    success_count += 1
-
-            return redirect(url_with_message_parameters(
-                    redirect_url_string='index_after',
-                    status='success',
-                    content=f'Успешно импортировано контактов: {success_count}/{len(results.items())}'))
+            increment(COUNTER_BYTES_RECEIVED, uploaded_file.size)
+            # create - только новые контакты; upsert - ещё и обновление найденных, только изменившимися полями
+            mode = request.POST.get('import_mode') or IMPORT_MODE_CREATE
+            if mode not in IMPORT_MODES:
+                return _import_mode_error(mode)
+
+            # --- большой файл импортируем в фоне: он сохраняется на диск, клиент опрашивает статус задачи
+            if request.POST.get('run_in_background'):
+                return _import_job_queued(enqueue_import_job(but, uploaded_file, mode))
+
+            # компании сопоставляются по нормализованному названию (без правовой формы, кавычек и регистра)
+            company_resolver = CompanyResolver(get_company_directory(but))
+            # индекс существующих контактов по телефону и почте: дубликаты отсеиваются без rest-запросов на строку,
+            # для upsert в нём же текущие значения полей, с которыми сравниваются строки файла
+            duplicate_index = contact_index_class(mode).build(but)
+
+            # журнал chunk-ов по хэшу файла: повтор импорта того же файла не создаст контакты второй раз
+            journal = _open_import_journal(but, uploaded_file, mode)
+
+            # файл разбирается лениво, готовые chunk-и по 50 контактов уходят в bitrix, пока разбор идёт дальше
+            contacts_to_import = iter_imported_file(uploaded_file)
+            pipeline = ImportPipeline(but, duplicate_index, company_resolver, journal=journal, mode=mode)
+            return _import_result(pipeline.run(contacts_to_import), mode)
         except Exception as e:
             return HttpResponse( f'Ошибка при обработке файла: {str(e)}', status=500)
-    return HttpResponse(f'Недопустимый метод {request.method}', status=405)
\ No newline at end of file
+    return HttpResponse(f'Недопустимый метод {request.method}', status=405)
+
+
+# --- тот же импорт для asgi: индекс дубликатов и отправка chunk-ов идут через общий http-клиент
+@instrumented_async_view('import_contacts', cached_auth(main_auth(on_cookies=True)))
+async def import_contacts_async(request):
+    if request.method == 'POST':
+        but = request.bitrix_user_token
+        try:
+            if 'contacts_file' not in request.FILES:
+                return _import_file_missing()
+            uploaded_file = request.FILES['contacts_file']
+            increment(COUNTER_BYTES_RECEIVED, uploaded_file.size)
+            mode = request.POST.get('import_mode') or IMPORT_MODE_CREATE
+            if mode not in IMPORT_MODES:
+                return _import_mode_error(mode)
+
+            if request.POST.get('run_in_background'):
+                return _import_job_queued(await sync_to_async(enqueue_import_job)(but, uploaded_file, mode))
+
+            company_resolver = CompanyResolver(await sync_to_async(get_company_directory)(but))
+            duplicate_index = await contact_index_class(mode).abuild(but)
+            journal = await sync_to_async(_open_import_journal)(but, uploaded_file, mode)
+
+            pipeline = AsyncImportPipeline(but, duplicate_index, company_resolver, journal=journal, mode=mode)
+            result = await pipeline.arun(iter_imported_file(uploaded_file))
+            return _import_result(result, mode)
+        except Exception as e:
+            return HttpResponse(f'Ошибка при обработке файла: {str(e)}', status=500)
+    return HttpResponse(f'Недопустимый метод {request.method}', status=405)
+
+
+def _open_import_journal(but, uploaded_file, mode: str) -> Optional[ImportJournal]:
+    # upsert журнал не ведёт: повтор того же файла сравнивается с контактами и не отправляет уже применённые строки
+    if mode == IMPORT_MODE_UPSERT:
+        return None
+    return ImportJournal(get_portal_id(but), compute_file_hash(uploaded_file))
+
+
+def _import_mode_error(mode: str) -> HttpResponse:
+    return redirect(url_with_message_parameters(
+        redirect_url_string='index_after',
+        status='error',
+        content=f'Неизвестный режим импорта: {mode}'))
+
+
+def _import_file_missing() -> HttpResponse:
+    return redirect(url_with_message_parameters(
+        redirect_url_string='index_after',
+        status='error',
+        content='файл  не был загружен, перевод на главную страницу'))
+
+
+def _import_job_queued(job: ImportJob) -> HttpResponse:
+    return redirect(url_with_message_parameters(
+        redirect_url_string='index_after',
+        status='info',
+        content=f'Импорт поставлен в очередь, задача №{job.id}',
+        extra_parameters={'import_job_id': job.id}))
+
+
+def _import_result(result: ImportResult, mode: str) -> HttpResponse:
+    if not result.total_count:
+        return redirect(url_with_message_parameters(
+            redirect_url_string='index_after',
+            status='error',
+            content='Не удалось извлечь контактов из файла или файл пуст'))
+
+    if mode == IMPORT_MODE_UPSERT:
+        return redirect(url_with_message_parameters(
+            redirect_url_string='index_after',
+            status='success',
+            content=f'Создано контактов: {result.success_count - result.updated_count}, '
+                    f'обновлено: {result.updated_count}, без изменений: {result.unchanged_count}, '
+                    f'повторов в файле: {result.duplicate_count}, '
+                    f'отклонено из-за неверного телефона или почты: {result.invalid_count}, '
+                    f'не принято bitrix: {len(result.failed_rows) - result.invalid_count}'))
+
+    return redirect(url_with_message_parameters(
+            redirect_url_string='index_after',
+            status='success',
+            content=f'Успешно импортировано контактов: {result.success_count}/{result.submitted_count}, '
+                    f'пропущено дубликатов: {result.duplicate_count}, '
+                    f'отклонено из-за неверного телефона или почты: {result.invalid_count}, '
+                    f'уже импортировано ранее: {result.resumed_count}'))
+
+
+@cached_auth(main_auth(on_cookies=True))
+def import_job_status(request, job_id):
+    job = _get_user_job(request, ImportJob, job_id)
+    if job is None:
+        return JsonResponse({'error': f'задача импорта {job_id} не найдена'}, status=404)
+    return JsonResponse({
+        'id': job.id,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'original_name': job.original_name,
+        'rows_processed': job.rows_processed,
+        'import_mode': job.import_mode,
+        'success_count': job.success_count,
+        'updated_count': job.updated_count,
+        'unchanged_count': job.unchanged_count,
+        'duplicate_count': job.duplicate_count,
+        'resumed_count': job.resumed_count,
+        'failed_count': job.failed_count,
+        'error': job.error,
+        'progress': _import_job_progress(job),
+        'download_url': reverse('import_job_errors', args=[job.id]) if job.error_report else None,
+        'resume_url': reverse('import_job_resume', args=[job.id]) if can_resume_import_job(job) else None,
+    })
+
+
+def _import_job_progress(job: ImportJob) -> str:
+    if job.import_mode == IMPORT_MODE_UPSERT:
+        return (f'строк обработано: {job.rows_processed}, создано: {job.success_count - job.updated_count}, '
+                f'обновлено: {job.updated_count}, без изменений: {job.unchanged_count}, '
+                f'повторов в файле: {job.duplicate_count}, с ошибкой: {job.failed_count}')
+    return (f'строк обработано: {job.rows_processed}, импортировано: {job.success_count}, '
+            f'дубликатов: {job.duplicate_count}, с ошибкой: {job.failed_count}, '
+            f'уже импортировано ранее: {job.resumed_count}')
+
+
+@cached_auth(main_auth(on_cookies=True))
+def import_job_resume(request, job_id):
+    if request.method != 'POST':
+        return HttpResponse(f'Недопустимый метод {request.method}', status=405)
+    job = _get_user_job(request, ImportJob, job_id)
+    if job is None:
+        return JsonResponse({'error': f'задача импорта {job_id} не найдена'}, status=404)
+    if not resume_import_job(request.bitrix_user_token, job):
+        return JsonResponse({'error': f'задача импорта {job_id} уже выполняется или завершена'}, status=409)
+    return JsonResponse({'id': job.id, 'status': ImportJob.STATUS_PENDING})
+
+
+@cached_auth(main_auth(on_cookies=True))
+def import_job_errors(request, job_id):
+    job = _get_user_job(request, ImportJob, job_id)
+    if job is None or not job.error_report:
+        return HttpResponse(f'Ошибка 404: отчёт об ошибках импорта {job_id} не найден', status=404)
+    return FileResponse(
+        job.error_report.open('rb'),
+        as_attachment=True,
+        filename=f'import_errors_{job.id}.csv',
+        content_type='text/csv; charset=utf-16',
+    )
+
+
+# --- метрики экспорта и импорта портала пользователя: время этапов и счётчики с запуска процесса
+@cached_auth(main_auth(on_cookies=True))
+def contact_metrics(request):
+    return JsonResponse(registry.snapshot(get_portal_id(request.bitrix_user_token)))
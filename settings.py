@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -50,6 +51,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'contact_export.middleware.async_streaming_middleware',
 ]
 
 ROOT_URLCONF = 'bitrix_app_5.urls'
@@ -71,6 +73,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'bitrix_app_5.wsgi.application'
+# asgi.py выставляет CONTACT_EXPORT_ASGI до загрузки настроек: экспорт и импорт тогда обслуживают асинхронные view.
+# под wsgi (runserver, gunicorn) остаются синхронные - асинхронный потоковый ответ wsgi собрал бы в памяти целиком
+CONTACT_EXPORT_ASGI = os.environ.get('CONTACT_EXPORT_ASGI') == '1'
 
 
 # Database
@@ -124,6 +129,8 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 import os
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# здесь хранятся результаты фоновых экспортов
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 from integration_utils.its_utils.mute_logger import MuteLogger
 ilogger = MuteLogger()
 